@@ -49,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'materials.instrumentation.QueryInspectorMiddleware',
 ]
 
 ROOT_URLCONF = 'circularfashion.urls'
@@ -126,3 +127,67 @@ USE_TZ = True
 STATIC_URL = '/static/'
 
 STATIC_ROOT = 'static'
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+# holds the taxonomy and data versions and the serialized fragments, the processes serving the API only see each
+# other's changes through a shared backend (file based or memcached rather than local memory)
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': config('CACHE_LOCATION', default=''),
+        'OPTIONS': {
+            # a fragment and a version counter per material and per quality, past it entries evict each other
+            'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', default=100000, cast=int),
+        },
+    }
+}
+
+
+# Materials rule evaluation
+
+MATERIALS_RULE_CACHE_SIZE = config('MATERIALS_RULE_CACHE_SIZE', default=2048, cast=int)
+
+# unset means the recyclers listing is only paginated when `?page_size=` is given
+RECYCLERS_PAGE_SIZE = config('RECYCLERS_PAGE_SIZE', default=None, cast=lambda v: int(v) if v else None)
+
+# materials listed per page, the materials listing is always paginated
+MATERIALS_PAGE_SIZE = config('MATERIALS_PAGE_SIZE', default=100, cast=int)
+
+# seconds the serialized qualities and materials are cached for, 0 disables the fragment cache. Disabled by default
+# with the local memory cache, where a version bumped by one process is not seen by the others and they would keep
+# serving their own fragments
+MATERIALS_FRAGMENT_CACHE_TIMEOUT = config(
+    'MATERIALS_FRAGMENT_CACHE_TIMEOUT', cast=int,
+    default=0 if CACHES['default']['BACKEND'].endswith('.LocMemCache') else 24 * 60 * 60,
+)
+
+# answer with an ETag and a 304 while the data versions are unchanged. Off by default with the local memory cache,
+# where a process would keep answering 304 for data another process changed
+MATERIALS_CONDITIONAL_RESPONSES = config(
+    'MATERIALS_CONDITIONAL_RESPONSES', cast=bool,
+    default=not CACHES['default']['BACKEND'].endswith('.LocMemCache'),
+)
+
+# where build_snapshot writes the memory mapped snapshot of the materials and qualities
+MATERIALS_SNAPSHOT_PATH = config('MATERIALS_SNAPSHOT_PATH', default=str(BASE_DIR / 'materials.snapshot'))
+
+# compositions a single what-if request can judge
+WHAT_IF_MAX_COMPOSITIONS = config('WHAT_IF_MAX_COMPOSITIONS', default=500, cast=int)
+
+RECYCLERS_STREAM_CHUNK_SIZE = config('RECYCLERS_STREAM_CHUNK_SIZE', default=100, cast=int)
+
+# threads the async recyclers listing fans out to, each holds its own database connection while working
+RECYCLERS_ASYNC_WORKERS = config('RECYCLERS_ASYNC_WORKERS', default=4, cast=int)
+
+
+# Query instrumentation
+
+QUERY_INSPECTOR_ENABLED = config('QUERY_INSPECTOR_ENABLED', default=DEBUG, cast=bool)
+
+# raise instead of logging when a view runs more queries than its `query_budget`, the tests always do
+QUERY_BUDGET_STRICT = config('QUERY_BUDGET_STRICT', default=False, cast=bool)
+
+QUERY_INSPECTOR_REPEAT_THRESHOLD = config('QUERY_INSPECTOR_REPEAT_THRESHOLD', default=3, cast=int)
@@ -2,7 +2,7 @@ from django.contrib import admin
 from mptt.admin import MPTTModelAdmin
 
 from materials.models import Attribute, AttributeOption, MaterialAttribute, Material, \
-    Recycler, RecyclerQuality
+    Recycler, RecyclerQuality, QualityResult
 
 
 admin.site.register(Attribute, MPTTModelAdmin)
@@ -11,3 +11,4 @@ admin.site.register(Material)
 admin.site.register(MaterialAttribute)
 admin.site.register(Recycler)
 admin.site.register(RecyclerQuality)
+admin.site.register(QualityResult)
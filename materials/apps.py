@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class MaterialsConfig(AppConfig):
     name = 'materials'
+
+    def ready(self):
+        from materials import signals  # noqa
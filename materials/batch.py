@@ -0,0 +1,187 @@
+from collections import defaultdict
+from typing import Iterable, List, Union
+
+import numpy as np
+
+from materials.constants import ATTR_VALUE_TYPE, OPERATORS
+from materials.context import Taxonomy, taxonomy_cache
+from materials.exceptions import InvalidOperandException
+from materials.rules import CompiledRule, Operation, Operand, SubexpressionStats, COMPARISON_FUNCTIONS, \
+    ARITHMETIC_FUNCTIONS, percentage_points, to_basis_points
+
+
+class UnsupportedBatchOperation(Exception):
+    """Raised when an operation cannot be evaluated on arrays, callers fall back to per material evaluation."""
+
+
+class MaterialMatrix:
+    """
+    A dense material x attribute matrix. `values` holds the same values `MaterialContext.attribute()` returns
+    (percentages in basis points, choices as option ids), with NaN standing in for a missing value, and
+    `categories` holds one column of category totals per category placeholder. Floats hold these integers exactly.
+    """
+
+    def __init__(self, material_ids: np.ndarray, columns: dict, values: np.ndarray, categories: dict,
+                 taxonomy: Taxonomy):
+        self.material_ids = material_ids
+        self.columns = columns
+        self.values = values
+        self.categories = categories
+        self.taxonomy = taxonomy
+        # operation key -> vector, shared by every rule judged on this matrix
+        self.memo = {}
+        self.stats = SubexpressionStats()
+
+    def __len__(self):
+        return len(self.material_ids)
+
+    @classmethod
+    def build(cls, materials: Union[Iterable[int], None] = None, taxonomy: Taxonomy = None) -> 'MaterialMatrix':
+        """
+        `materials` is a queryset or an iterable of material ids, all materials are used when it is not given.
+        """
+        from materials.models import Material, MaterialAttribute
+
+        taxonomy = taxonomy or taxonomy_cache.get()
+        if materials is None:
+            materials = Material.objects.all()
+        if hasattr(materials, 'values_list'):
+            materials = materials.values_list('id', flat=True)
+        material_ids = np.array(sorted(set(materials)), dtype=np.int64)
+        rows = {material_id: i for i, material_id in enumerate(material_ids.tolist())}
+
+        qs = MaterialAttribute.objects.order_by('id').values_list(
+            'material_id', 'attribute__placeholder', 'value_type', 'percentage', 'choice_id'
+        )
+        if len(rows) < Material.objects.count():
+            qs = qs.filter(material_id__in=list(rows))
+
+        columns = {}
+        cells = {}
+        sums = defaultdict(dict)
+        for material_id, placeholder, value_type, percentage, choice_id in qs.iterator():
+            row = rows[material_id]
+            column = columns.setdefault(placeholder, len(columns))
+            # the first row wins, like a `.first()` lookup would
+            points = percentage_points(percentage)
+            if (row, column) not in cells:
+                cells[(row, column)] = choice_id if value_type == ATTR_VALUE_TYPE.CHOICE else points
+            if value_type != ATTR_VALUE_TYPE.PERCENTAGE:
+                continue
+            # totals roll up to every category above the attribute, exactly like the single material context does
+            for category in taxonomy.ancestors.get(placeholder, ()):
+                total = sums[category].get(row)
+                if points is not None:
+                    total = (total or 0) + points
+                sums[category][row] = total
+
+        values = np.full((len(material_ids), len(columns)), np.nan)
+        for (row, column), value in cells.items():
+            if value is not None:
+                values[row, column] = value
+        categories = {}
+        for category, totals in sums.items():
+            categories[category] = np.full(len(material_ids), np.nan)
+            for row, total in totals.items():
+                if total is not None:
+                    categories[category][row] = total
+        return cls(material_ids, columns, values, categories, taxonomy)
+
+    def attribute(self, placeholder: str) -> np.ndarray:
+        if placeholder not in self.taxonomy.attributes:
+            raise InvalidOperandException(placeholder, 'ATTR')
+        column = self.columns.get(placeholder)
+        if column is None:
+            return np.full(len(self), np.nan)
+        return self.values[:, column]
+
+    def option(self, placeholder: str) -> int:
+        option_id = self.taxonomy.options.get(placeholder)
+        if option_id is None:
+            raise InvalidOperandException(placeholder, 'OPT')
+        return option_id
+
+    def cumulative(self, placeholder: str) -> np.ndarray:
+        if placeholder not in self.taxonomy.categories:
+            raise InvalidOperandException(placeholder, 'CUM')
+        return self.categories.get(placeholder, np.full(len(self), np.nan))
+
+
+def truth(value) -> Union[np.ndarray, bool]:
+    if isinstance(value, np.ndarray):
+        if value.dtype == bool:
+            return value
+        return (value != 0) & ~missing(value)
+    return bool(value)
+
+
+def missing(value) -> Union[np.ndarray, bool]:
+    if isinstance(value, np.ndarray) and value.dtype.kind == 'f':
+        return np.isnan(value)
+    return False
+
+
+def evaluate_node(node: Union[Operation, Operand], matrix: MaterialMatrix, scaled: bool = True):
+    if isinstance(node, Operand):
+        if node.kind == 'literal':
+            if isinstance(node.value, str):
+                raise UnsupportedBatchOperation(node.value)
+            return to_basis_points(node.value) if scaled else node.value
+        return getattr(matrix, node.kind)(node.value)
+
+    matrix.stats.requested += 1
+    if node.key in matrix.memo:
+        return matrix.memo[node.key]
+    matrix.stats.evaluated += 1
+    result = matrix.memo[node.key] = evaluate_operation(node, matrix)
+    return result
+
+
+def evaluate_operation(node: Operation, matrix: MaterialMatrix):
+    values = [evaluate_node(operand, matrix, scaled=node.scales_literals) for operand in node.operands]
+    if node.operator == OPERATORS['AND']['sign']:
+        result = True
+        for value in values:
+            result = np.logical_and(result, truth(value))
+        return result
+    elif node.operator == OPERATORS['OR']['sign']:
+        result = False
+        for value in values:
+            result = np.logical_or(result, truth(value))
+        return result
+    elif node.operator in COMPARISON_FUNCTIONS:
+        compare = COMPARISON_FUNCTIONS[node.operator]
+        result = True
+        for left, right in zip(values, values[1:]):
+            pair = compare(left, right)
+            if node.operator in (OPERATORS['EQ']['sign'], OPERATORS['NEQ']['sign']):
+                # two missing values are equal, as two `None`s are when evaluating a single material
+                both_missing = missing(left) & missing(right)
+                if node.operator == OPERATORS['EQ']['sign']:
+                    pair = np.logical_or(pair, both_missing)
+                else:
+                    pair = np.logical_and(pair, np.logical_not(both_missing))
+            result = np.logical_and(result, pair)
+        return result
+    arithmetic = ARITHMETIC_FUNCTIONS[node.operator]
+    result = values[0]
+    for value in values[1:]:
+        result = arithmetic(result, value)
+    return result
+
+
+def evaluate_rule(rule: CompiledRule, min_count: int, matrix: MaterialMatrix) -> np.ndarray:
+    """
+    Returns a boolean vector aligned with `matrix.material_ids`, each operation is one column and `min_count`
+    is applied across the columns of a row.
+    """
+    results = np.zeros((len(matrix), len(rule.operations)), dtype=bool)
+    for i, operation in enumerate(rule.operations):
+        results[:, i] = np.broadcast_to(truth(evaluate_node(operation, matrix)), len(matrix))
+    if min_count == -1:
+        return results.all(axis=1)
+    return results.sum(axis=1) >= min_count
+
+
+def matching_material_ids(passed: np.ndarray, matrix: MaterialMatrix) -> List[int]:
+    return matrix.material_ids[passed].tolist()
@@ -0,0 +1,177 @@
+import threading
+from typing import Any, Optional, Union
+
+from django.core.cache import cache
+
+from materials.constants import ATTR_VALUE_TYPE
+from materials.exceptions import InvalidOperandException
+from materials.rules import SubexpressionStats, percentage_points, to_basis_points
+
+
+class Taxonomy:
+    """
+    The attributes, categories and options operands are allowed to reference, loaded in one pass so that
+    validating an operand or serializing an attribute does not need a query of its own.
+    """
+
+    def __init__(self, attributes: set, categories: set, options: dict, ancestors: dict = None,
+                 attributes_by_id: dict = None, options_by_id: dict = None, ids: dict = None,
+                 ancestor_ids: dict = None):
+        self.attributes = attributes
+        self.categories = categories
+        self.options = options
+        # attribute placeholder -> the placeholders of every category above it, nearest first
+        self.ancestors = ancestors or {}
+        # id -> model instance, shared by every reader of the cached taxonomy so they must not be modified
+        self.attributes_by_id = attributes_by_id or {}
+        self.options_by_id = options_by_id or {}
+        # attribute or category placeholder -> id, and the ancestors chains by id
+        self.ids = ids or {}
+        self.ancestor_ids = ancestor_ids or {}
+
+    @classmethod
+    def load(cls) -> 'Taxonomy':
+        from materials.models import Attribute, AttributeOption
+
+        attributes_by_id = Attribute.objects.order_by().in_bulk()
+        options_by_id = AttributeOption.objects.order_by().in_bulk()
+        attributes, categories, ancestors, ancestor_ids = set(), set(), {}, {}
+        for attribute in attributes_by_id.values():
+            if attribute.category_id is None:
+                continue
+            attributes.add(attribute.placeholder)
+            chain = []
+            category = attributes_by_id.get(attribute.category_id)
+            while category is not None:
+                chain.append(category)
+                category = attributes_by_id.get(category.category_id)
+            categories.update(category.placeholder for category in chain)
+            ancestors[attribute.placeholder] = tuple(category.placeholder for category in chain)
+            ancestor_ids[attribute.id] = tuple(category.id for category in chain)
+        options = {option.placeholder: option.id for option in options_by_id.values()}
+        ids = {attribute.placeholder: attribute.id for attribute in attributes_by_id.values()}
+        return cls(attributes, categories, options, ancestors, attributes_by_id, options_by_id, ids, ancestor_ids)
+
+
+class TaxonomyCache:
+    """
+    Keeps the taxonomy in memory and reloads it when its version changes. The version is a counter in the
+    Django cache, bumped whenever an attribute or an option is saved or deleted, so that every process sharing
+    the cache backend picks up the change.
+    """
+    VERSION_KEY = 'materials:taxonomy:version'
+
+    def __init__(self):
+        self._taxonomy = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> int:
+        return cache.get(self.VERSION_KEY, 0)
+
+    def get(self) -> Taxonomy:
+        version = self.version
+        taxonomy = self._taxonomy
+        if taxonomy is not None and self._version == version:
+            return taxonomy
+        with self._lock:
+            if self._taxonomy is None or self._version != version:
+                # the version is read before loading, a change made meanwhile triggers another reload
+                self._taxonomy, self._version = Taxonomy.load(), version
+            return self._taxonomy
+
+    def invalidate(self):
+        cache.add(self.VERSION_KEY, 0, timeout=None)
+        try:
+            cache.incr(self.VERSION_KEY)
+        except ValueError:
+            # evicted in between, any value other than the loaded one triggers a reload
+            cache.set(self.VERSION_KEY, 1, timeout=None)
+        self._taxonomy = None
+
+
+taxonomy_cache = TaxonomyCache()
+
+
+class MaterialContext:
+    """
+    All the values a material can substitute for an operand placeholder, built from the material's attributes
+    in a single query (or none at all when `materialattribute_set` has been prefetched). Values are kept by
+    attribute id, placeholders are looked up in the taxonomy.
+    Category totals roll up the whole subtree, a percentage counts towards every category above its attribute.
+    Unsaved attributes can be given as `material_attributes`, in the order they would have been stored.
+    """
+
+    def __init__(self, material, taxonomy: Taxonomy = None, stats: SubexpressionStats = None,
+                 material_attributes: list = None):
+        from materials.models import MaterialAttribute
+
+        self.material = material
+        self.taxonomy = taxonomy or taxonomy_cache.get()
+        # operation key -> value, shared by every rule judged against this material
+        self.memo = {}
+        self.stats = stats or SubexpressionStats()
+        if material_attributes is None:
+            if 'materialattribute_set' in getattr(material, '_prefetched_objects_cache', {}):
+                material_attributes = list(material.materialattribute_set.all())
+            else:
+                material_attributes = list(MaterialAttribute.objects.filter(material=material))
+            material_attributes.sort(key=lambda ma: ma.pk)
+        self.attributes = {}
+        self.categories = {}
+        for material_attribute in material_attributes:
+            self.attributes.setdefault(material_attribute.attribute_id, material_attribute)
+            if material_attribute.value_type != ATTR_VALUE_TYPE.PERCENTAGE:
+                continue
+            points = percentage_points(material_attribute.percentage)
+            for category_id in self.taxonomy.ancestor_ids.get(material_attribute.attribute_id, ()):
+                category_sum = self.categories.get(category_id)
+                if points is not None:
+                    category_sum = (category_sum or 0) + points
+                self.categories[category_id] = category_sum
+
+    def attribute(self, placeholder: str) -> Optional[int]:
+        if placeholder not in self.taxonomy.attributes:
+            raise InvalidOperandException(placeholder, 'ATTR')
+        return self.attribute_value(self.taxonomy.ids[placeholder])
+
+    def attribute_value(self, attribute_id: int) -> Optional[int]:
+        """
+        Percentages are returned in basis points of 1 (70% is 7000), choices as the id of the chosen option so that
+        they can be compared with `option()`.
+        """
+        material_attribute = self.attributes.get(attribute_id)
+        if material_attribute is None:
+            return None
+        elif material_attribute.value_type == ATTR_VALUE_TYPE.CHOICE:
+            return material_attribute.choice_id
+        return percentage_points(material_attribute.percentage)
+
+    def option(self, placeholder: str) -> int:
+        option_id = self.taxonomy.options.get(placeholder)
+        if option_id is None:
+            raise InvalidOperandException(placeholder, 'OPT')
+        return option_id
+
+    def cumulative(self, placeholder: str) -> Optional[int]:
+        if placeholder not in self.taxonomy.categories:
+            raise InvalidOperandException(placeholder, 'CUM')
+        return self.cumulative_value(self.taxonomy.ids[placeholder])
+
+    def cumulative_value(self, category_id: int) -> Optional[int]:
+        return self.categories.get(category_id)
+
+    def resolve(self, operand: Union[str, int, float]) -> Any:
+        if not isinstance(operand, str):
+            # in the same units as the attributes
+            return to_basis_points(operand)
+        elif operand.isnumeric():
+            return operand
+        elif operand.startswith('ATTR_'):
+            return self.attribute(operand.replace('ATTR_', '', 1))
+        elif operand.startswith('OPT_'):
+            return self.option(operand.replace('OPT_', '', 1))
+        elif operand.startswith('CUM_'):
+            return self.cumulative(operand.replace('CUM_', '', 1))
+        raise InvalidOperandException(operand, 'Unknown')
@@ -1,26 +1,26 @@
 from materials.constants import OPERATOR_CHOICES, BOOLEAN_OPERATOR_CHOICES
 
 
-class MissingOperatorException(BaseException):
+class MissingOperatorException(Exception):
     def __init__(self, expression, *args):
         self.message = f'Operator not present in expression {str(expression)}. ' \
                        f'Operators [{", ".join([op[1] for op in OPERATOR_CHOICES])}] are allowed.'
         super().__init__(self.message, *args)
 
 
-class MissingOperandsException(BaseException):
+class MissingOperandsException(Exception):
     def __init__(self, expression, *args):
         self.message = f'Operands not present in expression {str(expression)}.'
         super().__init__(self.message, *args)
 
 
-class InvalidOperandException(BaseException):
+class InvalidOperandException(Exception):
     def __init__(self, operand, type_, *args):
         self.message = f'Invalid operand {str(operand)} of type "{type_}".'
         super().__init__(self.message, *args)
 
 
-class InvalidRootOperatorException(BaseException):
+class InvalidRootOperatorException(Exception):
     def __init__(self, operator, *args):
         self.message = f'Invalid root operator "{str(operator)}". ' \
                        f'Root operator must be a function that returns a boolean. ' \
@@ -29,13 +29,46 @@ class InvalidRootOperatorException(BaseException):
         super().__init__(self.message, *args)
 
 
-class NoOperationToPerformException(BaseException):
+class NoOperationToPerformException(Exception):
     def __init__(self, operations, *args):
         self.message = f'No operation to perform or invalid expressions. \n{str(operations)}'
         super().__init__(self.message, *args)
 
 
-class UnTrustedOperationException(BaseException):
+class UnTrustedOperationException(Exception):
     def __init__(self, co_names, *args):
         self.message = f'Untrusted operation. Found [{", ".join(co_names)}]'
-        super().__init__(self.message, *args)
\ No newline at end of file
+        super().__init__(self.message, *args)
+
+
+class InvalidOperatorException(Exception):
+    def __init__(self, operator, *args):
+        self.message = f'Invalid operator "{str(operator)}". ' \
+                       f'Operators [{", ".join([op[1] for op in OPERATOR_CHOICES])}] are allowed.'
+        super().__init__(self.message, *args)
+
+
+class QueryBudgetExceededException(Exception):
+    def __init__(self, path, budget, report, *args):
+        self.message = f'Query budget of {budget} exceeded on {path}.\n{report}'
+        super().__init__(self.message, *args)
+
+
+class InvalidIngestRowException(Exception):
+    def __init__(self, line, reason, *args):
+        self.line, self.reason = line, reason
+        self.message = f'Invalid material on line {line}: {reason}.'
+        super().__init__(self.message, *args)
+
+
+class InvalidSnapshotException(Exception):
+    def __init__(self, path, reason, *args):
+        self.message = f'Invalid snapshot {path}: {reason}.'
+        super().__init__(self.message, *args)
+
+
+# everything that can be raised while compiling or evaluating a quality's operations
+OPERATION_EXCEPTIONS = (
+    MissingOperatorException, MissingOperandsException, InvalidOperandException, InvalidRootOperatorException,
+    NoOperationToPerformException, UnTrustedOperationException, InvalidOperatorException
+)
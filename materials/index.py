@@ -0,0 +1,218 @@
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple, Union
+
+from materials.constants import OPERATORS
+from materials.context import MaterialContext, Taxonomy, taxonomy_cache
+from materials.exceptions import OPERATION_EXCEPTIONS
+from materials.rules import CompiledRule, Operation, Operand, rule_cache, to_basis_points
+from materials.versions import data_versions
+
+# flips an ordering when the literal is written on the left, `0.7 <= ATTR_X` is `ATTR_X >= 0.7`
+MIRRORED = {
+    OPERATORS['GT']['sign']: OPERATORS['LT']['sign'],
+    OPERATORS['LT']['sign']: OPERATORS['GT']['sign'],
+    OPERATORS['GTE']['sign']: OPERATORS['LTE']['sign'],
+    OPERATORS['LTE']['sign']: OPERATORS['GTE']['sign'],
+    OPERATORS['EQ']['sign']: OPERATORS['EQ']['sign'],
+}
+INDEXED_KINDS = ('attribute', 'cumulative')
+
+Predicate = Tuple[Tuple[str, str], str, Union[int, float]]
+
+
+def extract_predicate(node: Union[Operation, Operand], taxonomy: Taxonomy) -> Optional[Predicate]:
+    """
+    Returns `((kind, placeholder), sign, value)` when `node` is a comparison of an attribute or a category
+    total with a number, or of an attribute with an option, e.g. `ATTR_POLYESTER >= 0.7`.
+    """
+    if not isinstance(node, Operation) or node.operator not in MIRRORED or len(node.operands) != 2:
+        return None
+    left, right = node.operands
+    if not isinstance(left, Operand) or not isinstance(right, Operand):
+        return None
+    sign = node.operator
+    if right.kind in INDEXED_KINDS:
+        left, right, sign = right, left, MIRRORED[sign]
+    if left.kind not in INDEXED_KINDS:
+        return None
+    if right.kind == 'option' and sign == OPERATORS['EQ']['sign'] and left.kind == 'attribute':
+        value = taxonomy.options.get(right.value)
+        return None if value is None else ((left.kind, left.value), sign, value)
+    if right.kind == 'literal' and isinstance(right.value, (int, float)) and not isinstance(right.value, bool):
+        # in the units the material's values are compared in
+        return (left.kind, left.value), sign, to_basis_points(right.value)
+    return None
+
+
+class QualityIndex:
+    """
+    An index of the predicates every quality's operations require, so the qualities a material may pass are
+    found without evaluating every rule.
+
+    An operation is indexed when it is a predicate or an `and` of operands some of which are predicates: the
+    operation cannot pass unless all those predicates hold. Thresholds are kept sorted per attribute and
+    operator, equalities in a hash map, and a quality is a candidate when, counting the operations the index
+    cannot rule out, it can still reach its `min_count`.
+    """
+
+    def __init__(self, rules: Dict[int, Tuple[CompiledRule, int]], taxonomy: Taxonomy):
+        self.rules = rules
+        self.taxonomy = taxonomy
+        self.predicates: Dict[Predicate, int] = {}
+        self.thresholds = defaultdict(lambda: defaultdict(list))
+        self.equalities = defaultdict(list)
+        # predicate id -> operations requiring it, operation id -> (quality id, number of predicates)
+        self.requiring = defaultdict(list)
+        self.operations: List[Tuple[int, int]] = []
+        # qualities that can pass on the operations the index cannot rule out alone
+        self.always: List[int] = []
+        # quality id -> number of indexed operations that must pass on top of the ones that are not indexed
+        self.needed: Dict[int, int] = {}
+
+        for quality_id, (rule, min_count) in rules.items():
+            required = len(rule.operations) if min_count == -1 else min_count
+            unindexed = 0
+            for operation in rule.operations:
+                predicates = self.operation_predicates(operation)
+                if not predicates:
+                    unindexed += 1
+                    continue
+                operation_id = len(self.operations)
+                self.operations.append((quality_id, len(predicates)))
+                for predicate in predicates:
+                    self.requiring[self.add_predicate(predicate)].append(operation_id)
+            if unindexed >= required:
+                self.always.append(quality_id)
+            else:
+                self.needed[quality_id] = required - unindexed
+
+    def operation_predicates(self, operation: Operation) -> set:
+        predicate = extract_predicate(operation, self.taxonomy)
+        if predicate is not None:
+            return {predicate}
+        elif isinstance(operation, Operation) and operation.operator == OPERATORS['AND']['sign']:
+            return {
+                predicate for predicate in (extract_predicate(operand, self.taxonomy) for operand in operation.operands)
+                if predicate is not None
+            }
+        return set()
+
+    def add_predicate(self, predicate: Predicate) -> int:
+        if predicate in self.predicates:
+            return self.predicates[predicate]
+        predicate_id = self.predicates[predicate] = len(self.predicates)
+        key, sign, value = predicate
+        if sign == OPERATORS['EQ']['sign']:
+            self.equalities[(key, value)].append(predicate_id)
+        else:
+            insort(self.thresholds[key][sign], (value, predicate_id))
+        return predicate_id
+
+    def satisfied(self, key: Tuple[str, str], value: Union[int, float]) -> List[int]:
+        predicate_ids = list(self.equalities.get((key, value), []))
+        thresholds = self.thresholds.get(key, {})
+        for sign, entries in thresholds.items():
+            bound = (value, float('inf'))
+            if sign == OPERATORS['GTE']['sign']:
+                # value >= threshold for every threshold up to and including value
+                matching = entries[:bisect_right(entries, bound)]
+            elif sign == OPERATORS['GT']['sign']:
+                matching = entries[:bisect_left(entries, (value, -1))]
+            elif sign == OPERATORS['LTE']['sign']:
+                matching = entries[bisect_left(entries, (value, -1)):]
+            else:
+                matching = entries[bisect_right(entries, bound):]
+            predicate_ids.extend(predicate_id for _, predicate_id in matching)
+        return predicate_ids
+
+    def candidates(self, context: MaterialContext) -> List[int]:
+        candidates = list(self.always)
+        hits = defaultdict(int)
+        keys = {key for key, _, _ in self.predicates}
+        for kind, placeholder in keys:
+            try:
+                value = getattr(context, kind)(placeholder)
+            except OPERATION_EXCEPTIONS:
+                continue
+            if value is None:
+                continue
+            for predicate_id in self.satisfied((kind, placeholder), value):
+                for operation_id in self.requiring[predicate_id]:
+                    hits[operation_id] += 1
+        passing = defaultdict(int)
+        for operation_id, count in hits.items():
+            quality_id, predicates = self.operations[operation_id]
+            if count == predicates:
+                passing[quality_id] += 1
+        # qualities that are always candidates may have indexed operations too, they are not listed twice
+        candidates.extend(quality_id for quality_id, count in passing.items()
+                          if quality_id in self.needed and count >= self.needed[quality_id])
+        return candidates
+
+    def matching(self, context: MaterialContext, quality_ids: Optional[Set[int]] = None) -> List[int]:
+        """The qualities the material passes, only the `quality_ids` ones are judged when given."""
+        matching = []
+        for quality_id in self.candidates(context):
+            if quality_ids is not None and quality_id not in quality_ids:
+                continue
+            rule, min_count = self.rules[quality_id]
+            try:
+                if rule.judge(context, min_count):
+                    matching.append(quality_id)
+            except OPERATION_EXCEPTIONS:
+                # a rule that cannot be evaluated is not passed
+                continue
+        return sorted(matching)
+
+
+class QualityIndexCache:
+    """
+    Builds the index on first use and keeps it until the qualities or the taxonomy change. The data version of the
+    qualities and the taxonomy version are read from the Django cache on every `get()`, like `TaxonomyCache` does,
+    so a change made by another process sharing the cache backend rebuilds the index here too.
+    """
+
+    def __init__(self):
+        self._index = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    @property
+    def version(self) -> tuple:
+        from materials.models import RecyclerQuality
+
+        key = data_versions.key(RecyclerQuality)
+        return data_versions.read([key])[key], taxonomy_cache.version
+
+    def get(self) -> QualityIndex:
+        version = self.version
+        index = self._index
+        if index is not None and self._version == version:
+            return index
+        with self._lock:
+            if self._index is None or self._version != version:
+                # the versions are read before building, a change made meanwhile triggers another build
+                self._index, self._version = self.build(), version
+            return self._index
+
+    @staticmethod
+    def build() -> QualityIndex:
+        from materials.models import RecyclerQuality
+
+        rules = {}
+        for quality in RecyclerQuality.objects.only('id', 'operations', 'compiled_operations', 'min_count'):
+            if not quality.operations or not isinstance(quality.operations, list):
+                continue
+            try:
+                rules[quality.pk] = (rule_cache.get(quality), quality.min_count)
+            except OPERATION_EXCEPTIONS:
+                continue
+        return QualityIndex(rules, taxonomy_cache.get())
+
+    def invalidate(self):
+        self._index = None
+
+
+quality_index = QualityIndexCache()
@@ -0,0 +1,184 @@
+import csv
+import json
+import time
+import uuid
+from decimal import Decimal, InvalidOperation
+from typing import Callable, Iterable, Iterator, List, Optional, TextIO
+
+from django.db import transaction, connection
+
+from materials.constants import ATTR_VALUE_TYPE
+from materials.context import taxonomy_cache
+from materials.exceptions import InvalidIngestRowException
+from materials.versions import data_versions
+
+INGEST_FORMATS = ('jsonl', 'csv')
+
+
+def read_rows(file: TextIO, format_: str) -> Iterator[dict]:
+    """
+    Streams `{'name': ..., 'attributes': {placeholder: value}}` rows out of a file. A JSONL line holds one such
+    object, a CSV file has a `name` column and one column per attribute placeholder.
+    Numbers are percentages, strings are the placeholder of the chosen option.
+    """
+    if format_ == 'jsonl':
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+    elif format_ == 'csv':
+        for row in csv.DictReader(file):
+            name = row.pop('name', None)
+            yield {'name': name, 'attributes': {key: value for key, value in row.items() if value not in ('', None)}}
+    else:
+        raise ValueError(f'Unknown format "{format_}", expected one of {", ".join(INGEST_FORMATS)}')
+
+
+class IngestStats:
+    def __init__(self):
+        self.materials = 0
+        self.attributes = 0
+        self.skipped = 0
+        self.started = time.perf_counter()
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.materials / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return f'{self.materials} materials, {self.attributes} attributes, {self.skipped} skipped ' \
+               f'in {self.elapsed:.2f}s ({self.throughput:.0f} materials/s)'
+
+
+class MaterialIngester:
+    """
+    Writes materials and their attributes in `bulk_create` batches, one transaction per batch. Placeholders are
+    resolved against the cached taxonomy.
+    """
+
+    def __init__(self, batch_size: int = 1000, skip_invalid: bool = False,
+                 progress: Optional[Callable[[IngestStats], None]] = None):
+        from materials.models import AttributeOption
+
+        self.batch_size = batch_size
+        self.skip_invalid = skip_invalid
+        self.progress = progress
+        taxonomy = taxonomy_cache.get()
+        self.attributes = {
+            attribute.placeholder: attribute.id for attribute in taxonomy.attributes_by_id.values()
+            if attribute.category_id is not None
+        }
+        self.options = taxonomy.options
+        # the attributes with options take one of them, the others a percentage. An option without a name makes no
+        # attribute a choice, it could not be referenced anyway
+        self.valid_options = {}
+        valid_for = AttributeOption.valid_for.through.objects.exclude(
+            attributeoption__placeholder__isnull=True
+        ).exclude(attributeoption__placeholder='')
+        for option_id, attribute_id in valid_for.values_list('attributeoption_id', 'attribute_id'):
+            self.valid_options.setdefault(attribute_id, set()).add(option_id)
+
+    def resolve(self, line: int, row: dict) -> tuple:
+        from materials.models import Material, MaterialAttribute
+
+        name = row.get('name')
+        if not name:
+            raise InvalidIngestRowException(line, 'missing name')
+        material_attributes = []
+        for placeholder, value in (row.get('attributes') or {}).items():
+            attribute_id = self.attributes.get(placeholder)
+            if attribute_id is None:
+                raise InvalidIngestRowException(line, f'unknown attribute "{placeholder}"')
+            option_id = self.options.get(value) if isinstance(value, str) else None
+            valid_options = self.valid_options.get(attribute_id)
+            if valid_options:
+                if option_id is None:
+                    raise InvalidIngestRowException(line, f'"{value}" is not an option, "{placeholder}" takes one')
+                elif option_id not in valid_options:
+                    raise InvalidIngestRowException(line, f'option "{value}" is not valid for "{placeholder}"')
+                material_attributes.append(MaterialAttribute(
+                    attribute_id=attribute_id, value_type=ATTR_VALUE_TYPE.CHOICE, choice_id=option_id
+                ))
+                continue
+            elif option_id is not None:
+                raise InvalidIngestRowException(line, f'option "{value}" is not valid for "{placeholder}", '
+                                                      f'it takes a percentage')
+            try:
+                percentage = Decimal(str(value)).quantize(Decimal('0.01'))
+            except InvalidOperation:
+                raise InvalidIngestRowException(line, f'"{value}" is neither a percentage nor an option of '
+                                                      f'"{placeholder}"')
+            if not percentage.is_finite():
+                raise InvalidIngestRowException(line, f'"{value}" of "{placeholder}" is not a number')
+            if not 0 <= percentage <= 100:
+                raise InvalidIngestRowException(line, f'percentage {value} of "{placeholder}" is out of range')
+            material_attributes.append(MaterialAttribute(
+                attribute_id=attribute_id, value_type=ATTR_VALUE_TYPE.PERCENTAGE, percentage=percentage
+            ))
+        return Material(name=name), material_attributes
+
+    def ingest(self, rows: Iterable[dict]) -> IngestStats:
+        stats = IngestStats()
+        batch = []
+        for line, row in enumerate(rows, start=1):
+            try:
+                batch.append(self.resolve(line, row))
+            except InvalidIngestRowException:
+                if not self.skip_invalid:
+                    raise
+                stats.skipped += 1
+                continue
+            if len(batch) >= self.batch_size:
+                self.write(batch, stats)
+                batch = []
+        if batch:
+            self.write(batch, stats)
+        return stats
+
+    def create_marked(self, materials: list):
+        """
+        Creates the materials on a backend that does not return the ids of bulk inserted rows. They are inserted
+        under names made of a token unique to the batch and their position, looked up by it, and then renamed, all
+        within the caller's transaction, so rows other processes insert meanwhile are never mistaken for them.
+        """
+        from materials.models import Material
+
+        token = uuid.uuid4().hex
+        names = [material.name for material in materials]
+        for i, material in enumerate(materials):
+            material.name = f'{token}:{i}'
+        Material.objects.bulk_create(materials)
+        ids = dict(Material.objects.filter(name__startswith=f'{token}:').values_list('name', 'id'))
+        for i, (material, name) in enumerate(zip(materials, names)):
+            material.pk, material.name = ids[f'{token}:{i}'], name
+        Material.objects.bulk_update(materials, ['name'], batch_size=self.batch_size)
+
+    def write(self, batch: List[tuple], stats: IngestStats):
+        from materials.models import Material, MaterialAttribute
+
+        with transaction.atomic():
+            materials = [material for material, _ in batch]
+            if connection.features.can_return_rows_from_bulk_insert:
+                Material.objects.bulk_create(materials)
+            else:
+                self.create_marked(materials)
+            material_attributes = []
+            for material, attributes in batch:
+                for material_attribute in attributes:
+                    material_attribute.material_id = material.pk
+                    material_attributes.append(material_attribute)
+            MaterialAttribute.objects.bulk_create(material_attributes, batch_size=self.batch_size)
+        # bulk_create does not send the signals that bump the data versions
+        data_versions.bump(Material, MaterialAttribute)
+        stats.materials += len(materials)
+        stats.attributes += len(material_attributes)
+        if self.progress:
+            self.progress(stats)
+
+
+def ingest_materials(rows: Iterable[dict], batch_size: int = 1000, skip_invalid: bool = False,
+                     progress: Optional[Callable[[IngestStats], None]] = None) -> IngestStats:
+    return MaterialIngester(batch_size=batch_size, skip_invalid=skip_invalid, progress=progress).ingest(rows)
@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import re
+import sys
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+
+from materials.exceptions import QueryBudgetExceededException
+
+logger = logging.getLogger('materials.queries')
+
+PROJECT_ROOT = str(Path(__file__).resolve().parent.parent)
+IGNORED_FILES = (__file__, f'{PROJECT_ROOT}/materials/tests/')
+
+SHAPE_PATTERNS = (
+    (re.compile(r"'(?:[^']|'')*'"), '?'),
+    (re.compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(...)'),
+    (re.compile(r'\s+'), ' '),
+)
+
+# the recorder of the request being served, under ASGI the sync code of concurrent requests shares a thread and
+# its connection, every recorder only keeps the queries run on behalf of its own request
+current_recorder = ContextVar('current_recorder', default=None)
+
+
+def query_shape(sql: str) -> str:
+    """The query with its literals blanked out, so the same query run for different rows has the same shape."""
+    for pattern, replacement in SHAPE_PATTERNS:
+        sql = pattern.sub(replacement, sql)
+    return sql.strip()
+
+
+def query_origin() -> str:
+    """
+    Where in the project the query was issued from: the innermost project frame and, when the query was
+    triggered while serializing, the serializer field being rendered.
+    """
+    location, field = None, None
+    frame = sys._getframe(1)
+    while frame is not None and (location is None or field is None):
+        filename = frame.f_code.co_filename
+        if location is None and filename.startswith(PROJECT_ROOT) and not filename.startswith(IGNORED_FILES):
+            location = f'{Path(filename).relative_to(PROJECT_ROOT)}:{frame.f_lineno} in {frame.f_code.co_name}'
+        if field is None and frame.f_code.co_name == 'to_representation':
+            serializer_field = frame.f_locals.get('field')
+            if getattr(serializer_field, 'field_name', None) and serializer_field.parent is not None:
+                field = f'{serializer_field.parent.__class__.__name__}.{serializer_field.field_name}'
+        frame = frame.f_back
+    return ' '.join(part for part in (field, f'({location})' if location else None) if part) or 'unknown'
+
+
+class QueryRecorder:
+    """An `execute_wrapper` that records the sql, duration and origin of every query it sees."""
+
+    def __init__(self):
+        self.queries: List[dict] = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if current_recorder.get() not in (None, self):
+            return execute(sql, params, many, context)
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'time': time.perf_counter() - start,
+                'origin': query_origin(),
+            })
+
+    def __len__(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self) -> float:
+        return sum(query['time'] for query in self.queries)
+
+    def repeated(self, threshold: Optional[int] = None) -> Dict[str, dict]:
+        """Query shapes run more than `threshold` times, the usual sign of an N+1 pattern."""
+        threshold = threshold or getattr(settings, 'QUERY_INSPECTOR_REPEAT_THRESHOLD', 3)
+        shapes = defaultdict(lambda: {'count': 0, 'origins': set()})
+        for query in self.queries:
+            shape = shapes[query_shape(query['sql'])]
+            shape['count'] += 1
+            shape['origins'].add(query['origin'])
+        return {sql: shape for sql, shape in shapes.items() if shape['count'] > threshold}
+
+    def report(self) -> str:
+        lines = [f'{len(self)} queries in {self.total_time * 1000:.1f}ms']
+        for sql, shape in self.repeated().items():
+            lines.append(f'{shape["count"]}x {sql}')
+            lines.extend(f'    from {origin}' for origin in sorted(shape['origins']))
+        return '\n'.join(lines)
+
+    def record(self) -> ExitStack:
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self))
+        return stack
+
+    def attach(self):
+        """
+        Records the queries of the connections of the calling thread until `detach()` is called from it. Unlike
+        `record()`, recorders of interleaved requests can be attached and detached in any order.
+        """
+        for connection in connections.all():
+            connection.execute_wrappers.append(self)
+
+    def detach(self):
+        for connection in connections.all():
+            if self in connection.execute_wrappers:
+                connection.execute_wrappers.remove(self)
+
+
+class QueryInspectorMiddleware:
+    """
+    Counts and times the queries of every request, logs repeated query shapes with where they come from, and
+    checks the count against the `query_budget` a view declares. Exceeding the budget is logged, or raised
+    when `QUERY_BUDGET_STRICT` is set (as it should be in tests).
+    Only the queries run before the response is returned are counted, not those of a streamed body, nor those a view
+    runs on other threads with their own connections.
+    It supports both sync and async requests, so under ASGI it does not force every request through the single
+    thread Django runs sync middleware on.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # what Django checks to call the middleware as a coroutine, as its own middleware mixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not getattr(settings, 'QUERY_INSPECTOR_ENABLED', False):
+            return self.get_response(request)
+        recorder = QueryRecorder()
+        with recorder.record():
+            response = self.get_response(request)
+        return self.inspect(request, response, recorder)
+
+    async def __acall__(self, request):
+        if not getattr(settings, 'QUERY_INSPECTOR_ENABLED', False):
+            return await self.get_response(request)
+        # the sync parts of the request run on the thread sensitive executor, the recorder is attached to its
+        # connections and only records the queries run in the context of this request
+        recorder = QueryRecorder()
+        token = current_recorder.set(recorder)
+        try:
+            await sync_to_async(recorder.attach)()
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(recorder.detach)()
+        finally:
+            current_recorder.reset(token)
+        return self.inspect(request, response, recorder)
+
+    def inspect(self, request, response, recorder: QueryRecorder):
+        response['X-Query-Count'] = str(len(recorder))
+        response['X-Query-Time-Ms'] = f'{recorder.total_time * 1000:.1f}'
+        for sql, shape in recorder.repeated().items():
+            logger.warning('%s: query run %s times from %s: %s', request.path, shape['count'],
+                           ', '.join(sorted(shape['origins'])), sql)
+        budget = self.query_budget(request)
+        if budget is not None and len(recorder) > budget:
+            if getattr(settings, 'QUERY_BUDGET_STRICT', False):
+                raise QueryBudgetExceededException(request.path, budget, recorder.report())
+            logger.error('%s: query budget of %s exceeded\n%s', request.path, budget, recorder.report())
+        return response
+
+    @staticmethod
+    def query_budget(request):
+        # read from the resolved view rather than in `process_view`, which Django would run on the sync thread
+        view_func = getattr(getattr(request, 'resolver_match', None), 'func', None)
+        view_class = getattr(view_func, 'view_class', None) or getattr(view_func, 'cls', None)
+        return getattr(view_class, 'query_budget', None)
@@ -0,0 +1,24 @@
+import os
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+
+from materials.snapshot import write_snapshot
+
+
+class Command(BaseCommand):
+    help = 'Writes the memory mapped snapshot of the materials, the taxonomy and the compiled qualities'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', help='Defaults to MATERIALS_SNAPSHOT_PATH')
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.MATERIALS_SNAPSHOT_PATH
+        start = time.perf_counter()
+        header = write_snapshot(path)
+        materials, attributes = header['arrays']['values']['shape']
+        self.stdout.write(self.style.SUCCESS(
+            f'Snapshot of {materials} materials, {attributes} attributes and {len(header["qualities"])} qualities '
+            f'written to {path} ({os.path.getsize(path) / 2 ** 20:.1f} MiB) in {time.perf_counter() - start:.2f}s'
+        ))
@@ -0,0 +1,205 @@
+import random
+import time
+
+from django.core.management import BaseCommand
+from django.db import transaction, connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from materials.constants import ATTR_VALUE_TYPE
+from materials.context import taxonomy_cache
+from materials.index import quality_index
+from materials.models import MaterialAttribute, AttributeOption, Attribute, Material, Recycler, RecyclerQuality, \
+    make_placeholder
+from materials.versions import data_versions
+
+PREFIX = 'Bench'
+COMPARISONS = ('>', '<', '>=', '<=', '==', '!=')
+
+
+class Command(BaseCommand):
+    help = 'Generates a synthetic dataset at one or more scales and reports how the rule evaluation and API perform'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scales', type=int, nargs='+', default=[1],
+                            help='Multipliers applied to the number of materials, recyclers and qualities')
+        parser.add_argument('--materials', type=int, default=100)
+        parser.add_argument('--categories', type=int, default=4, help='The first category holds percentages')
+        parser.add_argument('--attributes', type=int, default=8, help='Attributes per category')
+        parser.add_argument('--options', type=int, default=6, help='Options per choice attribute')
+        parser.add_argument('--recyclers', type=int, default=10)
+        parser.add_argument('--qualities', type=int, default=5, help='Qualities per recycler')
+        parser.add_argument('--depth', type=int, default=3, help='Maximum depth of the generated operations')
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--samples', type=int, default=100, help='Qualities to time judge() on')
+        parser.add_argument('--keep', action='store_true', help='Keep the data of the last scale')
+
+    def handle(self, *args, **options):
+        self.batch_size = options['batch_size']
+        rows = []
+        for scale in options['scales']:
+            self.random = random.Random(options['seed'])
+            self.flush()
+            start = time.perf_counter()
+            self.generate(
+                materials=options['materials'] * scale, categories=options['categories'],
+                attributes=options['attributes'], options=options['options'],
+                recyclers=options['recyclers'] * scale, qualities=options['qualities'], depth=options['depth']
+            )
+            generated = time.perf_counter() - start
+            rows.append((scale, generated, *self.benchmark(options['samples'])))
+        if not options['keep']:
+            self.flush()
+
+        self.stdout.write(
+            f'{"scale":>6} {"materials":>10} {"qualities":>10} {"generate s":>11} {"judge ms":>9} '
+            f'{"recyclers ms":>13} {"queries":>8} {"attributes ms":>14} {"queries":>8}'
+        )
+        for scale, generated, materials, qualities, judge, recyclers, recyclers_queries, attributes, \
+                attributes_queries in rows:
+            self.stdout.write(
+                f'{scale:>6} {materials:>10} {qualities:>10} {generated:>11.2f} {judge:>9.3f} '
+                f'{recyclers:>13.1f} {recyclers_queries:>8} {attributes:>14.1f} {attributes_queries:>8}'
+            )
+
+    def flush(self):
+        with transaction.atomic():
+            Recycler.objects.filter(name__startswith=PREFIX).delete()
+            Material.objects.filter(name__startswith=PREFIX).delete()
+            AttributeOption.objects.filter(name__startswith=PREFIX).delete()
+            Attribute.objects.filter(name__startswith=PREFIX, category__isnull=False).delete()
+            Attribute.objects.filter(name__startswith=PREFIX).delete()
+
+    @transaction.atomic
+    def generate(self, materials, categories, attributes, options, recyclers, qualities, depth):
+        # mptt fields are filled in by the rebuild below, bulk_create does not go through save()
+        tree_fields = dict(lft=0, rght=0, tree_id=0, level=0)
+        category_objs = self.bulk_create(Attribute, [
+            Attribute(name=f'{PREFIX} Category {c}', placeholder=make_placeholder(f'{PREFIX} Category {c}'),
+                      **tree_fields)
+            for c in range(categories)
+        ])
+        attribute_objs = self.bulk_create(Attribute, [
+            Attribute(name=f'{PREFIX} Attribute {c} {a}', placeholder=make_placeholder(f'{PREFIX} Attribute {c} {a}'),
+                      category=category, **tree_fields)
+            for c, category in enumerate(category_objs) for a in range(attributes)
+        ])
+        Attribute.objects.rebuild()
+        percentage_attributes = attribute_objs[:attributes]
+        choice_attributes = attribute_objs[attributes:]
+
+        option_objs = self.bulk_create(AttributeOption, [
+            AttributeOption(name=f'{PREFIX} Option {a} {o}', placeholder=make_placeholder(f'{PREFIX} Option {a} {o}'))
+            for a in range(len(choice_attributes)) for o in range(options)
+        ])
+        options_for = {
+            attribute.pk: option_objs[i * options:(i + 1) * options] for i, attribute in enumerate(choice_attributes)
+        }
+        AttributeOption.valid_for.through.objects.bulk_create([
+            AttributeOption.valid_for.through(attributeoption_id=option.pk, attribute_id=attribute_id)
+            for attribute_id, attribute_options in options_for.items() for option in attribute_options
+        ], batch_size=self.batch_size)
+
+        material_objs = self.bulk_create(Material, [
+            Material(name=f'{PREFIX} Material {m}') for m in range(materials)
+        ])
+        material_attributes = []
+        for material in material_objs:
+            material_attributes.extend(
+                MaterialAttribute(material=material, attribute=attribute, value_type=ATTR_VALUE_TYPE.PERCENTAGE,
+                                  percentage=percentage)
+                for attribute, percentage in zip(percentage_attributes, self.composition(len(percentage_attributes)))
+            )
+            material_attributes.extend(
+                MaterialAttribute(material=material, attribute=attribute, value_type=ATTR_VALUE_TYPE.CHOICE,
+                                  choice=self.random.choice(options_for[attribute.pk]))
+                for attribute in choice_attributes
+            )
+        MaterialAttribute.objects.bulk_create(material_attributes, batch_size=self.batch_size)
+
+        recycler_objs = self.bulk_create(Recycler, [
+            Recycler(name=f'{PREFIX} {r}') for r in range(recyclers)
+        ])
+        self.leaves = (
+            [lambda a=a: [f'ATTR_{a.placeholder}', round(self.random.random(), 2)] for a in percentage_attributes] +
+            [lambda a=a: [f'ATTR_{a.placeholder}', f'OPT_{self.random.choice(options_for[a.pk]).placeholder}']
+             for a in choice_attributes] +
+            [lambda c=c: [f'CUM_{c.placeholder}', round(self.random.random(), 2)] for c in category_objs[:1]]
+        )
+        # bulk_create does not send the signals that drop the cached taxonomy and index
+        taxonomy_cache.invalidate()
+        taxonomy = taxonomy_cache.get()
+        quality_objs = [
+            RecyclerQuality(
+                title=f'{PREFIX} Quality {q}', recycler=recycler, material=self.random.choice(material_objs),
+                min_count=self.random.choice((-1, 1, 2)),
+                operations=[self.operation(depth) for _ in range(self.random.randint(1, 3))]
+            )
+            for recycler in recycler_objs for q in range(qualities)
+        ]
+        for quality in quality_objs:
+            # nor does it call save(), which stores the compiled operations
+            quality.compiled_operations = quality.compile_operations(taxonomy)
+        RecyclerQuality.objects.bulk_create(quality_objs, batch_size=self.batch_size)
+        quality_index.invalidate()
+        transaction.on_commit(lambda: data_versions.bump(
+            Attribute, AttributeOption, Material, MaterialAttribute, Recycler, RecyclerQuality
+        ))
+
+    def bulk_create(self, model, objs: list) -> list:
+        """
+        `bulk_create` only sets primary keys on some backends (Postgres does, SQLite does not), the rows are read
+        back by their unique name when it did not.
+        """
+        objs = model.objects.bulk_create(objs, batch_size=self.batch_size)
+        if objs and objs[0].pk is None:
+            created = {}
+            names = [obj.name for obj in objs]
+            for i in range(0, len(names), self.batch_size):
+                created.update((obj.name, obj) for obj in model.objects.filter(name__in=names[i:i + self.batch_size]))
+            objs = [created[name] for name in names]
+        return objs
+
+    def composition(self, size: int) -> list:
+        """Random percentages with two decimals summing to 100."""
+        cuts = sorted(self.random.randint(0, 10000) for _ in range(size - 1))
+        bounds = [0, *cuts, 10000]
+        return [(bounds[i + 1] - bounds[i]) / 100 for i in range(size)]
+
+    def operation(self, depth: int) -> dict:
+        if depth <= 1 or self.random.random() < 0.4:
+            operands = self.random.choice(self.leaves)()
+            operator = '==' if str(operands[1]).startswith('OPT_') else self.random.choice(COMPARISONS)
+            return {'operator': operator, 'operands': operands}
+        return {
+            'operator': self.random.choice(('and', 'or')),
+            'operands': [self.operation(depth - 1) for _ in range(self.random.randint(2, 3))]
+        }
+
+    def benchmark(self, samples: int) -> tuple:
+        qualities = list(RecyclerQuality.objects.filter(title__startswith=PREFIX).select_related('material'))
+        sample = self.random.sample(qualities, min(samples, len(qualities)))
+        start = time.perf_counter()
+        for quality in sample:
+            quality.judge()
+        judge = (time.perf_counter() - start) / max(len(sample), 1) * 1000
+
+        client = Client()
+        recyclers, recyclers_queries = self.time_request(client, reverse('materials:recyclers'))
+        material = self.random.choice(qualities).material
+        attributes, attributes_queries = self.time_request(
+            client, reverse('materials:attributes', kwargs={'material_id': material.pk})
+        )
+        materials = Material.objects.filter(name__startswith=PREFIX).count()
+        return materials, len(qualities), judge, recyclers, recyclers_queries, attributes, attributes_queries
+
+    @staticmethod
+    def time_request(client: Client, url: str) -> tuple:
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = client.get(url)
+            elapsed = (time.perf_counter() - start) * 1000
+        assert response.status_code == 200, f'{url} returned {response.status_code}'
+        return elapsed, len(queries)
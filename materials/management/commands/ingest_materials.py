@@ -0,0 +1,31 @@
+import os
+
+from django.core.management import BaseCommand, CommandError
+
+from materials.exceptions import InvalidIngestRowException
+from materials.ingest import INGEST_FORMATS, ingest_materials, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Ingests materials with their attribute percentages and options from a JSONL or CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=INGEST_FORMATS, help='Defaults to the extension of the file')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--skip-invalid', action='store_true', help='Skip invalid rows instead of stopping')
+
+    def handle(self, *args, **options):
+        format_ = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if format_ not in INGEST_FORMATS:
+            raise CommandError(f'Cannot tell the format of {options["path"]}, pass --format')
+
+        with open(options['path'], newline='') as file:
+            try:
+                stats = ingest_materials(
+                    read_rows(file, format_), batch_size=options['batch_size'],
+                    skip_invalid=options['skip_invalid'], progress=lambda s: self.stdout.write(str(s))
+                )
+            except InvalidIngestRowException as e:
+                raise CommandError(e.message)
+        self.stdout.write(self.style.SUCCESS(f'Ingested {stats}'))
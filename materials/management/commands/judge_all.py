@@ -0,0 +1,104 @@
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+import django
+from django.apps import apps
+from django.utils import timezone
+from django.core.management import BaseCommand
+from django.db import connections
+
+from materials.models import Material, RecyclerQuality
+from materials.results import judge_all_pairs
+from materials.snapshot import snapshot_cache
+
+# the qualities a worker judges, and the snapshot it judges them on if any, loaded once when the worker starts
+_qualities = None
+_snapshot = None
+
+
+def load_qualities() -> list:
+    return list(RecyclerQuality.objects.only('id', 'operations', 'compiled_operations', 'min_count'))
+
+
+def init_worker(snapshot_path: str = None):
+    global _qualities, _snapshot
+    if not apps.ready:
+        # workers that are spawned rather than forked start without the project set up
+        django.setup()
+    if snapshot_path:
+        _snapshot = snapshot_cache.get(snapshot_path)
+        _qualities = _snapshot.qualities()
+    else:
+        _qualities = load_qualities()
+
+
+def judge(chunk: tuple) -> tuple:
+    """Judges a chunk of material ids, or the rows `start` to `stop` of the snapshot."""
+    if _snapshot is None:
+        material_ids, batch_size = chunk
+        return judge_all_pairs(material_ids, _qualities, batch_size=batch_size)
+    (start, stop), batch_size = chunk
+    matrix = _snapshot.matrix(start, stop)
+    # what changed since the snapshot was written was judged again on fresher data, it is not overwritten
+    return judge_all_pairs(matrix.material_ids.tolist(), _qualities, taxonomy=_snapshot.taxonomy,
+                           batch_size=batch_size, matrix=matrix,
+                           loaded_at=datetime.fromtimestamp(_snapshot.created, tz=timezone.utc))
+
+
+def judge_chunk(chunk: tuple) -> tuple:
+    try:
+        return judge(chunk)
+    finally:
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = 'Judges every recycler quality against every material on a pool of processes and stores the results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=os.cpu_count(),
+                            help='Worker processes, 1 judges in this process')
+        parser.add_argument('--chunk-size', type=int, default=500, help='Materials judged by a worker at a time')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Results written per query')
+        parser.add_argument('--snapshot', metavar='PATH',
+                            help='Judge the materials and qualities of a snapshot written by build_snapshot, '
+                                 'memory mapped by every worker, instead of loading them from the database. '
+                                 'Those deleted since the snapshot was written are skipped, as are those whose results '
+                                 'were evaluated again since')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        chunk_size, snapshot_path = options['chunk_size'], options['snapshot']
+        if snapshot_path:
+            count = len(snapshot_cache.get(snapshot_path))
+            chunks = [((i, i + chunk_size), options['batch_size']) for i in range(0, count, chunk_size)]
+        else:
+            material_ids = list(Material.objects.order_by('id').values_list('id', flat=True))
+            count = len(material_ids)
+            chunks = [(material_ids[i:i + chunk_size], options['batch_size']) for i in range(0, count, chunk_size)]
+
+        if options['processes'] <= 1:
+            init_worker(snapshot_path)
+            judged, passed = self.collect(map(judge, chunks), options)
+        else:
+            # every worker opens its own connections, they must not share the ones inherited from this process
+            connections.close_all()
+            with multiprocessing.Pool(options['processes'], initializer=init_worker,
+                                      initargs=(snapshot_path,)) as pool:
+                judged, passed = self.collect(pool.imap_unordered(judge_chunk, chunks), options)
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'{judged} pairs judged over {count} materials, {passed} passed, in {elapsed:.2f}s '
+            f'({judged / elapsed if elapsed else 0:.0f} pairs/s)'
+        )
+
+    def collect(self, results, options) -> tuple:
+        judged, passed = 0, 0
+        for chunk_judged, chunk_passed in results:
+            judged, passed = judged + chunk_judged, passed + chunk_passed
+            if options['verbosity'] > 1:
+                self.stdout.write(f'{judged} pairs judged')
+        return judged, passed
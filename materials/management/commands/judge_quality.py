@@ -0,0 +1,52 @@
+import time
+
+from django.core.management import BaseCommand, CommandError
+
+from materials.batch import MaterialMatrix, matching_material_ids
+from materials.models import Material, RecyclerQuality
+
+
+class Command(BaseCommand):
+    help = 'Judges a recycler quality against every material (or the given ones) at once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('quality_id', type=int)
+        parser.add_argument('--materials', type=int, nargs='*', help='Material ids to judge, defaults to all')
+        parser.add_argument('--ids', action='store_true', help='Print the ids of the materials that passed')
+        parser.add_argument('--sql', action='store_true',
+                            help='Let the database filter the materials, unless the rule cannot be translated')
+
+    def handle(self, *args, **options):
+        try:
+            quality = RecyclerQuality.objects.get(pk=options['quality_id'])
+        except RecyclerQuality.DoesNotExist:
+            raise CommandError(f'Recycler quality {options["quality_id"]} does not exist')
+
+        if options['sql']:
+            return self.filter(quality, options)
+
+        start = time.perf_counter()
+        matrix = MaterialMatrix.build(options['materials'])
+        built = time.perf_counter()
+        passed = quality.judge_materials(matrix)
+        judged = time.perf_counter()
+
+        self.stdout.write(
+            f'{int(passed.sum())}/{len(matrix)} materials passed "{quality}" '
+            f'(matrix built in {built - start:.3f}s, judged in {judged - built:.3f}s)'
+        )
+        if options['ids']:
+            self.stdout.write(' '.join(str(material_id) for material_id in matching_material_ids(passed, matrix)))
+
+    def filter(self, quality: RecyclerQuality, options: dict):
+        materials = Material.objects.all()
+        if options['materials'] is not None:
+            materials = materials.filter(id__in=options['materials'])
+        start = time.perf_counter()
+        material_ids = quality.matching_materials(materials)
+        self.stdout.write(
+            f'{len(material_ids)}/{materials.count()} materials passed "{quality}" '
+            f'(filtered in {time.perf_counter() - start:.3f}s)'
+        )
+        if options['ids']:
+            self.stdout.write(' '.join(str(material_id) for material_id in material_ids))
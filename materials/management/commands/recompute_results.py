@@ -0,0 +1,22 @@
+import time
+
+from django.core.management import BaseCommand
+
+from materials.models import QualityResult
+from materials.results import recompute_results
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the stored results of recycler qualities'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--qualities', type=int, nargs='*', help='Quality ids to recompute')
+        parser.add_argument('--materials', type=int, nargs='*', help='Material ids to recompute')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        stats = recompute_results(quality_ids=options['qualities'], material_ids=options['materials'])
+        self.stdout.write(
+            f'{QualityResult.objects.count()} stored results, recomputed in {time.perf_counter() - start:.3f}s '
+            f'(subexpressions: {stats})'
+        )
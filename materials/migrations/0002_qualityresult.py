@@ -0,0 +1,29 @@
+# Generated by Django 3.1.3 on 2026-10-18 15:58
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QualityResult',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('passed', models.BooleanField()),
+                ('evaluated_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('rule_hash', models.CharField(max_length=40)),
+                ('material', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='materials.material')),
+                ('quality', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='results', to='materials.recyclerquality')),
+            ],
+            options={
+                'unique_together': {('quality', 'material')},
+            },
+        ),
+    ]
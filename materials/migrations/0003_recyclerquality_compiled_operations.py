@@ -0,0 +1,18 @@
+# Generated by Django 3.1.3 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0002_qualityresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recyclerquality',
+            name='compiled_operations',
+            field=models.JSONField(blank=True, editable=False, help_text='The operations validated against the taxonomy, with placeholders resolved to ids and constants folded. Kept up to date on save', null=True),
+        ),
+    ]
@@ -0,0 +1,121 @@
+import operator as py_operator
+from decimal import Decimal
+
+from django.db import migrations
+
+# a frozen copy of `materials.rules.compile_operations` as it was when this migration was written, the live code may
+# change or go away without changing what this migration stores
+
+PLACEHOLDER_KINDS = (('ATTR_', 'attribute'), ('OPT_', 'option'), ('CUM_', 'cumulative'))
+OPERATOR_SIGNS = {
+    '+': '+', 'add': '+', '*': '*', 'mul': '*', 'and': 'and', 'or': 'or', '>': '>', 'gt': '>', '<': '<', 'lt': '<',
+    '>=': '>=', 'gte': '>=', '<=': '<=', 'lte': '<=', '==': '==', 'eq': '==', '!=': '!=', 'neq': '!=',
+}
+BOOLEAN_SIGNS = {'and', 'or', '>', '<', '>=', '<=', '==', '!='}
+COMPARISON_FUNCTIONS = {
+    '>': py_operator.gt, '<': py_operator.lt, '>=': py_operator.ge, '<=': py_operator.le, '==': py_operator.eq,
+    '!=': py_operator.ne,
+}
+
+
+class InvalidOperation(Exception):
+    pass
+
+
+def load_taxonomy(apps) -> dict:
+    """Placeholder -> id of the attributes, categories and options operands may reference."""
+    Attribute = apps.get_model('materials', 'Attribute')
+    AttributeOption = apps.get_model('materials', 'AttributeOption')
+
+    attributes_by_id = Attribute.objects.order_by().in_bulk()
+    taxonomy = {'attribute': {}, 'cumulative': {}, 'option': {}}
+    for attribute in attributes_by_id.values():
+        if attribute.category_id is None:
+            continue
+        taxonomy['attribute'][attribute.placeholder] = attribute.id
+        category = attributes_by_id.get(attribute.category_id)
+        while category is not None:
+            taxonomy['cumulative'][category.placeholder] = category.id
+            category = attributes_by_id.get(category.category_id)
+    taxonomy['option'] = dict(AttributeOption.objects.values_list('placeholder', 'id'))
+    return taxonomy
+
+
+def is_constant(node, numeric=True) -> bool:
+    if isinstance(node, dict):
+        return False
+    return not numeric or isinstance(node, (int, float))
+
+
+def fold_constants(sign: str, values: list):
+    decimals = [Decimal(int(value)) if isinstance(value, int) else Decimal(str(value)) for value in values]
+    if sign in COMPARISON_FUNCTIONS:
+        compare = COMPARISON_FUNCTIONS[sign]
+        return all(compare(left, right) for left, right in zip(decimals, decimals[1:]))
+    arithmetic = py_operator.add if sign == '+' else py_operator.mul
+    result = decimals[0]
+    for value in decimals[1:]:
+        result = arithmetic(result, value)
+    return int(result) if result == result.to_integral_value() else float(result)
+
+
+def compile_operand(operand, taxonomy: dict):
+    if not isinstance(operand, str) or operand.isnumeric():
+        return operand
+    for prefix, kind in PLACEHOLDER_KINDS:
+        if operand.startswith(prefix):
+            name = operand.replace(prefix, '', 1)
+            if name not in taxonomy[kind]:
+                raise InvalidOperation(operand)
+            return {'ref': kind, 'name': name, 'id': taxonomy[kind][name]}
+    raise InvalidOperation(operand)
+
+
+def compile_operation(expression, taxonomy: dict, is_root: bool = True):
+    """The operation with its operator as a sign, its placeholders resolved and its constants folded."""
+    if not isinstance(expression, dict) or not expression.get('operator'):
+        raise InvalidOperation(expression)
+    sign = OPERATOR_SIGNS.get(expression['operator'])
+    if sign is None or (is_root and sign not in BOOLEAN_SIGNS) or not expression.get('operands'):
+        raise InvalidOperation(expression)
+    operands = [
+        compile_operation(operand, taxonomy, is_root=False) if isinstance(operand, dict)
+        else compile_operand(operand, taxonomy)
+        for operand in expression['operands']
+    ]
+    if sign in ('and', 'or'):
+        deciding = sign == 'or'
+        if any(bool(operand) is deciding for operand in operands if is_constant(operand, numeric=False)):
+            return deciding
+        operands = [operand for operand in operands if not is_constant(operand, numeric=False)]
+        return {'op': sign, 'args': operands} if operands else not deciding
+    if all(is_constant(operand) for operand in operands):
+        return fold_constants(sign, operands)
+    return {'op': sign, 'args': operands}
+
+
+def compile_existing_operations(apps, schema_editor):
+    RecyclerQuality = apps.get_model('materials', 'RecyclerQuality')
+    taxonomy = load_taxonomy(apps)
+    qualities = []
+    for quality in RecyclerQuality.objects.filter(compiled_operations__isnull=True).only('id', 'operations'):
+        # rows that never passed validation are left uncompiled, the index skips them the same way
+        if not quality.operations or not isinstance(quality.operations, list):
+            continue
+        try:
+            quality.compiled_operations = [compile_operation(operation, taxonomy) for operation in quality.operations]
+        except InvalidOperation:
+            continue
+        qualities.append(quality)
+    RecyclerQuality.objects.bulk_update(qualities, ['compiled_operations'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('materials', '0003_recyclerquality_compiled_operations'),
+    ]
+
+    operations = [
+        migrations.RunPython(compile_existing_operations, migrations.RunPython.noop),
+    ]
@@ -1,14 +1,19 @@
-from decimal import Decimal
-from typing import Union, Tuple, Any, List
+from typing import Union, Any, List
 
+import numpy as np
+from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models import JSONField, Sum
+from django.db.models import JSONField
+from django.utils import timezone
 from mptt.fields import TreeForeignKey
 from mptt.models import MPTTModel
 
-from materials.constants import ATTR_VALUE_TYPES, ATTR_VALUE_TYPE, BOOLEAN_OPERATOR_CHOICES
-from materials.exceptions import MissingOperatorException, MissingOperandsException, InvalidOperandException, \
-    InvalidRootOperatorException, NoOperationToPerformException, UnTrustedOperationException
+from materials.batch import MaterialMatrix, UnsupportedBatchOperation, evaluate_rule, matching_material_ids
+from materials.constants import ATTR_VALUE_TYPES
+from materials.context import MaterialContext, Taxonomy, taxonomy_cache
+from materials.exceptions import NoOperationToPerformException, OPERATION_EXCEPTIONS
+from materials.pushdown import UnsupportedPushdown, filter_materials
+from materials.rules import rule_cache, operations_hash, compile_operations
 
 
 def make_placeholder(name: str) -> str:
@@ -68,10 +73,6 @@ class MaterialAttribute(models.Model):
     choice = models.ForeignKey(AttributeOption, null=True, blank=True, on_delete=models.CASCADE)
     percentage = models.DecimalField(max_digits=6, decimal_places=2, null=True, blank=True)
 
-    @property
-    def value(self):
-        return self.choice.name if self.value_type == ATTR_VALUE_TYPE.CHOICE else Decimal(self.percentage / 100)
-
     def __str__(self):
         return f'{str(self.material)} - {str(self.attribute)}'
 
@@ -95,127 +96,111 @@ class RecyclerQuality(models.Model):
         help_text='Minimum number of operations to be satisfied, -1 means all available conditions must be satisfied'
     )
     operations = JSONField(default=list)
+    compiled_operations = JSONField(
+        null=True, blank=True, editable=False,
+        help_text='The operations validated against the taxonomy, with placeholders resolved to ids and constants '
+                  'folded. Kept up to date on save'
+    )
 
     def __str__(self):
         return self.title
 
+    def clean(self):
+        try:
+            self.compile_operations()
+        except OPERATION_EXCEPTIONS as e:
+            raise ValidationError({'operations': e.message})
+
+    def save(self, **kwargs):
+        self.compiled_operations = self.compile_operations()
+        if kwargs.get('update_fields') is not None and 'operations' in kwargs['update_fields']:
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'compiled_operations'}
+        super().save(**kwargs)
+
     class Meta:
         unique_together = ('title', 'recycler',)
 
-    def translate_operand(self, operand: Union[str, int, float]) -> Any:
-        if isinstance(operand, str) and not operand.isnumeric():
-            qs = None
-            operand_type = None
-            if operand.startswith('ATTR_'):
-                operand = operand.replace('ATTR_', '', 1)
-                operand_type = 'A'
-                qs = MaterialAttribute.objects.filter(material=self.material, attribute__placeholder=operand)
-            elif operand.startswith('OPT_'):
-                operand = operand.replace('OPT_', '', 1)
-                operand_type = 'O'
-                qs = MaterialAttribute.objects.filter(
-                    material=self.material, choice__placeholder=operand
-                )
-            elif operand.startswith('CUM_'):
-                operand = operand.replace('CUM_', '', 1)
-                operand_type = 'C'
-                qs = MaterialAttribute.objects.filter(
-                    value_type=ATTR_VALUE_TYPE.PERCENTAGE, material=self.material,
-                    attribute__category__placeholder=operand
-                )
-            # do checks for exception
-            if operand_type == 'A':
-                if not Attribute.objects.filter(placeholder=operand, category__isnull=False).exists():
-                    raise InvalidOperandException(operand, 'ATTR')
-            elif operand_type == 'C':
-                if not Attribute.objects.filter(category__placeholder=operand).exists():
-                    raise InvalidOperandException(operand, 'CUM')
-            elif operand_type == 'O':
-                if not AttributeOption.objects.filter(placeholder=operand).exists():
-                    raise InvalidOperandException(operand, 'OPT')
-            else:
-                raise InvalidOperandException(operand, 'Unknown')
-            if operand_type == 'C':
-                # No category means it a cumulative operation
-                sum_ = qs.aggregate(sum=Sum('percentage')).get('sum', 0)
-                return sum_ / 100 if sum_ else sum_
-            right_attribute: MaterialAttribute = qs.first()
-            return right_attribute.value
-        else:
-            return operand
-
-    def expression_to_python(self, expression: dict, is_root: bool = True) -> Tuple[str, str]:
-        """
-        Expressions need to be in the format:
-        [
-            {
-                operator: '+',
-                operands: [
-                    {
-                        operator: '*',
-                        operands: [9, 10]
-                    },
-                    10,
-                    'OTHER_CELLULOSICS'
-                ]
-            }
-        ]
-        """
-        boolean_operators = [op[1] for op in BOOLEAN_OPERATOR_CHOICES]
-        operator = expression.get('operator')
-        if not operator:
-            raise MissingOperatorException(expression)
-        elif is_root and operator not in boolean_operators:
-            raise InvalidRootOperatorException(operator)
-        operands = expression.get('operands', [])
-        if not operands:
-            raise MissingOperandsException(expression)
-        code = "("
-        readable_code = "("
-        for operand in operands:
-            if isinstance(operand, dict):
-                operand_code, operand_readable_code = self.expression_to_python(expression=operand, is_root=False)
-                readable_code += operand_readable_code
-            else:
-                readable_code += str(operand)
-                operand_code = self.translate_operand(operand)
-            code += f'"{operand_code}"' if isinstance(operand_code, str) else f'{str(operand_code)}'
-            code += f' {operator} '
-            readable_code += f' {operator} '
-        code = code.rstrip(f' {operator} ')
-        readable_code = readable_code.rstrip(f' {operator} ')
-        code += ")"
-        readable_code += ")"
-        if operator in boolean_operators:
-            code = f'bool({code})'
-        return code, readable_code
-
-    def evaluate_conditions(self, readable: bool = False) -> List[Any]:
-        res = []
-        safe_names = {'bool': bool}
-        for operation in self.operations:
-            code, readable_exp = self.expression_to_python(operation)
-            if not readable:
-                code = compile(code, '<string>', 'eval')
-                for name in code.co_names:
-                    if name not in safe_names:
-                        raise UnTrustedOperationException(code.co_names)
-                code = eval(code, {"__builtins__": {}}, safe_names)
-                res.append(code)
-            else:
-                res.append(readable_exp)
-        return res
-
-    def judge(self) -> bool:
+    @property
+    def rule_hash(self) -> str:
+        return operations_hash({'operations': self.operations, 'min_count': self.min_count})
+
+    def compile_operations(self, taxonomy: Taxonomy = None) -> List[Any]:
+        if not self.operations or not isinstance(self.operations, list):
+            raise NoOperationToPerformException(self.operations)
+        return compile_operations(self.operations, taxonomy or taxonomy_cache.get())
+
+    def get_context(self) -> MaterialContext:
+        return MaterialContext(self.material)
+
+    def translate_operand(self, operand: Union[str, int, float], context: MaterialContext = None) -> Any:
+        return (context or self.get_context()).resolve(operand)
+
+    def evaluate_conditions(self, readable: bool = False, context: MaterialContext = None) -> List[Any]:
+        rule = rule_cache.get(self)
+        if readable:
+            return list(rule.readable)
+        return rule.evaluate(context or self.get_context())
+
+    def judge(self, context: MaterialContext = None) -> bool:
         """
         - If the attribute passed in is a parent attribute (category), then we should do an cummulation
         - If the operand is on the left, we would check the attribute
         - If the operand is on the right side, we would check in order (attribute_options, free_input)
-        - Substitute all the placeholders and use python evaluate
+        - Substitute all the placeholders from the material's context and evaluate the compiled operations
+        """
+        if not self.operations or not isinstance(self.operations, list):
+            raise NoOperationToPerformException(self.operations)
+        return rule_cache.get(self).judge(context or self.get_context(), self.min_count)
+
+    def judge_materials(self, matrix: MaterialMatrix = None) -> np.ndarray:
+        """
+        Judges the operations against many materials at once, returning a boolean vector aligned with
+        `matrix.material_ids` (all materials when no matrix is given).
         """
         if not self.operations or not isinstance(self.operations, list):
             raise NoOperationToPerformException(self.operations)
-        res = self.evaluate_conditions()
-        if self.min_count == -1:
-            return all(res)
-        return res.count(True) >= self.min_count
+        matrix = matrix or MaterialMatrix.build()
+        try:
+            return evaluate_rule(rule_cache.get(self), self.min_count, matrix)
+        except UnsupportedBatchOperation:
+            materials = Material.objects.filter(id__in=matrix.material_ids.tolist()).prefetch_related(
+                'materialattribute_set'
+            ).in_bulk()
+            # a matrix read from a snapshot may hold materials deleted since, they do not pass
+            return np.array([
+                material_id in materials and
+                self.judge(context=MaterialContext(materials[material_id], taxonomy=matrix.taxonomy))
+                for material_id in matrix.material_ids.tolist()
+            ], dtype=bool)
+
+    def matching_materials(self, materials: models.QuerySet = None) -> List[int]:
+        """
+        The ids of the materials (all of them unless a queryset is given) that pass the operations, filtered by the
+        database. Rules it cannot evaluate like python does are judged in batch instead.
+        """
+        if not self.operations or not isinstance(self.operations, list):
+            raise NoOperationToPerformException(self.operations)
+        try:
+            queryset = filter_materials(rule_cache.get(self), self.min_count, materials)
+            return list(queryset.order_by('id').values_list('id', flat=True))
+        except UnsupportedPushdown:
+            matrix = MaterialMatrix.build(materials)
+            return matching_material_ids(self.judge_materials(matrix), matrix)
+
+
+class QualityResult(models.Model):
+    """
+    The stored outcome of judging a quality against a material, recomputed whenever anything the rule depends
+    on changes so that reads do not need to evaluate it.
+    """
+    quality = models.ForeignKey(RecyclerQuality, on_delete=models.CASCADE, related_name='results')
+    material = models.ForeignKey(Material, on_delete=models.CASCADE)
+    passed = models.BooleanField()
+    evaluated_at = models.DateTimeField(default=timezone.now)
+    rule_hash = models.CharField(max_length=40)
+
+    def __str__(self):
+        return f'{str(self.quality)} - {str(self.material)}'
+
+    class Meta:
+        unique_together = ('quality', 'material',)
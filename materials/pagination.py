@@ -0,0 +1,30 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class RecyclerCursorPagination(CursorPagination):
+    """
+    Keyset pagination on the recycler id. Pages are only used when a page size is configured with
+    `RECYCLERS_PAGE_SIZE` or requested with `?page_size=`, otherwise the whole list is returned as before.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 500
+
+    def get_page_size(self, request):
+        self.page_size = getattr(settings, 'RECYCLERS_PAGE_SIZE', None)
+        return super().get_page_size(request)
+
+
+class MaterialCursorPagination(CursorPagination):
+    """
+    Keyset pagination on the material id, every page is a range scan of the primary key however deep it is.
+    Always paginated, `MATERIALS_PAGE_SIZE` materials per page unless `?page_size=` asks for another size.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def get_page_size(self, request):
+        self.page_size = getattr(settings, 'MATERIALS_PAGE_SIZE', 100)
+        return super().get_page_size(request)
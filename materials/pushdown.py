@@ -0,0 +1,200 @@
+import operator as py_operator
+from functools import reduce
+from typing import List, Union
+
+from django.db.models import Case, F, FloatField, IntegerField, OuterRef, Q, QuerySet, Subquery, Sum, Value, When, \
+    ExpressionWrapper
+from django.db.models.functions import Cast, Round
+
+from materials.constants import ATTR_VALUE_TYPE, OPERATORS
+from materials.context import Taxonomy, taxonomy_cache
+from materials.rules import CompiledRule, Operation, Operand, BASIS_POINTS, COMPARISON_FUNCTIONS, ORDERING_SIGNS, \
+    is_constant, fold_constants, to_basis_points
+
+# the lookup of each ordering, and the one it becomes when its operands are swapped
+ORDERING_LOOKUPS = {
+    OPERATORS['GT']['sign']: ('gt', 'lt'),
+    OPERATORS['LT']['sign']: ('lt', 'gt'),
+    OPERATORS['GTE']['sign']: ('gte', 'lte'),
+    OPERATORS['LTE']['sign']: ('lte', 'gte'),
+}
+
+
+class UnsupportedPushdown(Exception):
+    """Raised when an operation cannot be translated to SQL, callers fall back to evaluating it in python."""
+
+
+def percentage_points():
+    # 70.00% is 7000 basis points, rounded as the column may hold the percentage as a binary float (SQLite)
+    return Cast(Round(F('percentage') * 100), IntegerField())
+
+
+class QueryCompiler:
+    """
+    Translates a compiled rule into expressions over `Material`: an attribute is the value of the material's first
+    row for it, a category total the sum of the percentages below it, both subqueries that are NULL where the
+    python evaluation has `None`. Every value compared is annotated once under an alias, shared by the operations
+    of the rule that contain it. Boolean operations become `Q` objects on these aliases, or plain booleans once
+    they are decided by constants.
+    """
+
+    def __init__(self, taxonomy: Taxonomy):
+        self.taxonomy = taxonomy
+        # alias -> expression, and operation key -> alias
+        self.annotations = {}
+        self.aliases = {}
+
+    def filter(self, queryset: QuerySet, operations: List[Union[Operation, Operand]], min_count: int) -> QuerySet:
+        conditions = [self.condition(operation) for operation in operations]
+        required = len(conditions) if min_count == -1 else min_count
+        # constant operations count towards `min_count` without reaching the database
+        required -= sum(condition is True for condition in conditions)
+        conditions = [condition for condition in conditions if isinstance(condition, Q)]
+        if required <= 0:
+            return queryset
+        elif required > len(conditions):
+            return queryset.none()
+        for alias, expression in self.annotations.items():
+            queryset = queryset.annotate(**{alias: expression})
+        passed = reduce(py_operator.add, [
+            Case(When(condition, then=Value(1)), default=Value(0), output_field=IntegerField())
+            for condition in conditions
+        ])
+        return queryset.annotate(passed_operations=passed).filter(passed_operations__gte=required)
+
+    def condition(self, node: Union[Operation, Operand]) -> Union[Q, bool]:
+        """The truth of `node`, as python's `bool()` of its value."""
+        if isinstance(node, Operand):
+            if node.kind == 'literal':
+                if isinstance(node.value, str):
+                    raise UnsupportedPushdown(node.value)
+                return bool(node.value)
+            return self.truth(self.alias(node))
+
+        if node.operator in (OPERATORS['AND']['sign'], OPERATORS['OR']['sign']):
+            deciding = node.operator == OPERATORS['OR']['sign']
+            combine = py_operator.or_ if deciding else py_operator.and_
+            conditions = []
+            for operand in node.operands:
+                condition = self.condition(operand)
+                if condition is deciding:
+                    return deciding
+                elif isinstance(condition, Q):
+                    conditions.append(condition)
+            return reduce(combine, conditions) if conditions else not deciding
+        elif node.operator in COMPARISON_FUNCTIONS:
+            conditions = [
+                self.compare(node.operator, left, right) for left, right in zip(node.operands, node.operands[1:])
+            ]
+            if any(condition is False for condition in conditions):
+                return False
+            conditions = [condition for condition in conditions if isinstance(condition, Q)]
+            return reduce(py_operator.and_, conditions) if conditions else True
+        return self.truth(self.alias(node))
+
+    def compare(self, operator: str, left: Union[Operation, Operand],
+                right: Union[Operation, Operand]) -> Union[Q, bool]:
+        if is_constant(left) and is_constant(right):
+            return fold_constants(operator, [left.value, right.value])
+        elif is_constant(left):
+            # the literal goes on the right of the lookup
+            if operator in ORDERING_LOOKUPS:
+                return self.lookup(ORDERING_LOOKUPS[operator][1], self.alias(right), self.literal(left))
+            return self.compare(operator, right, left)
+
+        alias = self.alias(left)
+        other = self.literal(right) if is_constant(right) else F(self.alias(right))
+        if operator in ORDERING_SIGNS:
+            # NULL never satisfies an ordering, like a missing value does not in python
+            return self.lookup(ORDERING_LOOKUPS[operator][0], alias, other)
+        # in python two missing values are equal and a missing value differs from any number, so NULLs are explicit
+        if isinstance(other, F):
+            both_missing = Q(**{f'{alias}__isnull': True, f'{other.name}__isnull': True})
+            one_missing = Q(**{f'{alias}__isnull': True, f'{other.name}__isnull': False}) | \
+                Q(**{f'{alias}__isnull': False, f'{other.name}__isnull': True})
+        else:
+            both_missing, one_missing = None, Q(**{f'{alias}__isnull': True})
+        if operator == OPERATORS['EQ']['sign']:
+            equal = self.lookup('exact', alias, other)
+            return equal | both_missing if both_missing is not None else equal
+        return self.lookup('lt', alias, other) | self.lookup('gt', alias, other) | one_missing
+
+    @staticmethod
+    def lookup(lookup: str, alias: str, value) -> Q:
+        return Q(**{f'{alias}__{lookup}': value})
+
+    @staticmethod
+    def truth(alias: str) -> Q:
+        # python treats a missing value and 0 as false
+        return Q(**{f'{alias}__isnull': False}) & ~Q(**{alias: 0})
+
+    @staticmethod
+    def literal(node: Operand) -> Union[int, float]:
+        return to_basis_points(node.value)
+
+    def alias(self, node: Union[Operation, Operand]) -> str:
+        """Annotates the value of `node` once and returns the name it is annotated under."""
+        alias = self.aliases.get(node.key)
+        if alias is None:
+            alias = f'rule_value_{len(self.aliases)}'
+            self.annotations[alias] = ExpressionWrapper(self.value(node), output_field=FloatField())
+            self.aliases[node.key] = alias
+        return alias
+
+    def value(self, node: Union[Operation, Operand]):
+        from materials.models import MaterialAttribute
+
+        if isinstance(node, Operation):
+            if node.operator not in (OPERATORS['ADD']['sign'], OPERATORS['MUL']['sign']):
+                # booleans used as numbers
+                raise UnsupportedPushdown(node.key)
+            values = [self.value(operand) for operand in node.operands]
+            if node.operator == OPERATORS['ADD']['sign']:
+                return reduce(py_operator.add, values)
+            return reduce(lambda left, right: left * right / Value(float(BASIS_POINTS)), values)
+        elif node.kind == 'literal':
+            if isinstance(node.value, str):
+                raise UnsupportedPushdown(node.value)
+            return Value(self.literal(node), output_field=FloatField())
+        elif node.kind == 'option':
+            return Value(self.id(node), output_field=FloatField())
+
+        rows = MaterialAttribute.objects.filter(material=OuterRef('pk'))
+        if node.kind == 'attribute':
+            # the first row wins, like it does in the material context
+            rows = rows.filter(attribute_id=self.id(node)).order_by('id').annotate(
+                rule_value=Case(When(value_type=ATTR_VALUE_TYPE.CHOICE, then=F('choice_id')),
+                                default=percentage_points(), output_field=IntegerField())
+            ).values('rule_value')[:1]
+            return Subquery(rows, output_field=FloatField())
+        category = self.taxonomy.attributes_by_id.get(self.id(node))
+        if category is None:
+            # a taxonomy read from a snapshot has no tree
+            raise UnsupportedPushdown(node.key)
+        # the attributes below the category are those inside its mptt range, at any depth. The taxonomy is reloaded
+        # whenever an attribute is saved, which is when the ranges move.
+        # NULL when the material has no percentage below the category, as the context has no total for it
+        rows = rows.filter(
+            attribute__tree_id=category.tree_id, attribute__lft__gt=category.lft, attribute__rght__lt=category.rght,
+            value_type=ATTR_VALUE_TYPE.PERCENTAGE,
+        ).order_by().values('material').annotate(rule_value=Sum(percentage_points())).values('rule_value')
+        return Subquery(rows, output_field=FloatField())
+
+    def id(self, node: Operand) -> int:
+        if node.id is None:
+            node = node.resolve(self.taxonomy)
+        return node.id
+
+
+def filter_materials(rule: CompiledRule, min_count: int, queryset: QuerySet = None,
+                     taxonomy: Taxonomy = None) -> QuerySet:
+    """
+    The materials of `queryset` (all of them by default) that pass the rule, filtered by the database. Raises
+    `UnsupportedPushdown` when the rule uses something the database cannot evaluate like python does.
+    """
+    from materials.models import Material
+
+    queryset = Material.objects.all() if queryset is None else queryset
+    compiler = QueryCompiler(taxonomy or taxonomy_cache.get())
+    # an uncompiled rule may still hold constant subexpressions
+    return compiler.filter(queryset, [operation.fold() for operation in rule.operations], min_count)
@@ -0,0 +1,9 @@
+from rest_framework.renderers import JSONRenderer
+
+
+class FlatJSONRenderer(JSONRenderer):
+    """
+    Picked with `?format=flat`. Views check `request.accepted_renderer.format` and return rows whose joined
+    columns are side by side instead of nested.
+    """
+    format = 'flat'
@@ -0,0 +1,218 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from materials.batch import MaterialMatrix
+from materials.context import MaterialContext, Taxonomy, taxonomy_cache
+from materials.exceptions import OPERATION_EXCEPTIONS
+from materials.rules import rule_cache, SubexpressionStats
+
+
+def qualities_referencing(placeholders: set) -> list:
+    """Ids of the qualities whose operations reference any of the (kind, placeholder) pairs."""
+    from materials.models import RecyclerQuality
+
+    quality_ids = []
+    for quality in RecyclerQuality.objects.only('id', 'operations', 'compiled_operations'):
+        try:
+            rule = rule_cache.get(quality)
+        except OPERATION_EXCEPTIONS:
+            continue
+        if rule.placeholders & placeholders:
+            quality_ids.append(quality.pk)
+    return quality_ids
+
+
+def recompile_operations(quality_ids: Iterable[int]):
+    """
+    Compiles the stored operations of the qualities again against the current taxonomy. Those no longer valid
+    lose their compiled form, so they are compiled from `operations` when read and raise as before.
+    """
+    from materials.models import RecyclerQuality
+
+    taxonomy = taxonomy_cache.get()
+    qualities = list(RecyclerQuality.objects.filter(id__in=quality_ids).only('id', 'operations', 'compiled_operations'))
+    for quality in qualities:
+        try:
+            quality.compiled_operations = quality.compile_operations(taxonomy)
+        except OPERATION_EXCEPTIONS:
+            quality.compiled_operations = None
+    RecyclerQuality.objects.bulk_update(qualities, ['compiled_operations'], batch_size=1000)
+
+
+def recompute_results(quality_ids: Optional[Iterable[int]] = None,
+                      material_ids: Optional[Iterable[int]] = None) -> SubexpressionStats:
+    """
+    Re-judges the stored results of the given qualities and/or materials, along with the pairing of every
+    affected quality with its own material. With neither given, every result is recomputed.
+    Pairs whose rule cannot be evaluated lose their stored result, so reading them raises as judging would.
+    Returns how many subexpressions were shared between the qualities judged against the same material.
+    """
+    from materials.models import QualityResult, RecyclerQuality
+
+    if quality_ids is not None and material_ids is not None:
+        scope = Q(quality_id__in=quality_ids) | Q(material_id__in=material_ids)
+        quality_scope = Q(id__in=quality_ids) | Q(material_id__in=material_ids)
+    elif quality_ids is not None:
+        scope, quality_scope = Q(quality_id__in=quality_ids), Q(id__in=quality_ids)
+    elif material_ids is not None:
+        scope, quality_scope = Q(material_id__in=material_ids), Q(material_id__in=material_ids)
+    else:
+        scope, quality_scope = Q(), Q()
+
+    existing = {(result.quality_id, result.material_id): result for result in QualityResult.objects.filter(scope)}
+    pairs = set(existing) | set(RecyclerQuality.objects.filter(quality_scope).values_list('id', 'material_id'))
+    return recompute_pairs(pairs, existing)
+
+
+def recompute_own_results(quality_ids: Iterable[int]) -> SubexpressionStats:
+    """
+    Re-judges each quality against its own material only, the result the API reads. Its results on other
+    materials, stored by `judge_all`, are not touched: a saved quality drops them until the next `judge_all` run.
+    """
+    from materials.models import QualityResult, RecyclerQuality
+
+    pairs = set(RecyclerQuality.objects.filter(id__in=quality_ids).values_list('id', 'material_id'))
+    existing = {
+        (result.quality_id, result.material_id): result
+        for result in QualityResult.objects.filter(quality_id__in=quality_ids,
+                                                   material_id__in={material_id for _, material_id in pairs})
+        if (result.quality_id, result.material_id) in pairs
+    }
+    return recompute_pairs(pairs, existing)
+
+
+def recompute_pairs(pairs: set, existing: dict) -> SubexpressionStats:
+    """Judges the (quality id, material id) pairs and stores the outcomes, `existing` maps pairs to their result."""
+    from materials.models import Material, RecyclerQuality
+
+    stats = SubexpressionStats()
+    if not pairs:
+        return stats
+
+    by_material = defaultdict(list)
+    for quality_id, material_id in pairs:
+        by_material[material_id].append(quality_id)
+    qualities = RecyclerQuality.objects.in_bulk({quality_id for quality_id, _ in pairs})
+    materials = Material.objects.filter(id__in=by_material.keys()).prefetch_related('materialattribute_set')
+    taxonomy = taxonomy_cache.get()
+
+    judged = {}
+    for material in materials:
+        context = MaterialContext(material, taxonomy=taxonomy, stats=stats)
+        for quality_id in by_material[material.pk]:
+            try:
+                judged[(quality_id, material.pk)] = qualities[quality_id].judge(context=context)
+            except OPERATION_EXCEPTIONS:
+                judged[(quality_id, material.pk)] = None
+    write_results(judged, existing, qualities)
+    return stats
+
+
+def judge_all_pairs(material_ids: List[int], qualities: List, taxonomy: Taxonomy = None,
+                    batch_size: int = 1000, matrix: MaterialMatrix = None,
+                    loaded_at: Optional[datetime] = None) -> Tuple[int, int]:
+    """
+    Judges every quality against every one of the materials and stores the results. The attributes of the
+    materials are loaded once into a matrix, unless one is given, rules that cannot be judged on it are judged
+    material by material. Materials and qualities deleted since they were loaded, e.g. into a snapshot, are
+    skipped. Returns the number of pairs judged and of those that passed.
+
+    `loaded_at` is when the materials and qualities were read, when it is older than now. The qualities and
+    materials with a result evaluated since have changed and been judged again on fresher data, their pairs are
+    neither judged nor written.
+    """
+    from materials.models import Material, QualityResult, RecyclerQuality
+
+    taxonomy = taxonomy or taxonomy_cache.get()
+    if matrix is None:
+        matrix = MaterialMatrix.build(material_ids, taxonomy=taxonomy)
+    ids = matrix.material_ids.tolist()
+    live_material_ids = set(Material.objects.filter(id__in=ids).values_list('id', flat=True))
+    live_quality_ids = set(RecyclerQuality.objects.filter(
+        id__in=[quality.pk for quality in qualities]
+    ).values_list('id', flat=True))
+    if loaded_at is not None:
+        changed = QualityResult.objects.filter(
+            Q(material_id__in=live_material_ids) | Q(quality_id__in=live_quality_ids), evaluated_at__gt=loaded_at
+        ).values_list('quality_id', 'material_id')
+        for quality_id, material_id in changed:
+            live_quality_ids.discard(quality_id)
+            live_material_ids.discard(material_id)
+    qualities = [quality for quality in qualities if quality.pk in live_quality_ids]
+    contexts = None
+    judged = {}
+    for quality in qualities:
+        try:
+            passed = quality.judge_materials(matrix).tolist()
+        except OPERATION_EXCEPTIONS:
+            passed = None
+        if passed is not None:
+            judged.update(
+                ((quality.pk, material_id), value) for material_id, value in zip(ids, passed)
+                if material_id in live_material_ids
+            )
+            continue
+        if contexts is None:
+            materials = Material.objects.filter(id__in=ids).prefetch_related('materialattribute_set')
+            contexts = [MaterialContext(material, taxonomy=taxonomy) for material in materials]
+        for context in contexts:
+            if context.material.pk not in live_material_ids:
+                continue
+            try:
+                judged[(quality.pk, context.material.pk)] = quality.judge(context=context)
+            except OPERATION_EXCEPTIONS:
+                judged[(quality.pk, context.material.pk)] = None
+
+    existing = {
+        (result.quality_id, result.material_id): result
+        for result in QualityResult.objects.filter(material_id__in=ids).only('id', 'quality_id', 'material_id')
+    }
+    write_results(judged, existing, {quality.pk: quality for quality in qualities}, batch_size=batch_size,
+                  loaded_at=loaded_at)
+    return len(judged), sum(passed is True for passed in judged.values())
+
+
+def write_results(judged: Dict[Tuple[int, int], Optional[bool]], existing: dict, qualities: dict,
+                  batch_size: int = 1000, loaded_at: Optional[datetime] = None):
+    """
+    Stores the outcome of every judged (quality id, material id) pair, `None` standing for a rule that could not
+    be evaluated, whose stored result is deleted. `existing` maps pairs to their stored result. With `loaded_at`,
+    results evaluated after it, by a change made while judging, are left as they are.
+    """
+    from materials.models import QualityResult
+
+    now = timezone.now()
+    rule_hashes = {}
+    to_create, to_delete = [], []
+    # (quality id, passed) -> ids of the results to update, every group is one UPDATE rather than a CASE per row
+    to_update = defaultdict(list)
+    for (quality_id, material_id), passed in judged.items():
+        result = existing.get((quality_id, material_id))
+        if passed is None:
+            if result is not None:
+                to_delete.append(result.pk)
+            continue
+        if quality_id not in rule_hashes:
+            rule_hashes[quality_id] = qualities[quality_id].rule_hash
+        if result is None:
+            to_create.append(QualityResult(quality_id=quality_id, material_id=material_id, passed=passed,
+                                           evaluated_at=now, rule_hash=rule_hashes[quality_id]))
+        else:
+            to_update[(quality_id, passed)].append(result.pk)
+
+    results = QualityResult.objects.all()
+    if loaded_at is not None:
+        results = results.filter(evaluated_at__lte=loaded_at)
+    with transaction.atomic():
+        results.filter(pk__in=to_delete).delete()
+        for (quality_id, passed), result_ids in to_update.items():
+            for i in range(0, len(result_ids), batch_size):
+                results.filter(pk__in=result_ids[i:i + batch_size]).update(
+                    passed=passed, evaluated_at=now, rule_hash=rule_hashes[quality_id]
+                )
+        QualityResult.objects.bulk_create(to_create, batch_size=batch_size, ignore_conflicts=True)
@@ -0,0 +1,508 @@
+import hashlib
+import json
+import operator as py_operator
+import threading
+from collections import OrderedDict
+from decimal import Decimal
+from typing import Any, Callable, List, Optional, Union
+
+from django.conf import settings
+from django.utils.functional import cached_property
+
+from materials.constants import OPERATORS
+from materials.exceptions import MissingOperatorException, MissingOperandsException, InvalidOperandException, \
+    InvalidRootOperatorException, InvalidOperatorException
+
+PLACEHOLDER_PREFIXES = ('ATTR_', 'OPT_', 'CUM_')
+
+OPERAND_KIND = ('literal', 'attribute', 'option', 'cumulative')
+
+# operators may be written either with their sign or their text, they are normalized to the sign
+OPERATOR_SIGNS = {
+    **{op['sign']: op['sign'] for op in OPERATORS.values()},
+    **{op['text']: op['sign'] for op in OPERATORS.values()},
+}
+BOOLEAN_SIGNS = {op['sign'] for op in OPERATORS.values() if op['is_boolean']}
+COMPARISON_FUNCTIONS = {
+    OPERATORS['GT']['sign']: py_operator.gt,
+    OPERATORS['LT']['sign']: py_operator.lt,
+    OPERATORS['GTE']['sign']: py_operator.ge,
+    OPERATORS['LTE']['sign']: py_operator.le,
+    OPERATORS['EQ']['sign']: py_operator.eq,
+    OPERATORS['NEQ']['sign']: py_operator.ne,
+}
+# numbers are evaluated as basis points of 1, where a percentage and its two decimals are an integer
+BASIS_POINTS = 10000
+
+
+def to_basis_points(value: Any) -> Any:
+    """
+    A numeric literal in basis points, an integer unless it is finer than a basis point.
+
+    Booleans have a single representation: wherever a value is compared or used in arithmetic it is in basis
+    points, so a boolean literal there is the number 1 or 0 and `True` is 10000 (100%). Logical results, those of
+    comparisons, of `and`/`or` and of an operation folded down to a literal, stay `bool`, and a literal compared
+    with one of them is compared unscaled (see `Operation.scales_literals` and `compile_root`).
+    """
+    if isinstance(value, bool):
+        return BASIS_POINTS if value else 0
+    elif not isinstance(value, (int, float)):
+        return value
+    points = Decimal(str(value)) * BASIS_POINTS
+    return int(points) if points == points.to_integral_value() else float(points)
+
+
+def percentage_points(percentage: Optional[Decimal]) -> Optional[int]:
+    # 70.00% is 7000 basis points
+    return None if percentage is None else int(percentage * 100)
+
+
+def multiply_points(left, right):
+    """The product of two numbers in basis points, itself in basis points."""
+    product = left * right
+    if isinstance(product, int) and product % BASIS_POINTS == 0:
+        return product // BASIS_POINTS
+    return product / BASIS_POINTS
+
+
+ARITHMETIC_FUNCTIONS = {
+    OPERATORS['ADD']['sign']: py_operator.add,
+    OPERATORS['MUL']['sign']: multiply_points,
+}
+ORDERING_SIGNS = {OPERATORS[key]['sign'] for key in ('GT', 'LT', 'GTE', 'LTE')}
+# operators whose operands can be reordered without changing the outcome, `!=` only when comparing two operands
+COMMUTATIVE_SIGNS = {OPERATORS[key]['sign'] for key in ('AND', 'OR', 'ADD', 'MUL', 'EQ')}
+# relative cost of resolving an operand, `and`/`or` operands and a rule's operations are evaluated cheapest first
+OPERAND_COSTS = {'literal': 0, 'option': 0, 'attribute': 1, 'cumulative': 2}
+
+
+def operations_hash(operations: Any) -> str:
+    return hashlib.sha1(json.dumps(operations, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def is_placeholder(operand: Any) -> bool:
+    return isinstance(operand, str) and operand.startswith(PLACEHOLDER_PREFIXES)
+
+
+def is_constant(node: Union['Operation', 'Operand'], numeric: bool = True) -> bool:
+    """Whether `node` is a literal that can be folded, only numbers are folded into arithmetic and comparisons."""
+    if not isinstance(node, Operand) or node.kind != 'literal':
+        return False
+    return not numeric or isinstance(node.value, (int, float))
+
+
+def fold_constants(operator: str, values: List[Union[int, float]]) -> Union[bool, int, float]:
+    """
+    The value of an operation on numeric literals, worked out on decimals so that it is exact and stays in the
+    units the rule was written in.
+    """
+    decimals = [Decimal(int(value)) if isinstance(value, int) else Decimal(str(value)) for value in values]
+    if operator in COMPARISON_FUNCTIONS:
+        compare = COMPARISON_FUNCTIONS[operator]
+        return all(compare(left, right) for left, right in zip(decimals, decimals[1:]))
+    arithmetic = py_operator.add if operator == OPERATORS['ADD']['sign'] else py_operator.mul
+    result = decimals[0]
+    for value in decimals[1:]:
+        result = arithmetic(result, value)
+    return int(result) if result == result.to_integral_value() else float(result)
+
+
+def is_truth_valued(node: Union['Operation', 'Operand']) -> bool:
+    """Whether `node` is a comparison or an `and`/`or`, whose value is a boolean and not a number."""
+    return isinstance(node, Operation) and node.operator in BOOLEAN_SIGNS
+
+
+def load_node(node: Any) -> Union['Operation', 'Operand']:
+    if isinstance(node, dict) and 'op' in node:
+        return Operation.load(node)
+    return Operand.load(node)
+
+
+def node_placeholders(node: Union['Operation', 'Operand']) -> set:
+    if isinstance(node, Operation):
+        return node.placeholders()
+    return set() if node.kind == 'literal' else {(node.kind, node.value)}
+
+
+def compile_operations(operations: List[dict], taxonomy) -> List[Any]:
+    """
+    Validates `operations` against the taxonomy and returns their normalized form, ready to be stored: operators
+    are signs, placeholders carry the id they stand for and constant subexpressions are folded.
+    """
+    return [Operation.parse(operation).resolve(taxonomy).fold().dump() for operation in operations]
+
+
+class Operand:
+    """
+    A leaf of an operation, with its kind worked out once at compile time. Placeholders keep their
+    name without the prefix, literals keep their value.
+    """
+    __slots__ = ('kind', 'value', 'id')
+
+    def __init__(self, kind: str, value: Any, id_: Optional[int] = None):
+        self.kind = kind
+        self.value = value
+        # the attribute, option or category the placeholder stood for when the rule was stored
+        self.id = id_
+
+    @classmethod
+    def parse(cls, operand: Union[str, int, float]) -> 'Operand':
+        if isinstance(operand, str) and not operand.isnumeric():
+            for prefix, kind in zip(PLACEHOLDER_PREFIXES, OPERAND_KIND[1:]):
+                if operand.startswith(prefix):
+                    return cls(kind, operand.replace(prefix, '', 1))
+            raise InvalidOperandException(operand, 'Unknown')
+        return cls('literal', operand)
+
+    @classmethod
+    def load(cls, node: Any) -> 'Operand':
+        if isinstance(node, dict):
+            return cls(node['ref'], node['name'], node['id'])
+        return cls('literal', node)
+
+    def dump(self) -> Any:
+        if self.kind == 'literal':
+            return self.value
+        return {'ref': self.kind, 'name': self.value, 'id': self.id}
+
+    def resolve(self, taxonomy) -> 'Operand':
+        if self.kind == 'literal':
+            return self
+        elif self.kind == 'option':
+            id_ = taxonomy.options.get(self.value)
+        elif self.value in (taxonomy.attributes if self.kind == 'attribute' else taxonomy.categories):
+            id_ = taxonomy.ids[self.value]
+        else:
+            id_ = None
+        if id_ is None:
+            raise InvalidOperandException(self.value, self.prefix.rstrip('_'))
+        return Operand(self.kind, self.value, id_)
+
+    def fold(self) -> 'Operand':
+        return self
+
+    def cost(self) -> int:
+        return OPERAND_COSTS[self.kind]
+
+    def compile(self, scaled: bool = True) -> Callable[[Any], Any]:
+        value, id_ = self.value, self.id
+        if self.kind == 'literal':
+            # compared with attribute values, which are in basis points, unless it is compared with a boolean
+            value = to_basis_points(value) if scaled else value
+            return lambda context: value
+        elif self.kind == 'attribute':
+            if id_ is not None:
+                return lambda context: context.attribute_value(id_)
+            return lambda context: context.attribute(value)
+        elif self.kind == 'option':
+            if id_ is not None:
+                return lambda context: id_
+            return lambda context: context.option(value)
+        if id_ is not None:
+            return lambda context: context.cumulative_value(id_)
+        return lambda context: context.cumulative(value)
+
+    @property
+    def prefix(self) -> str:
+        return PLACEHOLDER_PREFIXES[OPERAND_KIND.index(self.kind) - 1]
+
+    def readable(self) -> str:
+        if self.kind == 'literal':
+            return str(self.value)
+        return f'{self.prefix}{self.value}'
+
+    @property
+    def key(self) -> str:
+        return repr(self.value) if self.kind == 'literal' else self.readable()
+
+
+class Operation:
+    __slots__ = ('operator', 'operands', '_key')
+
+    def __init__(self, operator: str, operands: List[Union['Operation', Operand]]):
+        self.operator = operator
+        self.operands = operands
+        self._key = None
+
+    @classmethod
+    def parse(cls, expression: dict, is_root: bool = True) -> 'Operation':
+        """
+        Expressions need to be in the format:
+        [
+            {
+                operator: '+',
+                operands: [
+                    {
+                        operator: '*',
+                        operands: [9, 10]
+                    },
+                    10,
+                    'OTHER_CELLULOSICS'
+                ]
+            }
+        ]
+        """
+        operator = expression.get('operator')
+        if not operator:
+            raise MissingOperatorException(expression)
+        sign = OPERATOR_SIGNS.get(operator)
+        if is_root and sign not in BOOLEAN_SIGNS:
+            raise InvalidRootOperatorException(operator)
+        elif sign is None:
+            raise InvalidOperatorException(operator)
+        operands = expression.get('operands', [])
+        if not operands:
+            raise MissingOperandsException(expression)
+        return cls(sign, [
+            cls.parse(operand, is_root=False) if isinstance(operand, dict) else Operand.parse(operand)
+            for operand in operands
+        ])
+
+    @classmethod
+    def load(cls, node: dict) -> 'Operation':
+        return cls(node['op'], [load_node(operand) for operand in node['args']])
+
+    def dump(self) -> dict:
+        return {'op': self.operator, 'args': [operand.dump() for operand in self.operands]}
+
+    def resolve(self, taxonomy) -> 'Operation':
+        return Operation(self.operator, [operand.resolve(taxonomy) for operand in self.operands])
+
+    def fold(self) -> Union['Operation', Operand]:
+        """
+        Replaces the subexpressions that only involve literals with their value. Literals are dropped from an
+        `and` when truthy and from an `or` when falsy, otherwise they decide it.
+        """
+        operands = [operand.fold() for operand in self.operands]
+        if self.operator in (OPERATORS['AND']['sign'], OPERATORS['OR']['sign']):
+            deciding = self.operator == OPERATORS['OR']['sign']
+            if any(bool(operand.value) is deciding for operand in operands if is_constant(operand, numeric=False)):
+                return Operand('literal', deciding)
+            operands = [operand for operand in operands if not is_constant(operand, numeric=False)]
+            return Operation(self.operator, operands) if operands else Operand('literal', not deciding)
+        if all(is_constant(operand) for operand in operands):
+            return Operand('literal', fold_constants(self.operator, [operand.value for operand in operands]))
+        return Operation(self.operator, operands)
+
+    def cost(self) -> int:
+        return sum(operand.cost() for operand in self.operands)
+
+    def compile(self, shared: bool = True) -> Callable[[Any], Any]:
+        """
+        When `shared`, the value is kept in the context's memo under the operation's key, so the same
+        subexpression is only evaluated once per material however many rules contain it.
+        """
+        function = self.compile_unshared()
+        if not shared:
+            return function
+        key = self.key
+
+        def memoized(context):
+            memo = context.memo
+            context.stats.requested += 1
+            if key in memo:
+                return memo[key]
+            context.stats.evaluated += 1
+            value = memo[key] = function(context)
+            return value
+        return memoized
+
+    def compile_unshared(self) -> Callable[[Any], Any]:
+        operands = self.operands
+        if self.operator in (OPERATORS['AND']['sign'], OPERATORS['OR']['sign']):
+            # the outcome does not depend on the order, the cheapest operands get a chance to decide it first
+            operands = sorted(operands, key=lambda operand: operand.cost())
+        functions = [
+            operand.compile(scaled=self.scales_literals) if isinstance(operand, Operand) else operand.compile()
+            for operand in operands
+        ]
+        if self.operator == OPERATORS['AND']['sign']:
+            def conjunction(context):
+                for function in functions:
+                    if not function(context):
+                        return False
+                return True
+            return conjunction
+        elif self.operator == OPERATORS['OR']['sign']:
+            def disjunction(context):
+                for function in functions:
+                    if function(context):
+                        return True
+                return False
+            return disjunction
+        elif self.operator in COMPARISON_FUNCTIONS:
+            return self.compile_comparison(COMPARISON_FUNCTIONS[self.operator], functions)
+        arithmetic = ARITHMETIC_FUNCTIONS[self.operator]
+
+        def fold(context):
+            # a missing value makes the result missing, like the NaN it is when judging in batch
+            result = functions[0](context)
+            for function in functions[1:]:
+                value = function(context)
+                if result is None or value is None:
+                    return None
+                result = arithmetic(result, value)
+            return result
+        return fold
+
+    @property
+    def scales_literals(self) -> bool:
+        """
+        Literals are in basis points like the values they are compared with, except when compared with the outcome
+        of a comparison or of an `and`/`or`: `(ATTR_POLYESTER > 0.5) == True` compares two booleans.
+        """
+        return not (self.operator in COMPARISON_FUNCTIONS and any(map(is_truth_valued, self.operands)))
+
+    def compile_comparison(self, compare: Callable[[Any, Any], bool], functions: List[Callable]) -> Callable:
+        if self.operator in ORDERING_SIGNS:
+            # a missing value (an attribute the material has no percentage for) never satisfies an ordering
+            def compare(left, right, _compare=compare):
+                return left is not None and right is not None and _compare(left, right)
+        if len(functions) == 2:
+            left, right = functions
+            return lambda context: bool(compare(left(context), right(context)))
+
+        def chain(context):
+            # same semantics as a chained python comparison, e.g. a < b < c
+            left = functions[0](context)
+            for function in functions[1:]:
+                right = function(context)
+                if not compare(left, right):
+                    return False
+                left = right
+            return True
+        return chain
+
+    def readable(self) -> str:
+        return f'({f" {self.operator} ".join(operand.readable() for operand in self.operands)})'
+
+    @property
+    def key(self) -> str:
+        """A canonical form of the operation, the same for operations that only differ by commutation."""
+        if self._key is None:
+            keys = [operand.key for operand in self.operands]
+            if self.operator in COMMUTATIVE_SIGNS or (self.operator == OPERATORS['NEQ']['sign'] and len(keys) == 2):
+                keys.sort()
+            self._key = f'({f" {self.operator} ".join(keys)})'
+        return self._key
+
+    def placeholders(self) -> set:
+        return set().union(*(node_placeholders(operand) for operand in self.operands))
+
+
+def compile_root(node: Union[Operation, Operand]) -> Callable[[Any], bool]:
+    """
+    The program of one of a rule's operations. An operation folded down to a literal has its truth as outcome, a
+    boolean like every other operation's and not the number it would be compared as.
+    """
+    if isinstance(node, Operand):
+        passed = bool(node.value)
+        return lambda context: passed
+    return node.compile()
+
+
+class SubexpressionStats:
+    """How many operations were asked for and how many had to be evaluated, the rest came from a memo."""
+
+    def __init__(self):
+        self.requested = 0
+        self.evaluated = 0
+
+    @property
+    def ratio(self) -> float:
+        return self.requested / self.evaluated if self.evaluated else 1.0
+
+    def __str__(self):
+        return f'{self.requested} requested, {self.evaluated} evaluated ({self.ratio:.2f}x)'
+
+
+class CompiledRule:
+    """
+    The compiled form of a quality's `operations`: every operation is parsed once into typed nodes and turned
+    into nested closures that only need a material context to be evaluated. When the normalized form stored
+    with the quality is given, the nodes are loaded from it without validating anything again.
+    """
+
+    def __init__(self, operations: List[dict], compiled: Optional[List[Any]] = None):
+        self.source = operations
+        if compiled is None:
+            self.operations = [Operation.parse(operation) for operation in operations]
+        else:
+            self.operations = [load_node(node) for node in compiled]
+        self.programs = [compile_root(operation) for operation in self.operations]
+        # judged cheapest first
+        self.ordered_programs = [
+            program for _, program in sorted(zip(self.operations, self.programs), key=lambda pair: pair[0].cost())
+        ]
+        # the (kind, placeholder) pairs the rule depends on
+        self.placeholders = set().union(*(node_placeholders(operation) for operation in self.operations))
+
+    @cached_property
+    def readable(self) -> List[str]:
+        # as written, not folded
+        return [Operation.parse(operation).readable() for operation in self.source]
+
+    def evaluate(self, context) -> List[bool]:
+        return [program(context) for program in self.programs]
+
+    def judge(self, context, min_count: int) -> bool:
+        """
+        Stops as soon as the outcome is known: when `min_count` operations passed, or when too few are left for
+        them to.
+        """
+        required = len(self.ordered_programs) if min_count == -1 else min_count
+        passed, remaining = 0, len(self.ordered_programs)
+        for program in self.ordered_programs:
+            if passed >= required or passed + remaining < required:
+                break
+            passed += program(context) is True
+            remaining -= 1
+        return passed >= required
+
+
+class RuleCache:
+    """
+    Process-wide LRU of compiled rules keyed by (quality id, operations hash), so a changed `operations` never
+    hits a stale entry even before the save signal invalidates it.
+    """
+
+    def __init__(self, max_size: Optional[int] = None):
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def max_size(self) -> int:
+        return self._max_size or getattr(settings, 'MATERIALS_RULE_CACHE_SIZE', 2048)
+
+    def get(self, quality) -> CompiledRule:
+        compiled = quality.compiled_operations
+        if quality.pk is None:
+            return CompiledRule(quality.operations, compiled)
+        key = (quality.pk, operations_hash([quality.operations, compiled]))
+        with self._lock:
+            rule = self._entries.get(key)
+            if rule is not None:
+                self._entries.move_to_end(key)
+                return rule
+        rule = CompiledRule(quality.operations, compiled)
+        with self._lock:
+            self._entries[key] = rule
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return rule
+
+    def invalidate(self, pk: int):
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == pk]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+rule_cache = RuleCache()
@@ -1,6 +1,106 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
 from rest_framework import serializers
 
+from materials.context import MaterialContext, Taxonomy, taxonomy_cache, TaxonomyCache
+from materials.exceptions import InvalidIngestRowException, OPERATION_EXCEPTIONS
+from materials.ingest import MaterialIngester
 from materials.models import Material, Recycler, RecyclerQuality, MaterialAttribute, Attribute, AttributeOption
+from materials.versions import data_versions
+
+
+def get_taxonomy(context: dict) -> Taxonomy:
+    # read once per request and kept in the root serializer's context, so every row sees the same version
+    if 'taxonomy' not in context:
+        context['taxonomy'] = taxonomy_cache.get()
+    return context['taxonomy']
+
+
+class TaxonomyField(serializers.Field):
+    """
+    A foreign key to an attribute or an option, rendered by `serializer` from the cached taxonomy rather than from
+    a joined or fetched row.
+    """
+
+    def __init__(self, serializer, lookup: str, **kwargs):
+        self.serializer = serializer
+        self.lookup = lookup
+        super().__init__(read_only=True, **kwargs)
+
+    def get_attribute(self, instance):
+        return getattr(instance, f'{self.source}_id')
+
+    def to_representation(self, value):
+        instance = getattr(get_taxonomy(self.context), self.lookup).get(value)
+        return None if instance is None else self.serializer(instance, context=self.context).data
+
+
+class SparseFieldsMixin:
+    """Renders only the fields listed in `fields` when it is given, for clients asking for a sparse fieldset."""
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields).difference(fields):
+                self.fields.pop(name)
+
+
+class FragmentCacheMixin:
+    """
+    Caches the representation of every instance in the Django cache, under its id and the versions of the data
+    it is rendered from, listed by `fragment_versions()`. Changing any of that data bumps a version, so fragments
+    are never invalidated, they are left to expire after `MATERIALS_FRAGMENT_CACHE_TIMEOUT` seconds.
+    """
+
+    def fragment_versions(self, instance) -> list:
+        raise NotImplementedError
+
+    def fragment_key(self, instance, versions: dict) -> str:
+        request = self.context.get('request')
+        # hyperlinks are absolute, a fragment is only valid for the host it was rendered for
+        base = request.build_absolute_uri('/') if request is not None else ''
+        # a sparse fieldset is a fragment of its own
+        fields = ','.join(self.fields)
+        source = '|'.join((base, fields, *(str(versions[key]) for key in self.fragment_versions(instance))))
+        return f'materials:fragment:{self.__class__.__name__}:{instance.pk}:{hashlib.md5(source.encode()).hexdigest()}'
+
+    def render(self, instance):
+        return super().to_representation(instance)
+
+    def to_representation(self, instance):
+        timeout = getattr(settings, 'MATERIALS_FRAGMENT_CACHE_TIMEOUT', 0)
+        if not timeout:
+            return self.render(instance)
+        key = self.fragment_key(instance, data_versions.read(self.fragment_versions(instance)))
+        data = cache.get(key)
+        if data is None:
+            data = self.render(instance)
+            cache.set(key, data, timeout)
+        return data
+
+
+class FragmentListSerializer(serializers.ListSerializer):
+    """Reads the versions and the cached fragments of the whole list at once, and renders only those missing."""
+
+    def to_representation(self, data):
+        timeout = getattr(settings, 'MATERIALS_FRAGMENT_CACHE_TIMEOUT', 0)
+        if not timeout:
+            return super().to_representation(data)
+        instances = list(data.all() if isinstance(data, models.Manager) else data)
+        versions = data_versions.read(key for instance in instances for key in self.child.fragment_versions(instance))
+        keys = [self.child.fragment_key(instance, versions) for instance in instances]
+        fragments = cache.get_many(keys)
+        missing = {}
+        for key, instance in zip(keys, instances):
+            if key not in fragments and key not in missing:
+                missing[key] = self.child.render(instance)
+        if missing:
+            cache.set_many(missing, timeout)
+            fragments.update(missing)
+        return [fragments[key] for key in keys]
 
 
 class CategorySerializer(serializers.ModelSerializer):
@@ -13,7 +113,7 @@ class CategorySerializer(serializers.ModelSerializer):
 
 
 class AttributeSerializer(serializers.ModelSerializer):
-    category = CategorySerializer()
+    category = TaxonomyField(CategorySerializer, 'attributes_by_id')
 
     class Meta:
         model = Attribute
@@ -36,8 +136,8 @@ class AttributeOptionSerializer(serializers.ModelSerializer):
 
 
 class MaterialAttributeSerializer(serializers.ModelSerializer):
-    choice = AttributeOptionSerializer()
-    attribute = AttributeSerializer()
+    choice = TaxonomyField(AttributeOptionSerializer, 'options_by_id')
+    attribute = TaxonomyField(AttributeSerializer, 'attributes_by_id')
 
     class Meta:
         model = MaterialAttribute
@@ -50,11 +150,65 @@ class MaterialAttributeSerializer(serializers.ModelSerializer):
         )
 
 
-class MaterialSerializer(serializers.ModelSerializer):
+# the columns the attributes of a material are projected from, joined with their attribute, its category and the
+# chosen option, and the names they have in the flat projection
+MATERIAL_ATTRIBUTE_COLUMNS = (
+    ('id', 'id'),
+    ('attribute_id', 'attribute_id'),
+    ('attribute__name', 'attribute_name'),
+    ('attribute__placeholder', 'attribute_placeholder'),
+    ('attribute__category_id', 'category_id'),
+    ('attribute__category__name', 'category_name'),
+    ('value_type', 'value_type'),
+    ('choice_id', 'choice_id'),
+    ('choice__name', 'choice_name'),
+    ('choice__placeholder', 'choice_placeholder'),
+    ('percentage', 'percentage'),
+)
+
+
+def project_material_attributes(rows, flat: bool = False) -> list:
+    """
+    What `MaterialAttributeSerializer` renders, built straight from rows of `MATERIAL_ATTRIBUTE_COLUMNS` without
+    any serializer. Flat rows keep the joined columns side by side.
+    """
+    percentage_field = MaterialAttributeSerializer().fields['percentage']
+    names = [name for _, name in MATERIAL_ATTRIBUTE_COLUMNS]
+    data = []
+    for row in rows:
+        row = dict(zip(names, row))
+        if row['percentage'] is not None:
+            row['percentage'] = percentage_field.to_representation(row['percentage'])
+        if flat:
+            data.append(row)
+            continue
+        data.append({
+            'id': row['id'],
+            'attribute': {
+                'id': row['attribute_id'],
+                'name': row['attribute_name'],
+                'placeholder': row['attribute_placeholder'],
+                'category': None if row['category_id'] is None else {
+                    'id': row['category_id'],
+                    'name': row['category_name'],
+                },
+            },
+            'value_type': row['value_type'],
+            'choice': None if row['choice_id'] is None else {
+                'id': row['choice_id'],
+                'name': row['choice_name'],
+                'placeholder': row['choice_placeholder'],
+            },
+            'percentage': row['percentage'],
+        })
+    return data
+
+
+class MaterialSerializer(SparseFieldsMixin, FragmentCacheMixin, serializers.ModelSerializer):
     attributes = serializers.HyperlinkedRelatedField(
         source='id', view_name='materials:attributes', lookup_url_kwarg='material_id', read_only=True
     )
-    attributes_count = serializers.IntegerField(source='materialattribute_set.count', read_only=True)
+    attributes_count = serializers.SerializerMethodField()
 
     class Meta:
         model = Material
@@ -64,11 +218,22 @@ class MaterialSerializer(serializers.ModelSerializer):
             'attributes',
             'attributes_count'
         )
+        list_serializer_class = FragmentListSerializer
+
+    def fragment_versions(self, instance) -> list:
+        # bumped when the material or any of its attributes changes
+        return [data_versions.object_key(Material, instance.pk)]
+
+    def get_attributes_count(self, obj) -> int:
+        # annotated by the materials listing, counted from the prefetched attributes when nested in qualities
+        if hasattr(obj, 'attributes_count'):
+            return obj.attributes_count
+        return obj.materialattribute_set.count()
 
 
-class RecyclerQualitySerializer(serializers.ModelSerializer):
+class RecyclerQualitySerializer(FragmentCacheMixin, serializers.ModelSerializer):
     material = MaterialSerializer()
-    passed = serializers.BooleanField(source='judge')
+    passed = serializers.SerializerMethodField()
     condition = serializers.SerializerMethodField()
 
     class Meta:
@@ -82,9 +247,71 @@ class RecyclerQualitySerializer(serializers.ModelSerializer):
             'operations',
             'passed'
         )
+        list_serializer_class = FragmentListSerializer
+
+    def fragment_versions(self, instance) -> list:
+        # whether the quality passes depends on its rule, on the material's attributes and on the taxonomy
+        return [data_versions.object_key(RecyclerQuality, instance.pk),
+                data_versions.object_key(Material, instance.material_id), TaxonomyCache.VERSION_KEY]
 
     def get_condition(self, obj):
-        return ' and '.join(obj.evaluate_conditions(readable=True))
+        try:
+            return ' and '.join(obj.evaluate_conditions(readable=True))
+        except OPERATION_EXCEPTIONS:
+            return ''
+
+    def get_material_context(self, material) -> MaterialContext:
+        # contexts live in the root serializer's context, so they are shared by every quality serialized in the
+        # same request
+        contexts = self.context.setdefault('material_contexts', {})
+        if material.pk not in contexts:
+            contexts[material.pk] = MaterialContext(material, taxonomy=get_taxonomy(self.context),
+                                                    stats=self.context.get('subexpression_stats'))
+        return contexts[material.pk]
+
+    def get_passed(self, obj) -> bool:
+        # the stored result is used as long as it was computed with the current rule, `results` is expected to be
+        # prefetched
+        stored = next((result for result in obj.results.all() if result.material_id == obj.material_id), None)
+        if stored is not None and stored.rule_hash == obj.rule_hash:
+            return stored.passed
+        try:
+            return obj.judge(context=self.get_material_context(obj.material))
+        except OPERATION_EXCEPTIONS:
+            # operations that no longer compile (e.g. an attribute they reference was removed) cannot be judged, the
+            # stored result stands if there is one
+            return stored.passed if stored is not None else False
+
+
+class RecyclerSummarySerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Recycler
+        fields = (
+            'id',
+            'name'
+        )
+
+
+class MatchingQualitySerializer(serializers.ModelSerializer):
+    recycler = RecyclerSummarySerializer()
+    condition = serializers.SerializerMethodField()
+
+    class Meta:
+        model = RecyclerQuality
+        fields = (
+            'id',
+            'title',
+            'min_count',
+            'recycler',
+            'condition',
+            'operations'
+        )
+
+    def get_condition(self, obj):
+        try:
+            return ' and '.join(obj.evaluate_conditions(readable=True))
+        except OPERATION_EXCEPTIONS:
+            return ''
 
 
 class RecyclerSerializer(serializers.ModelSerializer):
@@ -97,3 +324,40 @@ class RecyclerSerializer(serializers.ModelSerializer):
             'name',
             'qualities'
         )
+
+
+class CompositionSerializer(serializers.Serializer):
+    name = serializers.CharField(required=False)
+    # attribute placeholder -> percentage, or the placeholder of the chosen option
+    attributes = serializers.DictField()
+
+
+class WhatIfSerializer(serializers.Serializer):
+    compositions = serializers.ListField(child=CompositionSerializer(), min_length=1)
+    qualities = serializers.ListField(child=serializers.IntegerField(), required=False)
+
+    def validate_compositions(self, compositions):
+        """Resolved into their name and unsaved attributes, validated like ingested materials."""
+        limit = getattr(settings, 'WHAT_IF_MAX_COMPOSITIONS', 500)
+        if len(compositions) > limit:
+            raise serializers.ValidationError(f'At most {limit} compositions can be judged at once.')
+        ingester = MaterialIngester()
+        resolved, errors = [], {}
+        for i, composition in enumerate(compositions):
+            row = {'name': composition.get('name') or f'Composition {i + 1}', 'attributes': composition['attributes']}
+            try:
+                material, material_attributes = ingester.resolve(i, row)
+            except InvalidIngestRowException as e:
+                errors[i] = [f'{e.reason[0].upper()}{e.reason[1:]}.']
+                continue
+            resolved.append((material.name, material_attributes))
+        if errors:
+            raise serializers.ValidationError(errors)
+        return resolved
+
+    def validate_qualities(self, quality_ids):
+        unknown = set(quality_ids).difference(RecyclerQuality.objects.filter(id__in=quality_ids)
+                                              .values_list('id', flat=True))
+        if unknown:
+            raise serializers.ValidationError(f'Unknown qualities {", ".join(map(str, sorted(unknown)))}.')
+        return quality_ids
@@ -0,0 +1,144 @@
+import threading
+import weakref
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_save, post_init
+from django.dispatch import receiver
+
+from materials.context import taxonomy_cache
+from materials.index import quality_index
+from materials.models import RecyclerQuality, Attribute, AttributeOption, MaterialAttribute, Material, Recycler, \
+    QualityResult
+from materials.results import recompute_results, recompute_own_results, qualities_referencing, \
+    recompile_operations
+from materials.rules import rule_cache
+from materials.versions import data_versions
+
+
+@receiver([post_save, post_delete], sender=Attribute)
+@receiver([post_save, post_delete], sender=AttributeOption)
+def invalidate_taxonomy(sender, instance, **kwargs):
+    # connected first, the receivers below read the taxonomy. Bumped again on commit, another process may have
+    # reloaded it before the change was visible to it
+    taxonomy_cache.invalidate()
+    transaction.on_commit(taxonomy_cache.invalidate)
+
+
+@receiver([post_save, post_delete], sender=Material)
+@receiver([post_save, post_delete], sender=MaterialAttribute)
+@receiver([post_save, post_delete], sender=Attribute)
+@receiver([post_save, post_delete], sender=AttributeOption)
+@receiver([post_save, post_delete], sender=Recycler)
+@receiver([post_save, post_delete], sender=RecyclerQuality)
+def bump_data_version(sender, instance, **kwargs):
+    # bumped again on commit, a response rendered before the change was visible must not keep the new ETag
+    data_versions.bump(sender)
+    transaction.on_commit(lambda: data_versions.bump(sender))
+
+
+@receiver([post_save, post_delete], sender=Material)
+@receiver([post_save, post_delete], sender=MaterialAttribute)
+@receiver([post_save, post_delete], sender=RecyclerQuality)
+def bump_fragment_version(sender, instance, **kwargs):
+    # the cached fragments of a material and of a quality are keyed by these versions, the attributes of a material
+    # are part of its fragment
+    model, pk = (Material, instance.material_id) if sender is MaterialAttribute else (sender, instance.pk)
+    data_versions.bump_object(model, pk)
+    transaction.on_commit(lambda: data_versions.bump_object(model, pk))
+
+
+@receiver([post_save, post_delete], sender=RecyclerQuality)
+def invalidate_compiled_rule(sender, instance, **kwargs):
+    rule_cache.invalidate(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=RecyclerQuality)
+@receiver([post_save, post_delete], sender=Attribute)
+@receiver([post_save, post_delete], sender=AttributeOption)
+def invalidate_quality_index(sender, instance, **kwargs):
+    quality_index.invalidate()
+
+
+@receiver(post_save, sender=RecyclerQuality)
+def recompute_quality_results(sender, instance, **kwargs):
+    # only the result the API reads, re-judging the quality against every material judge_all stored it for would
+    # make each save as slow as that run. Those are dropped instead, until the next judge_all stores them again
+    QualityResult.objects.filter(quality=instance).exclude(material=instance.material_id).delete()
+    recompute_own_results([instance.pk])
+
+
+@receiver(post_save, sender=MaterialAttribute)
+def recompute_material_results(sender, instance, **kwargs):
+    recompute_results(material_ids=[instance.material_id])
+
+
+class DeletedMaterialResults:
+    """The materials whose attributes the current transaction deleted, recomputed at once when it commits."""
+
+    def __init__(self, material_id: int):
+        self.material_ids = {material_id}
+        self.done = False
+
+    def __call__(self):
+        self.done = True
+        recompute_results(material_ids=self.material_ids)
+
+
+# a weak reference to the batch of the transaction running in this thread, only `on_commit` holds the batch itself
+_pending = threading.local()
+
+
+@receiver(post_delete, sender=MaterialAttribute)
+def recompute_material_results_on_delete(sender, instance, **kwargs):
+    # deferred, the material itself may be deleted in the same transaction, and batched so that deleting a
+    # material's attributes recomputes it once. Once the batch has run, or a rollback dropped it, nothing holds it
+    # anymore and the next delete starts a new one
+    batch = _pending.batch() if getattr(_pending, 'batch', None) is not None else None
+    if batch is not None and not batch.done:
+        batch.material_ids.add(instance.material_id)
+        return
+    batch = DeletedMaterialResults(instance.material_id)
+    _pending.batch = weakref.ref(batch)
+    transaction.on_commit(batch)
+
+
+@receiver(post_init, sender=Attribute)
+def remember_category(sender, instance, **kwargs):
+    # mptt moves the node, in the database and in its own cache, before pre_save is sent
+    instance._loaded_category_id = instance.category_id
+
+
+@receiver(pre_save, sender=Attribute)
+@receiver(pre_save, sender=AttributeOption)
+def remember_placeholders(sender, instance, **kwargs):
+    previous = sender.objects.filter(pk=instance.pk).first()
+    if previous is not None and sender is Attribute:
+        previous.category_id = getattr(instance, '_loaded_category_id', previous.category_id)
+    instance._previous_placeholders = taxonomy_placeholders(previous)
+
+
+@receiver([post_save, post_delete], sender=Attribute)
+@receiver([post_save, post_delete], sender=AttributeOption)
+def recompute_taxonomy_results(sender, instance, **kwargs):
+    placeholders = taxonomy_placeholders(instance) | getattr(instance, '_previous_placeholders', set())
+    quality_ids = qualities_referencing(placeholders)
+    if quality_ids:
+        recompile_operations(quality_ids)
+        recompute_results(quality_ids=quality_ids)
+
+
+def taxonomy_placeholders(instance) -> set:
+    """The (kind, placeholder) pairs whose meaning depends on an attribute or option."""
+    if instance is None:
+        return set()
+    elif isinstance(instance, AttributeOption):
+        return {('option', instance.placeholder)}
+    placeholders = {('attribute', instance.placeholder), ('cumulative', instance.placeholder)}
+    category = Attribute.objects.filter(pk=instance.category_id).first()
+    if category is not None:
+        # totals of every category above the attribute include it
+        placeholders.update(
+            ('cumulative', placeholder)
+            for placeholder in category.get_ancestors(include_self=True).values_list('placeholder', flat=True)
+        )
+    return placeholders
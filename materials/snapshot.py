@@ -0,0 +1,178 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+from materials.batch import MaterialMatrix
+from materials.context import Taxonomy, taxonomy_cache
+from materials.exceptions import InvalidSnapshotException
+
+MAGIC = b'CFSNAP02'
+# the magic and the length of the JSON header that follows it
+PREAMBLE = struct.Struct('<8sQ')
+# arrays start on a cache line
+ALIGNMENT = 64
+
+
+def align(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def write_snapshot(path: str, taxonomy: Taxonomy = None) -> dict:
+    """
+    Writes the attribute values of every material, the taxonomy and the compiled operations of every quality to
+    `path`. The file is written next to it and then renamed over it, so a process mapping `path` either sees the
+    previous snapshot or the new one, never a partial one. Returns the header.
+
+    The file holds a JSON header followed by little endian arrays: the material ids, the material x attribute
+    matrix of values (as `MaterialMatrix` has them, choices as option ids) and one row of totals per category.
+    """
+    from materials.models import RecyclerQuality
+
+    taxonomy = taxonomy or taxonomy_cache.get()
+    matrix = MaterialMatrix.build(taxonomy=taxonomy)
+    categories = sorted(matrix.categories)
+    arrays = {
+        'material_ids': matrix.material_ids.astype('<i8'),
+        'values': np.ascontiguousarray(matrix.values, dtype='<f8'),
+        'categories': np.array([matrix.categories[category] for category in categories], dtype='<f8').reshape(
+            len(categories), len(matrix)
+        ),
+    }
+    header = {
+        'created': time.time(),
+        'columns': matrix.columns,
+        'categories': categories,
+        'taxonomy': {
+            'attributes': sorted(taxonomy.attributes),
+            'categories': sorted(taxonomy.categories),
+            'options': taxonomy.options,
+            'ancestors': taxonomy.ancestors,
+            'ids': taxonomy.ids,
+            'ancestor_ids': {str(attribute_id): ids for attribute_id, ids in taxonomy.ancestor_ids.items()},
+        },
+        'qualities': [
+            [quality.pk, quality.min_count, quality.operations, quality.compiled_operations]
+            for quality in RecyclerQuality.objects.order_by('id').only(
+                'id', 'min_count', 'operations', 'compiled_operations'
+            )
+        ],
+        'arrays': {},
+    }
+    # offsets are counted from the end of the header
+    size = 0
+    for name, array in arrays.items():
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': size}
+        size = align(size + array.nbytes)
+    encoded = json.dumps(header).encode()
+    start = align(PREAMBLE.size + len(encoded))
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as file:
+            file.write(PREAMBLE.pack(MAGIC, len(encoded)))
+            file.write(encoded)
+            for name, array in arrays.items():
+                file.seek(start + header['arrays'][name]['offset'])
+                file.write(array.tobytes())
+            file.truncate(start + size)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return header
+
+
+class Snapshot:
+    """
+    A snapshot file mapped read-only. Its arrays are views on the mapped pages, so processes mapping the same
+    file share them instead of each holding a copy, and the matrices built from it copy nothing.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mmap) < PREAMBLE.size:
+            raise InvalidSnapshotException(path, 'truncated')
+        magic, length = PREAMBLE.unpack_from(self._mmap)
+        if magic != MAGIC:
+            raise InvalidSnapshotException(path, 'not a snapshot or written by an incompatible version')
+        self.header = json.loads(self._mmap[PREAMBLE.size:PREAMBLE.size + length])
+        start = align(PREAMBLE.size + length)
+        arrays = {}
+        for name, spec in self.header['arrays'].items():
+            dtype, shape, offset = np.dtype(spec['dtype']), tuple(spec['shape']), start + spec['offset']
+            count = int(np.prod(shape))
+            if offset + count * dtype.itemsize > len(self._mmap):
+                raise InvalidSnapshotException(path, f'array "{name}" is truncated')
+            arrays[name] = np.frombuffer(self._mmap, dtype=dtype, count=count, offset=offset).reshape(shape)
+        self.material_ids = arrays['material_ids']
+        self.values = arrays['values']
+        self.categories = dict(zip(self.header['categories'], arrays['categories']))
+
+        taxonomy = self.header['taxonomy']
+        self.taxonomy = Taxonomy(
+            set(taxonomy['attributes']), set(taxonomy['categories']), taxonomy['options'],
+            ancestors={placeholder: tuple(chain) for placeholder, chain in taxonomy['ancestors'].items()},
+            ids=taxonomy['ids'],
+            ancestor_ids={int(attribute_id): tuple(ids) for attribute_id, ids in taxonomy['ancestor_ids'].items()},
+        )
+
+    def __len__(self):
+        return len(self.material_ids)
+
+    @property
+    def created(self) -> float:
+        return self.header['created']
+
+    def matrix(self, start: int = 0, stop: Optional[int] = None) -> MaterialMatrix:
+        """The materials of rows `start` to `stop`, in material id order."""
+        rows = slice(start, stop)
+        return MaterialMatrix(
+            self.material_ids[rows], self.header['columns'], self.values[rows],
+            {category: totals[rows] for category, totals in self.categories.items()}, self.taxonomy
+        )
+
+    def qualities(self) -> List:
+        """Unsaved qualities holding the snapshot's operations, they judge like the stored ones."""
+        from materials.models import RecyclerQuality
+
+        return [
+            RecyclerQuality(id=quality_id, min_count=min_count, operations=operations,
+                            compiled_operations=compiled)
+            for quality_id, min_count, operations, compiled in self.header['qualities']
+        ]
+
+
+class SnapshotCache:
+    """
+    Keeps the snapshot of a path mapped, and maps it again once a new snapshot has been renamed over it. The
+    previous mapping stays valid for as long as something still uses it.
+    """
+
+    def __init__(self):
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def get(self, path: str) -> Snapshot:
+        stat = os.stat(path)
+        identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        cached = self._snapshots.get(path)
+        if cached is not None and cached[0] == identity:
+            return cached[1]
+        with self._lock:
+            cached = self._snapshots.get(path)
+            if cached is None or cached[0] != identity:
+                cached = self._snapshots[path] = (identity, Snapshot(path))
+            return cached[1]
+
+
+snapshot_cache = SnapshotCache()
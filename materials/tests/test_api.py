@@ -1,9 +1,24 @@
+import asyncio
 import json
+import time
+from unittest.mock import patch
 
+from django.db import connection
+from django.test import override_settings, TransactionTestCase, AsyncClient
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
+from materials.constants import ATTR_VALUE_TYPE
+from materials.context import taxonomy_cache
+from materials.exceptions import QueryBudgetExceededException
+from materials.models import RecyclerQuality, Recycler, Material, QualityResult, MaterialAttribute, Attribute, \
+    AttributeOption
+from materials.rules import compile_operations, CompiledRule, SubexpressionStats
+from materials.serializers import MaterialSerializer, MaterialAttributeSerializer
 from materials.tests.test_funcs import TestSetup
-from materials.tests.utils import recursively_assert_values
+from materials.tests.utils import recursively_assert_values, query_budget
+from materials.versions import data_versions
+from materials.views import RecyclerListAPIView, AttributesListAPIView, MaterialListAPIView
 
 
 class TestCFAPI(TestSetup):
@@ -50,3 +65,365 @@ class TestCFAPI(TestSetup):
             }
         ]""")
         recursively_assert_values(expected_data, response.json(), 0, 'data')
+
+    def test_that_recycler_endpoint_queries_do_not_grow_with_qualities(self):
+        self.create_quality()
+        with CaptureQueriesContext(connection) as single:
+            self.client.get(reverse('materials:recyclers'))
+        for i in range(5):
+            RecyclerQuality.objects.create(material=self.material, recycler=self.recycler, title=f'Quality {i}',
+                                           operations=[{'operator': '==', 'operands': ['CUM_COMPOSITION', 1]}])
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(reverse('materials:recyclers'))
+        self.assertEqual(len(response.json()[0]['qualities']), 6)
+        self.assertEqual(len(single), len(many))
+
+    def test_that_matching_qualities_endpoint_returns_passed_qualities(self):
+        self.create_quality()
+        RecyclerQuality.objects.create(material=self.material, recycler=self.recycler, title='Quality Worst',
+                                       operations=[{'operator': '>', 'operands': ['ATTR_POLYESTER', 0.9]}])
+        response = self.client.get(reverse('materials:matching-qualities', kwargs={'material_id': self.material.pk}))
+        self.assertEqual(response.status_code, 200)
+        recursively_assert_values([{
+            'id': self.quality.pk,
+            'title': 'Quality Best',
+            'recycler': {'id': self.recycler.pk, 'name': 'Recycler 1'},
+            'condition': '(4 and (8 * 8 * 8) and ATTR_POLYESTER)',
+        }], response.json())
+        response = self.client.get(reverse('materials:matching-qualities', kwargs={'material_id': 404}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_that_matching_qualities_include_rules_mixing_indexed_operations(self):
+        # the `!=` cannot be indexed and is enough for min_count 1, the `>=` is indexed and holds as well
+        quality = RecyclerQuality.objects.create(
+            material=self.material, recycler=self.recycler, title='Quality Mixed', operations=[
+                {'operator': '!=', 'operands': ['ATTR_WOOL', 0.1]},
+                {'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.7]},
+            ]
+        )
+        response = self.client.get(reverse('materials:matching-qualities', kwargs={'material_id': self.material.pk}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['id'] for item in response.json()], [quality.pk])
+
+    def create_recyclers(self, count):
+        for i in range(count):
+            recycler = Recycler.objects.create(name=f'Recycler {i + 2}')
+            RecyclerQuality.objects.create(material=self.material, recycler=recycler, title='Quality Best',
+                                           operations=self.operations)
+
+    def test_that_recycler_endpoint_paginates_with_a_cursor(self):
+        self.create_quality()
+        self.create_recyclers(4)
+        response = self.client.get(reverse('materials:recyclers'), {'page_size': 2})
+        self.assertEqual([recycler['name'] for recycler in response.json()['results']], ['Recycler 1', 'Recycler 2'])
+        names = []
+        next_page = response.json()['next']
+        while next_page:
+            data = self.client.get(next_page).json()
+            names += [recycler['name'] for recycler in data['results']]
+            next_page = data['next']
+        self.assertEqual(names, ['Recycler 3', 'Recycler 4', 'Recycler 5'])
+
+    @override_settings(RECYCLERS_STREAM_CHUNK_SIZE=2)
+    def test_that_recycler_endpoint_streams_the_same_data(self):
+        self.create_quality()
+        self.create_recyclers(4)
+        response = self.client.get(reverse('materials:recyclers'), {'stream': 'true'})
+        self.assertTrue(response.streaming)
+        self.assertNotIn('X-Subexpressions', response)
+        streamed = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(streamed, self.client.get(reverse('materials:recyclers')).json())
+
+    def test_that_materials_are_listed_by_keyset_with_their_counts(self):
+        materials = [self.material] + [Material.objects.create(name=f'Material {i}') for i in range(2, 6)]
+        MaterialAttribute.objects.create(material=materials[2], attribute=Attribute.objects.get(placeholder='WOOL'),
+                                         value_type=ATTR_VALUE_TYPE.PERCENTAGE, percentage=100)
+        response = self.client.get(reverse('materials:list'), {'page_size': 2})
+        self.assertEqual(response.json()['results'][0], {
+            'id': self.material.pk, 'name': 'Material 1', 'attributes_count': 18,
+            'attributes': f'http://testserver/api/materials/{self.material.pk}/attributes/',
+        })
+        listed = []
+        next_page = response.json()['next']
+        while next_page:
+            data = self.client.get(next_page).json()
+            listed += [(material['id'], material['attributes_count']) for material in data['results']]
+            next_page = data['next']
+        self.assertEqual(listed, [(materials[2].pk, 1), (materials[3].pk, 0), (materials[4].pk, 0)])
+
+    def test_that_materials_are_filtered_by_placeholder_with_sparse_fields(self):
+        other = Material.objects.create(name='Material 2')
+        MaterialAttribute.objects.create(material=other, attribute=Attribute.objects.get(placeholder='WOOL'),
+                                         value_type=ATTR_VALUE_TYPE.PERCENTAGE, percentage=100)
+        dye_method = MaterialAttribute.objects.get(material=self.material, attribute__placeholder='DYE_METHOD')
+        dye_method.choice = AttributeOption.objects.get(placeholder='TOP_DYED')
+        dye_method.save()
+
+        url = reverse('materials:list')
+        self.assertEqual(self.client.get(url, {'attribute': 'WOOL', 'fields': 'id,name'}).json()['results'], [
+            {'id': self.material.pk, 'name': 'Material 1'}, {'id': other.pk, 'name': 'Material 2'},
+        ])
+        self.assertEqual(self.client.get(url, {'attribute': 'WOOL,COTTON', 'option': 'TOP_DYED',
+                                               'fields': 'id'}).json()['results'], [{'id': self.material.pk}])
+        self.assertEqual(self.client.get(url, {'option': 'UNKNOWN'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'fields': 'id,secret'}).status_code, 400)
+
+    def test_that_materials_listing_only_loads_the_taxonomy_to_filter(self):
+        url = reverse('materials:list')
+        taxonomy_cache.invalidate()
+        with self.assertNumQueries(1):
+            self.client.get(url)
+        with query_budget(MaterialListAPIView.query_budget):
+            self.assertEqual(len(self.client.get(url, {'attribute': 'WOOL'}).json()['results']), 1)
+        with self.assertNumQueries(1):
+            self.client.get(url, {'option': 'TOP_DYED'})
+
+    def test_that_endpoints_stay_within_their_query_budget(self):
+        self.create_quality()
+        self.create_recyclers(5)
+        with query_budget(RecyclerListAPIView.query_budget):
+            self.client.get(reverse('materials:recyclers'))
+        with query_budget(AttributesListAPIView.query_budget):
+            self.client.get(reverse('materials:attributes', kwargs={'material_id': self.material.pk}))
+        with query_budget(MaterialListAPIView.query_budget):
+            self.client.get(reverse('materials:list'), {'option': 'TOP_DYED'})
+
+    def test_that_recycler_endpoint_reports_shared_subexpressions(self):
+        self.create_quality()
+        RecyclerQuality.objects.create(material=self.material, recycler=self.recycler, title='Quality Other',
+                                       operations=self.operations)
+        QualityResult.objects.all().delete()
+        response = self.client.get(reverse('materials:recyclers'))
+        self.assertEqual(response['X-Subexpressions'], '2 requested, 1 evaluated (2.00x)')
+
+    def test_that_attributes_are_projected_from_a_single_query(self):
+        dye_method = MaterialAttribute.objects.get(material=self.material, attribute__placeholder='DYE_METHOD')
+        dye_method.choice = AttributeOption.objects.get(placeholder='TOP_DYED')
+        dye_method.save()
+        url = reverse('materials:attributes', kwargs={'material_id': self.material.pk})
+        with self.assertNumQueries(1):
+            data = self.client.get(url).json()
+        serialized = MaterialAttributeSerializer(MaterialAttribute.objects.filter(material=self.material), many=True)
+        self.assertEqual(data, json.loads(json.dumps(serialized.data)))
+        self.assertEqual(data[0]['attribute']['category']['name'], 'Composition')
+
+        flat = self.client.get(url, {'format': 'flat'}).json()
+        self.assertEqual(len(flat), len(data))
+        row = next(row for row in flat if row['id'] == dye_method.pk)
+        self.assertEqual((row['attribute_placeholder'], row['category_name'], row['choice_placeholder']),
+                         ('DYE_METHOD', 'Dyes', 'TOP_DYED'))
+        polyester = next(row for row in flat if row['attribute_placeholder'] == 'POLYESTER')
+        self.assertEqual(polyester['percentage'], '70.00')
+
+    def test_that_attributes_of_unknown_materials_are_not_found(self):
+        empty = Material.objects.create(name='Material 2')
+        self.assertEqual(self.client.get(reverse('materials:attributes', kwargs={'material_id': empty.pk})).json(), [])
+        self.assertEqual(self.client.get(reverse('materials:attributes', kwargs={'material_id': 999})).status_code,
+                         404)
+
+    # off by default with the local memory cache the tests run on
+    @override_settings(MATERIALS_CONDITIONAL_RESPONSES=True)
+    def test_that_unchanged_responses_are_not_modified(self):
+        self.create_quality()
+        url = reverse('materials:recyclers')
+        response = self.client.get(url)
+        self.assertIn('Last-Modified', response)
+        # the links in the body are absolute
+        self.assertNotEqual(self.client.get(url, HTTP_HOST='other.testserver')['ETag'], response['ETag'])
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertNotEqual(self.client.get(url, {'page_size': 1})['ETag'], response['ETag'])
+
+        polyester = MaterialAttribute.objects.get(material=self.material, attribute__name='Polyester')
+        polyester.percentage = 0
+        polyester.save()
+        modified = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(modified.status_code, 200)
+        self.assertFalse(modified.json()[0]['qualities'][0]['passed'])
+        # Last-Modified has a precision of a second, the change may well have happened within the same one
+        since = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(since.status_code, 200)
+        self.assertFalse(since.json()[0]['qualities'][0]['passed'])
+
+    @override_settings(MATERIALS_CONDITIONAL_RESPONSES=True)
+    def test_that_attributes_only_change_with_their_data(self):
+        url = reverse('materials:attributes', kwargs={'material_id': self.material.pk})
+        etag = self.client.get(url)['ETag']
+        Recycler.objects.create(name='Recycler 2')
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Attribute.objects.filter(name='Polyester').get().save()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    @override_settings(MATERIALS_CONDITIONAL_RESPONSES=False)
+    def test_that_responses_are_not_conditional_when_disabled(self):
+        response = self.client.get(reverse('materials:recyclers'))
+        self.assertNotIn('ETag', response)
+        self.assertEqual(self.client.get(reverse('materials:recyclers'), HTTP_IF_NONE_MATCH='*').status_code, 200)
+
+    # off by default with the local memory cache the tests run on
+    @override_settings(MATERIALS_FRAGMENT_CACHE_TIMEOUT=60)
+    def test_that_qualities_are_served_from_cached_fragments(self):
+        self.create_quality()
+        QualityResult.objects.all().delete()
+        url = reverse('materials:recyclers')
+        response = self.client.get(url)
+        self.assertIn('X-Subexpressions', response)
+        # nothing it depends on changed, the quality is neither judged nor serialized again
+        cached = self.client.get(url)
+        self.assertNotIn('X-Subexpressions', cached)
+        self.assertEqual(cached.json(), response.json())
+
+        Material.objects.filter(pk=self.material.pk).get().save(update_fields=['name'])
+        self.assertIn('X-Subexpressions', self.client.get(url))
+        polyester = MaterialAttribute.objects.get(material=self.material, attribute__name='Polyester')
+        polyester.percentage = 0
+        polyester.save()
+        self.assertFalse(self.client.get(url).json()[0]['qualities'][0]['passed'])
+
+    def test_that_qualities_that_no_longer_compile_are_still_served(self):
+        self.create_quality()
+        RecyclerQuality.objects.filter(pk=self.quality.pk).update(
+            operations=[{'operator': 'xor', 'operands': ['ATTR_POLYESTER', 0.5]}], compiled_operations=None
+        )
+        data_versions.bump(RecyclerQuality)
+        response = self.client.get(reverse('materials:recyclers'))
+        self.assertEqual(response.status_code, 200)
+        quality = response.json()[0]['qualities'][0]
+        # the result stored before the rule went invalid stands
+        self.assertEqual((quality['condition'], quality['passed']), ('', True))
+
+        QualityResult.objects.all().delete()
+        data_versions.bump(RecyclerQuality)
+        response = self.client.get(reverse('materials:recyclers'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.json()[0]['qualities'][0]['passed'])
+
+    @override_settings(MATERIALS_FRAGMENT_CACHE_TIMEOUT=0)
+    def test_that_fragments_are_not_cached_when_disabled(self):
+        self.create_quality()
+        QualityResult.objects.all().delete()
+        self.client.get(reverse('materials:recyclers'))
+        self.assertIn('X-Subexpressions', self.client.get(reverse('materials:recyclers')))
+
+    def test_that_what_if_judges_compositions_without_writing(self):
+        self.operations = [
+            {'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.6]},
+            {'operator': '==', 'operands': ['ATTR_DYE_METHOD', 'OPT_TOP_DYED']},
+        ]
+        self.create_quality()
+        self.quality.min_count = -1
+        self.quality.save()
+        other = RecyclerQuality.objects.create(material=self.material, recycler=self.recycler, title='Quality Cotton',
+                                               operations=[{'operator': '>', 'operands': ['CUM_COMPOSITION', 0.9]}])
+        counts = (Material.objects.count(), MaterialAttribute.objects.count(), QualityResult.objects.count())
+        response = self.client.post(reverse('materials:what-if'), {'compositions': [
+            {'name': 'Blend', 'attributes': {'POLYESTER': 65, 'COTTON': 35, 'DYE_METHOD': 'TOP_DYED'}},
+            {'attributes': {'POLYESTER': 50}},
+        ]}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), [
+            {'name': 'Blend', 'passed': [self.quality.pk, other.pk], 'failed': []},
+            {'name': 'Composition 2', 'passed': [], 'failed': [self.quality.pk, other.pk]},
+        ])
+        self.assertEqual((Material.objects.count(), MaterialAttribute.objects.count(), QualityResult.objects.count()),
+                         counts)
+
+        judged = []
+        judge = CompiledRule.judge
+
+        def recording_judge(rule, context, min_count):
+            judged.append(rule)
+            return judge(rule, context, min_count)
+
+        with patch.object(CompiledRule, 'judge', recording_judge):
+            response = self.client.post(reverse('materials:what-if'), {
+                'compositions': [{'attributes': {'POLYESTER': 65, 'COTTON': 35, 'DYE_METHOD': 'TOP_DYED'}}],
+                'qualities': [other.pk]
+            }, content_type='application/json')
+        self.assertEqual(response.json(), [{'name': 'Composition 1', 'passed': [other.pk], 'failed': []}])
+        # the other qualities are not even judged
+        self.assertEqual(len(judged), 1)
+
+    def test_that_what_if_sees_qualities_changed_by_another_process(self):
+        self.operations = [{'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.9]}]
+        self.create_quality()
+        payload = {'compositions': [{'attributes': {'POLYESTER': 65}}]}
+        response = self.client.post(reverse('materials:what-if'), payload, content_type='application/json')
+        self.assertEqual(response.json()[0]['passed'], [])
+
+        operations = [{'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.6]}]
+        RecyclerQuality.objects.filter(pk=self.quality.pk).update(
+            operations=operations, compiled_operations=compile_operations(operations, taxonomy_cache.get())
+        )
+        data_versions.bump(RecyclerQuality)
+        response = self.client.post(reverse('materials:what-if'), payload, content_type='application/json')
+        self.assertEqual(response.json()[0]['passed'], [self.quality.pk])
+
+    def test_that_what_if_rejects_invalid_compositions(self):
+        response = self.client.post(reverse('materials:what-if'), {
+            'compositions': [{'attributes': {'POLYESTER': 65}}, {'attributes': {'UNKNOWN': 1}}], 'qualities': [404]
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'compositions': {'1': ['Unknown attribute "UNKNOWN".']},
+                                           'qualities': ['Unknown qualities 404.']})
+
+        response = self.client.post(reverse('materials:what-if'), {
+            'compositions': [{'attributes': {'POLYESTER': 'nan'}}]
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'compositions': {'0': ['"nan" of "POLYESTER" is not a number.']}})
+
+    @override_settings(QUERY_INSPECTOR_ENABLED=True, QUERY_BUDGET_STRICT=True)
+    def test_that_exceeding_a_query_budget_fails(self):
+        self.create_quality()
+        response = self.client.get(reverse('materials:recyclers'))
+        self.assertLessEqual(int(response['X-Query-Count']), RecyclerListAPIView.query_budget)
+        with patch.object(RecyclerListAPIView, 'query_budget', 1):
+            with self.assertRaises(QueryBudgetExceededException):
+                self.client.get(reverse('materials:recyclers'))
+
+    def test_that_repeated_queries_are_traced_to_their_serializer_field(self):
+        for i in range(5):
+            RecyclerQuality.objects.create(material=Material.objects.create(name=f'Material {i + 2}'),
+                                           recycler=self.recycler, title=f'Quality {i}', operations=self.operations)
+        qualities = RecyclerQuality.objects.select_related('material')
+        with query_budget(100) as recorder:
+            MaterialSerializer([quality.material for quality in qualities], many=True,
+                               context={'request': None}).data
+        origins = set().union(*(shape['origins'] for shape in recorder.repeated().values()))
+        self.assertTrue(any(origin.startswith('MaterialSerializer.attributes_count') for origin in origins))
+
+
+@override_settings(QUERY_INSPECTOR_ENABLED=True, QUERY_BUDGET_STRICT=True)
+class TestAsyncRecyclersAPI(TransactionTestCase):
+    # worker threads use their own connections, they only see committed data
+    setUp = TestSetup.setUp
+    create_quality = TestSetup.create_quality
+
+    @override_settings(RECYCLERS_ASYNC_WORKERS=2)
+    def test_that_async_recycler_endpoint_returns_the_same_data(self):
+        self.create_quality()
+        for i in range(4):
+            recycler = Recycler.objects.create(name=f'Recycler {i + 2}')
+            RecyclerQuality.objects.create(material=self.material, recycler=recycler, title='Quality Best',
+                                           operations=self.operations)
+        QualityResult.objects.all().delete()
+        response = self.client.get(reverse('materials:recyclers-async'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), self.client.get(reverse('materials:recyclers')).json())
+        self.assertIn('X-Subexpressions', response)
+
+    async def test_that_concurrent_async_requests_overlap(self):
+        def slow_serialize_recyclers(request, recycler_ids):
+            time.sleep(0.5)
+            return [], SubexpressionStats()
+
+        client = AsyncClient()
+        with patch('materials.views.serialize_recyclers', slow_serialize_recyclers):
+            start = time.perf_counter()
+            responses = await asyncio.gather(*(client.get(reverse('materials:recyclers-async')) for _ in range(2)))
+            elapsed = time.perf_counter() - start
+        self.assertEqual([response.status_code for response in responses], [200, 200])
+        # one after the other they would take a second
+        self.assertLess(elapsed, 0.9)
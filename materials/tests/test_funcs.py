@@ -1,9 +1,34 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+from importlib import import_module
+from io import StringIO
+from unittest.mock import patch
 
+from django.apps import apps
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from materials.batch import MaterialMatrix
 from materials.constants import ATTR_VALUE_TYPE
-from materials.exceptions import NoOperationToPerformException
+from materials.context import MaterialContext, TaxonomyCache, taxonomy_cache
+from materials.exceptions import NoOperationToPerformException, InvalidOperandException, InvalidOperatorException, \
+    InvalidIngestRowException
+from materials.index import quality_index
+from materials.ingest import ingest_materials, read_rows
 from materials.models import Material, Attribute, MaterialAttribute, Recycler, AttributeOption, \
-    RecyclerQuality
+    RecyclerQuality, QualityResult
+from materials.pushdown import UnsupportedPushdown, filter_materials
+from materials.results import write_results
+from materials.rules import rule_cache, RuleCache, CompiledRule, compile_operations, to_basis_points
+from materials.serializers import RecyclerQualitySerializer
+from materials.snapshot import Snapshot, SnapshotCache, write_snapshot
+from materials.versions import data_versions
 
 CATEGORIES = {
     'Composition': """
@@ -67,6 +92,8 @@ OPTIONS = {
 }
 
 
+# every view requested from a test is held to its query budget
+@override_settings(QUERY_INSPECTOR_ENABLED=True, QUERY_BUDGET_STRICT=True)
 class TestSetup(TestCase):
     def setUp(self) -> None:
         self.material = Material.objects.create(name='Material 1')
@@ -158,3 +185,790 @@ class TestGeneral(TestSetup):
                 'OPT_TOP_DYED'
             ]
         }]
+        self.create_quality()
+        self.assertEqual(self.quality.judge(), False)
+        dye_stuff = MaterialAttribute.objects.get(material=self.material, attribute__placeholder='DYE_STUFF')
+        dye_stuff.choice = AttributeOption.objects.get(placeholder='TOP_DYED')
+        dye_stuff.save()
+        self.assertEqual(self.quality.judge(), True)
+
+    def test_that_operators_can_be_written_as_text(self):
+        self.operations = [{'operator': 'eq', 'operands': ['ATTR_POLYESTER', 0.7]}]
+        self.create_quality()
+        self.assertEqual(self.quality.judge(), True)
+        self.assertEqual(self.quality.evaluate_conditions(readable=True), ['(ATTR_POLYESTER == 0.7)'])
+
+    def test_that_comparisons_chain(self):
+        self.operations = [
+            {'operator': '<', 'operands': [0.2, 'ATTR_COTTON', 'ATTR_POLYESTER', 1]},
+            {'operator': '<', 'operands': [0.2, 'ATTR_POLYESTER', 'ATTR_COTTON']},
+        ]
+        self.create_quality()
+        self.assertEqual(self.quality.evaluate_conditions(), [True, False])
+
+    def test_that_invalid_operator_raises_exception(self):
+        self.operations = [{'operator': 'and', 'operands': [{'operator': '^', 'operands': [1, 2]}]}]
+        with self.assertRaises(InvalidOperatorException):
+            self.create_quality()
+            self.quality.judge()
+
+
+class TestCompiledOperations(TestSetup):
+    def test_that_constants_are_folded_on_save(self):
+        self.create_quality()
+        polyester = Attribute.objects.get(placeholder='POLYESTER')
+        self.assertEqual(self.quality.compiled_operations, [
+            {'op': 'and', 'args': [{'ref': 'attribute', 'name': 'POLYESTER', 'id': polyester.pk}]}
+        ])
+        # the condition is still shown as written
+        self.assertEqual(self.quality.evaluate_conditions(readable=True), ['(4 and (8 * 8 * 8) and ATTR_POLYESTER)'])
+
+    def test_that_operators_and_options_are_normalized(self):
+        self.operations = [
+            {'operator': 'eq', 'operands': ['ATTR_DYE_STUFF', 'OPT_TOP_DYED']},
+            {'operator': 'or', 'operands': [{'operator': '<', 'operands': [1, 2]}, 'ATTR_POLYESTER']},
+        ]
+        self.create_quality()
+        option = AttributeOption.objects.get(placeholder='TOP_DYED')
+        compiled = self.quality.compiled_operations
+        self.assertEqual(compiled[0]['op'], '==')
+        self.assertEqual(compiled[0]['args'][1], {'ref': 'option', 'name': 'TOP_DYED', 'id': option.pk})
+        self.assertIs(compiled[1], True)
+
+    def test_that_rules_folded_to_a_constant_judge_alike_on_every_path(self):
+        cases = [
+            ({'operator': '>', 'operands': [1, 0]}, True),
+            ({'operator': 'and', 'operands': [4, {'operator': '>', 'operands': [1, 0]}]}, True),
+            ({'operator': 'or', 'operands': [0, 2]}, True),
+            ({'operator': '<', 'operands': [1, 0]}, False),
+            ({'operator': 'and', 'operands': [0, 'ATTR_POLYESTER']}, False),
+        ]
+        for operation, expected in cases:
+            with self.subTest(operation=operation):
+                quality = RecyclerQuality.objects.create(material=self.material, recycler=self.recycler,
+                                                         title='Quality Constant', min_count=-1,
+                                                         operations=[operation])
+                self.assertIs(quality.compiled_operations[0], expected)
+                self.assertIs(quality.judge(), expected)
+                self.assertEqual(quality.judge_materials().tolist(), [expected])
+                self.assertEqual(quality.matching_materials(), [self.material.pk] if expected else [])
+                quality.delete()
+
+    def test_that_invalid_operations_are_rejected_on_save(self):
+        self.operations = [{'operator': '>', 'operands': ['ATTR_UNKNOWN', 0.5]}]
+        with self.assertRaises(InvalidOperandException):
+            self.create_quality()
+        quality = RecyclerQuality(material=self.material, recycler=self.recycler, title='Quality Best',
+                                  operations=self.operations)
+        with self.assertRaises(ValidationError):
+            quality.full_clean()
+
+    def test_that_stored_operations_are_not_validated_again(self):
+        self.operations = [{'operator': '>', 'operands': ['ATTR_POLYESTER', 'CUM_DYES', 0]}]
+        self.create_quality()
+        with patch.object(MaterialContext, 'attribute', side_effect=AssertionError), \
+                patch.object(MaterialContext, 'cumulative', side_effect=AssertionError):
+            self.assertEqual(self.quality.judge(), False)
+
+    def test_that_existing_operations_are_compiled_by_the_migration(self):
+        self.create_quality()
+        invalid = RecyclerQuality.objects.create(material=self.material, recycler=self.recycler, title='Quality Worst',
+                                                 operations=self.operations)
+        RecyclerQuality.objects.filter(pk=invalid.pk).update(operations=[{'operator': '>', 'operands': ['ATTR_X', 1]}])
+        compiled = self.quality.compiled_operations
+        RecyclerQuality.objects.update(compiled_operations=None)
+        migration = import_module('materials.migrations.0004_compile_existing_operations')
+        migration.compile_existing_operations(apps, None)
+        self.quality.refresh_from_db()
+        invalid.refresh_from_db()
+        self.assertEqual(self.quality.compiled_operations, compiled)
+        self.assertIsNone(invalid.compiled_operations)
+
+
+class TestShortCircuit(TestSetup):
+    def setUp(self) -> None:
+        super().setUp()
+        self.operations = [
+            {'operator': '==', 'operands': ['CUM_COMPOSITION', 1]},
+            {'operator': '>', 'operands': ['ATTR_POLYESTER', 0.9]},
+        ]
+
+    def judge(self, min_count):
+        self.quality.min_count = min_count
+        with patch.object(MaterialContext, 'cumulative_value', side_effect=AssertionError):
+            return self.quality.judge(context=MaterialContext(self.material))
+
+    def test_that_judge_stops_once_the_outcome_is_known(self):
+        self.create_quality()
+        # the cheaper attribute is checked first and already fails, or leaves too few operations to pass
+        self.assertEqual(self.judge(min_count=-1), False)
+        self.assertEqual(self.judge(min_count=2), False)
+        self.quality.min_count = 1
+        self.assertEqual(self.quality.judge(), True)
+
+    def test_that_boolean_operands_are_evaluated_cheapest_first(self):
+        self.operations = [{'operator': 'or', 'operands': [
+            {'operator': '==', 'operands': ['CUM_COMPOSITION', 1]},
+            {'operator': '<', 'operands': ['ATTR_POLYESTER', 0.9]},
+        ]}]
+        self.create_quality()
+        self.assertEqual(self.judge(min_count=1), True)
+
+
+class TestSubexpressionSharing(TestSetup):
+    def setUp(self) -> None:
+        super().setUp()
+        self.operations = [
+            {'operator': 'and', 'operands': [
+                {'operator': '==', 'operands': ['CUM_COMPOSITION', 1]},
+                {'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.7]},
+            ]},
+        ]
+        self.create_quality()
+        self.other = RecyclerQuality.objects.create(
+            material=self.material, recycler=self.recycler, title='Quality Other', min_count=1,
+            operations=[{'operator': 'and', 'operands': [
+                {'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.7]},
+                {'operator': '==', 'operands': [1, 'CUM_COMPOSITION']},
+            ]}]
+        )
+
+    def test_that_commuted_operations_share_a_key(self):
+        self.assertEqual(rule_cache.get(self.quality).operations[0].key, rule_cache.get(self.other).operations[0].key)
+
+    def test_that_subexpressions_are_evaluated_once_per_material(self):
+        context = MaterialContext(self.material)
+        self.assertEqual(self.quality.judge(context), True)
+        self.assertEqual(self.other.judge(context), True)
+        self.assertEqual((context.stats.requested, context.stats.evaluated), (4, 3))
+
+    def test_that_batch_evaluation_shares_subexpressions(self):
+        matrix = MaterialMatrix.build()
+        self.assertEqual(self.quality.judge_materials(matrix).tolist(), self.other.judge_materials(matrix).tolist())
+        # the second rule is answered by its root, its operands are not even looked up
+        self.assertEqual((matrix.stats.requested, matrix.stats.evaluated), (4, 3))
+
+
+class TestRuleCache(TestSetup):
+    def setUp(self) -> None:
+        super().setUp()
+        rule_cache.clear()
+
+    def test_that_compiled_rule_is_reused(self):
+        self.create_quality()
+        self.quality.judge()
+        rule = rule_cache.get(self.quality)
+        self.quality.judge()
+        self.assertIs(rule_cache.get(self.quality), rule)
+
+    def test_that_saving_quality_invalidates_compiled_rule(self):
+        self.create_quality()
+        self.assertEqual(self.quality.judge(), True)
+        rule = rule_cache.get(self.quality)
+        self.quality.operations = [{'operator': '>', 'operands': ['ATTR_POLYESTER', 0.8]}]
+        self.quality.save()
+        self.assertEqual(len(rule_cache), 1)
+        self.assertIsNot(rule_cache.get(self.quality), rule)
+        self.assertEqual(self.quality.judge(), False)
+
+    def test_that_cache_is_bounded(self):
+        cache = RuleCache(max_size=1)
+        self.create_quality()
+        other = RecyclerQuality.objects.create(material=self.material, recycler=self.recycler, title='Quality Other',
+                                               operations=self.operations)
+        cache.get(self.quality)
+        cache.get(other)
+        self.assertEqual(len(cache), 1)
+
+
+class TestTaxonomyCache(TestSetup):
+    def test_that_taxonomy_is_reused_until_it_changes(self):
+        taxonomy = taxonomy_cache.get()
+        material = Material.objects.prefetch_related('materialattribute_set').get()
+        with self.assertNumQueries(0):
+            self.assertIs(taxonomy_cache.get(), taxonomy)
+            self.assertEqual(MaterialContext(material).attribute('POLYESTER'), 7000)
+        AttributeOption.objects.create(name='Recycled')
+        self.assertIsNot(taxonomy_cache.get(), taxonomy)
+        self.assertIn('RECYCLED', taxonomy_cache.get().options)
+
+    def test_that_renaming_an_attribute_reloads_the_taxonomy(self):
+        self.operations = [{'operator': '>', 'operands': ['ATTR_POLYESTER', 0.5]}]
+        self.create_quality()
+        self.assertEqual(self.quality.judge(), True)
+        polyester = Attribute.objects.get(placeholder='POLYESTER')
+        polyester.name = 'Recycled Polyester'
+        polyester.save()
+        self.assertIn('RECYCLED_POLYESTER', taxonomy_cache.get().attributes)
+        self.quality.refresh_from_db()
+        self.assertIsNone(self.quality.compiled_operations)
+        with self.assertRaises(InvalidOperandException):
+            self.quality.judge()
+
+
+class TestMaterialContext(TestSetup):
+    def test_that_context_resolves_placeholders_without_queries(self):
+        context = MaterialContext(self.material)
+        with self.assertNumQueries(0):
+            self.assertEqual(context.resolve('ATTR_POLYESTER'), 7000)
+            self.assertEqual(context.resolve('CUM_COMPOSITION'), 10000)
+            self.assertEqual(context.resolve(8), 80000)
+
+    def test_that_context_rejects_unknown_placeholders(self):
+        context = MaterialContext(self.material)
+        for operand in ('ATTR_UNKNOWN', 'OPT_UNKNOWN', 'CUM_POLYESTER', 'POLYESTER'):
+            with self.assertRaises(InvalidOperandException):
+                context.resolve(operand)
+
+
+class TestBasisPoints(TestSetup):
+    def setUp(self) -> None:
+        super().setUp()
+        attributes = MaterialAttribute.objects.filter(material=self.material)
+        attributes.filter(attribute__placeholder='POLYESTER').update(percentage=10)
+        attributes.filter(attribute__placeholder='COTTON').update(percentage=20)
+
+    def test_that_sums_and_products_compare_exactly(self):
+        # 0.1 + 0.2 != 0.3 and 0.1 * 3 != 0.3 in floating point
+        self.operations = [
+            {'operator': '==', 'operands': [{'operator': '+', 'operands': ['ATTR_POLYESTER', 'ATTR_COTTON']}, 0.3]},
+            {'operator': '==', 'operands': [{'operator': '*', 'operands': ['ATTR_POLYESTER', 3]}, 0.3]},
+            {'operator': '==', 'operands': ['CUM_COMPOSITION', 0.3]},
+        ]
+        self.create_quality()
+        self.quality.min_count = -1
+        self.assertTrue(self.quality.judge())
+        self.assertEqual(self.quality.judge_materials().tolist(), [True])
+
+    def test_that_booleans_are_one_and_zero_next_to_numbers(self):
+        # as when percentages were fractions: True is 100% next to a percentage, and a truth value next to a boolean
+        cases = [
+            ({'operator': '>', 'operands': ['ATTR_POLYESTER', True]}, False),
+            ({'operator': '>', 'operands': ['ATTR_POLYESTER', False]}, True),
+            ({'operator': '<', 'operands': ['CUM_COMPOSITION', True]}, True),
+            ({'operator': '==', 'operands': [{'operator': '+', 'operands': ['CUM_COMPOSITION', 0.7]}, True]}, True),
+            ({'operator': '==', 'operands': [{'operator': '+', 'operands': ['ATTR_POLYESTER', True]}, 1.1]}, True),
+            ({'operator': '==', 'operands': [{'operator': '>', 'operands': ['ATTR_COTTON', 'ATTR_POLYESTER']},
+                                             True]}, True),
+            ({'operator': '!=', 'operands': [{'operator': '<', 'operands': ['ATTR_COTTON', 0.1]}, False]}, False),
+        ]
+        for operation, expected in cases:
+            with self.subTest(operation=operation):
+                quality = RecyclerQuality(material=self.material, recycler=self.recycler, operations=[operation],
+                                          min_count=-1)
+                self.assertIs(quality.judge(), expected)
+                self.assertEqual(quality.judge_materials().tolist(), [expected])
+                self.assertEqual(quality.matching_materials(), [self.material.pk] if expected else [])
+
+    def test_that_logical_results_stay_booleans(self):
+        # comparisons work on basis points, their outcomes and those of and/or are booleans
+        self.assertEqual(to_basis_points(True), 10000)
+        self.assertEqual(to_basis_points(False), 0)
+        rule = CompiledRule([
+            {'operator': '>', 'operands': ['ATTR_COTTON', True]},
+            {'operator': 'and', 'operands': ['ATTR_POLYESTER', {'operator': '==', 'operands': ['ATTR_COTTON', 0.2]}]},
+            {'operator': 'or', 'operands': [0, 'ATTR_POLYESTER']},
+            {'operator': '==', 'operands': [{'operator': '<', 'operands': ['ATTR_COTTON', 1]}, True]},
+        ])
+        outcomes = rule.evaluate(MaterialContext(self.material))
+        self.assertEqual(outcomes, [False, True, True, True])
+        self.assertTrue(all(type(outcome) is bool for outcome in outcomes))
+
+    def test_that_constants_are_folded_exactly(self):
+        operations = [{'operator': '==', 'operands': [{'operator': '+', 'operands': [0.1, 0.2]}, 'ATTR_POLYESTER']}]
+        self.assertEqual(compile_operations(operations, taxonomy_cache.get())[0]['args'][0], 0.3)
+
+
+class TestBatchJudge(TestSetup):
+    def setUp(self) -> None:
+        super().setUp()
+        self.other_material = Material.objects.create(name='Material 2')
+        MaterialAttribute.objects.bulk_create([
+            MaterialAttribute(material=self.other_material, attribute=attribute, value_type=ATTR_VALUE_TYPE.PERCENTAGE,
+                              percentage=percentage)
+            for attribute, percentage in ((Attribute.objects.get(placeholder='POLYESTER'), 40),
+                                          (Attribute.objects.get(placeholder='WOOL'), 60))
+        ])
+        dye_method = MaterialAttribute.objects.get(material=self.material, attribute__placeholder='DYE_METHOD')
+        dye_method.choice = AttributeOption.objects.get(placeholder='TOP_DYED')
+        dye_method.save()
+
+    def assert_matches_judge(self, min_count=1):
+        self.quality.min_count = min_count
+        matrix = MaterialMatrix.build()
+        passed = self.quality.judge_materials(matrix)
+        expected = []
+        for material_id in matrix.material_ids.tolist():
+            self.quality.material = Material.objects.get(pk=material_id)
+            expected.append(self.quality.judge())
+        self.assertEqual(passed.tolist(), expected)
+        return passed
+
+    def test_that_batch_judge_matches_judge(self):
+        self.operations = [
+            {'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.5]},
+            {'operator': '==', 'operands': ['ATTR_DYE_METHOD', 'OPT_TOP_DYED']},
+            {'operator': 'or', 'operands': [
+                {'operator': '==', 'operands': ['CUM_COMPOSITION', 1]},
+                {'operator': '>', 'operands': [{'operator': '+', 'operands': ['ATTR_WOOL', 0.1]}, 0.65]},
+            ]},
+        ]
+        self.create_quality()
+        self.assertEqual(self.assert_matches_judge().tolist(), [True, True])
+        self.assertEqual(self.assert_matches_judge(min_count=-1).tolist(), [True, False])
+
+    def test_that_batch_judge_falls_back_for_string_literals(self):
+        self.operations = [{'operator': '!=', 'operands': ['ATTR_DYE_METHOD', '5']}]
+        self.create_quality()
+        self.assert_matches_judge()
+
+
+class TestPushdown(TestSetup):
+    def setUp(self) -> None:
+        super().setUp()
+        self.other_material = Material.objects.create(name='Material 2')
+        MaterialAttribute.objects.bulk_create([
+            MaterialAttribute(material=self.other_material, attribute=Attribute.objects.get(placeholder='POLYESTER'),
+                              value_type=ATTR_VALUE_TYPE.PERCENTAGE, percentage=40.33),
+            MaterialAttribute(material=self.other_material, attribute=Attribute.objects.get(placeholder='WOOL'),
+                              value_type=ATTR_VALUE_TYPE.PERCENTAGE, percentage=59.67),
+            MaterialAttribute(material=self.other_material, attribute=Attribute.objects.get(placeholder='DYE_METHOD'),
+                              value_type=ATTR_VALUE_TYPE.CHOICE,
+                              choice=AttributeOption.objects.get(placeholder='UNDYED')),
+        ])
+        Material.objects.create(name='Material 3')
+
+    def assert_matches_judge(self, operations, min_count=1):
+        self.operations = operations
+        self.create_quality()
+        self.quality.min_count = min_count
+        expected = []
+        for material in Material.objects.order_by('id'):
+            self.quality.material = material
+            if self.quality.judge():
+                expected.append(material.pk)
+        self.assertEqual(self.quality.matching_materials(), expected)
+        self.quality.delete()
+        return expected
+
+    def test_that_database_filter_matches_judge(self):
+        material, other, empty = Material.objects.order_by('id').values_list('id', flat=True)
+        self.assertEqual(self.assert_matches_judge([
+            {'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.4033]},
+            {'operator': '==', 'operands': ['CUM_COMPOSITION', 1]},
+        ], min_count=-1), [material, other])
+        self.assertEqual(self.assert_matches_judge([
+            {'operator': '==', 'operands': ['ATTR_WOOL', 'ATTR_SILK']},
+            {'operator': '!=', 'operands': ['ATTR_DYE_METHOD', 'OPT_UNDYED']},
+        ], min_count=2), [material, empty])
+        self.assertEqual(self.assert_matches_judge([
+            {'operator': '<', 'operands': [0.3, 'ATTR_POLYESTER', 0.8]},
+            {'operator': '>', 'operands': [{'operator': '*', 'operands': ['ATTR_WOOL', 'ATTR_POLYESTER']}, 0.24]},
+            {'operator': 'or', 'operands': ['ATTR_COTTON', {'operator': '+', 'operands': ['ATTR_WOOL', 0.1]}]},
+        ], min_count=2), [material, other])
+        self.assertEqual(self.assert_matches_judge([
+            {'operator': '!=', 'operands': ['ATTR_WOOL', 'ATTR_SILK']},
+            {'operator': 'and', 'operands': [4, {'operator': '>', 'operands': [1, 0]}]},
+        ], min_count=2), [other])
+        # booleans are the numbers 1 and 0, scaled to basis points like them
+        self.assertEqual(self.assert_matches_judge([
+            {'operator': '>', 'operands': ['ATTR_POLYESTER', True]},
+        ]), [])
+        self.assertEqual(self.assert_matches_judge([
+            {'operator': '<=', 'operands': ['CUM_COMPOSITION', True]},
+            {'operator': '>', 'operands': [{'operator': '+', 'operands': ['ATTR_POLYESTER', True]}, 1.4]},
+        ], min_count=-1), [material, other])
+
+    def test_that_rules_the_database_cannot_evaluate_fall_back(self):
+        self.operations = [{'operator': '!=', 'operands': ['ATTR_DYE_METHOD', '5']}]
+        self.create_quality()
+        with self.assertRaises(UnsupportedPushdown):
+            filter_materials(rule_cache.get(self.quality), self.quality.min_count)
+        self.assertEqual(self.quality.matching_materials(), list(Material.objects.order_by('id').values_list(
+            'id', flat=True
+        )))
+
+
+class TestQualityIndex(TestSetup):
+    def setUp(self) -> None:
+        super().setUp()
+        quality_index.invalidate()
+        rules = {
+            'Polyester Rich': [{'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.7]}],
+            'Polyester Poor': [{'operator': '<', 'operands': ['ATTR_POLYESTER', 0.7]}],
+            'Cotton Mirrored': [{'operator': '<', 'operands': [0.2, 'ATTR_COTTON']}],
+            'Top Dyed': [{'operator': 'and', 'operands': [
+                {'operator': '==', 'operands': ['ATTR_DYE_METHOD', 'OPT_TOP_DYED']},
+                {'operator': '>', 'operands': ['CUM_COMPOSITION', 0.5]},
+            ]}],
+            'Any Of Two': [
+                {'operator': '==', 'operands': ['ATTR_COTTON', 0.4]},
+                {'operator': '!=', 'operands': ['ATTR_WOOL', 0.1]},
+            ],
+            'All Of Two': [
+                {'operator': '==', 'operands': ['ATTR_COTTON', 0.4]},
+                {'operator': '!=', 'operands': ['ATTR_WOOL', 0.1]},
+            ],
+        }
+        for title, operations in rules.items():
+            RecyclerQuality.objects.create(material=self.material, recycler=self.recycler, title=title,
+                                           operations=operations, min_count=-1 if title == 'All Of Two' else 1)
+
+    def test_that_index_matches_every_rule_evaluation(self):
+        context = MaterialContext(self.material)
+        index = quality_index.get()
+        expected = [quality.pk for quality in RecyclerQuality.objects.order_by('id') if quality.judge(context)]
+        self.assertEqual(index.matching(context), expected)
+        self.assertEqual(
+            sorted(RecyclerQuality.objects.get(pk=pk).title for pk in expected),
+            ['Any Of Two', 'Cotton Mirrored', 'Polyester Rich']
+        )
+
+    def test_that_index_skips_qualities_that_cannot_pass(self):
+        index = quality_index.get()
+        candidates = index.candidates(MaterialContext(self.material))
+        self.assertNotIn(RecyclerQuality.objects.get(title='Polyester Poor').pk, candidates)
+        self.assertNotIn(RecyclerQuality.objects.get(title='All Of Two').pk, candidates)
+
+    def test_that_qualities_always_judged_may_have_indexed_operations(self):
+        quality = RecyclerQuality.objects.create(
+            material=self.material, recycler=self.recycler, title='Either', operations=[
+                {'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.7]},
+                {'operator': '!=', 'operands': ['ATTR_WOOL', 0.1]},
+            ]
+        )
+        candidates = quality_index.get().candidates(MaterialContext(self.material))
+        self.assertEqual(candidates.count(quality.pk), 1)
+
+    def test_that_index_is_rebuilt_when_a_quality_changes(self):
+        index = quality_index.get()
+        quality = RecyclerQuality.objects.get(title='Polyester Poor')
+        quality.operations = [{'operator': '<=', 'operands': ['ATTR_POLYESTER', 0.7]}]
+        quality.save()
+        self.assertIsNot(quality_index.get(), index)
+        self.assertIn(quality.pk, quality_index.get().matching(MaterialContext(self.material)))
+
+    def test_that_index_is_rebuilt_when_another_process_changes_a_quality(self):
+        index = quality_index.get()
+        operations = [{'operator': '<=', 'operands': ['ATTR_POLYESTER', 0.7]}]
+        # saved without the signals of this process, only the shared data version tells about it
+        RecyclerQuality.objects.filter(title='Polyester Poor').update(
+            operations=operations, compiled_operations=compile_operations(operations, taxonomy_cache.get())
+        )
+        self.assertIs(quality_index.get(), index)
+        data_versions.bump(RecyclerQuality)
+        self.assertIsNot(quality_index.get(), index)
+        response = self.client.get(reverse('materials:matching-qualities', kwargs={'material_id': self.material.pk}))
+        self.assertIn('Polyester Poor', [quality['title'] for quality in response.json()])
+
+    def test_that_index_is_rebuilt_when_another_process_changes_the_taxonomy(self):
+        index = quality_index.get()
+        cache.set(TaxonomyCache.VERSION_KEY, taxonomy_cache.version + 1, timeout=None)
+        self.assertIsNot(quality_index.get(), index)
+        self.assertIs(quality_index.get().taxonomy, taxonomy_cache.get())
+
+
+class TestQualityResults(TestSetup):
+    def get_result(self) -> QualityResult:
+        return QualityResult.objects.get(quality=self.quality, material=self.material)
+
+    def test_that_result_is_stored_when_quality_is_saved(self):
+        self.create_quality()
+        result = self.get_result()
+        self.assertEqual(result.passed, True)
+        self.assertEqual(result.rule_hash, self.quality.rule_hash)
+
+    def test_that_result_is_recomputed_when_material_attribute_changes(self):
+        self.operations = [{'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.7]}]
+        self.create_quality()
+        polyester = MaterialAttribute.objects.get(material=self.material, attribute__placeholder='POLYESTER')
+        polyester.percentage = 50
+        polyester.save()
+        self.assertEqual(self.get_result().passed, False)
+
+    def test_that_result_is_recomputed_when_option_is_renamed(self):
+        self.operations = [{'operator': '==', 'operands': ['ATTR_DYE_METHOD', 'OPT_TOP_DYED']}]
+        self.create_quality()
+        option = AttributeOption.objects.get(placeholder='TOP_DYED')
+        option.name = 'Topped'
+        option.save()
+        self.assertFalse(QualityResult.objects.filter(quality=self.quality).exists())
+
+    def test_that_saving_a_quality_drops_its_results_on_other_materials(self):
+        self.operations = [{'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.5]}]
+        self.create_quality()
+        other = Material.objects.create(name='Material 2')
+        call_command('judge_all', processes=1, stdout=StringIO())
+        self.assertTrue(QualityResult.objects.filter(quality=self.quality, material=other).exists())
+        self.quality.operations = [{'operator': '<', 'operands': ['ATTR_POLYESTER', 0.5]}]
+        self.quality.save()
+        self.assertEqual((self.get_result().passed, self.get_result().rule_hash), (False, self.quality.rule_hash))
+        # left to the next judge_all, the API only reads the result of the quality's own material
+        self.assertFalse(QualityResult.objects.filter(quality=self.quality, material=other).exists())
+        call_command('judge_all', processes=1, stdout=StringIO())
+        self.assertEqual(QualityResult.objects.get(quality=self.quality, material=other).rule_hash,
+                         self.quality.rule_hash)
+
+    def test_that_stale_results_are_not_served(self):
+        self.create_quality()
+        QualityResult.objects.filter(quality=self.quality).update(passed=False)
+        serializer = RecyclerQualitySerializer()
+        self.assertEqual(serializer.get_passed(RecyclerQuality.objects.get(pk=self.quality.pk)), False)
+        QualityResult.objects.filter(quality=self.quality).update(rule_hash='stale')
+        self.assertEqual(serializer.get_passed(RecyclerQuality.objects.get(pk=self.quality.pk)), True)
+
+
+class TestDeletedAttributeResults(TransactionTestCase):
+    # on_commit callbacks only run when the transaction really commits
+    setUp = TestSetup.setUp
+
+    def test_that_deleting_a_material_recomputes_it_once(self):
+        material_id = self.material.pk
+        with patch('materials.signals.recompute_results') as recompute:
+            with transaction.atomic():
+                MaterialAttribute.objects.filter(material=self.material).delete()
+                self.material.delete()
+            self.assertEqual(recompute.call_count, 1)
+            self.assertEqual(recompute.call_args.kwargs['material_ids'], {material_id})
+
+    def test_that_a_rolled_back_batch_is_not_reused(self):
+        other = Material.objects.create(name='Material 2')
+        wool = MaterialAttribute.objects.create(material=other, attribute=Attribute.objects.get(placeholder='WOOL'),
+                                                value_type=ATTR_VALUE_TYPE.PERCENTAGE, percentage=100)
+        with patch('materials.signals.recompute_results') as recompute:
+            with self.assertRaises(ValueError), transaction.atomic():
+                MaterialAttribute.objects.filter(material=self.material).delete()
+                raise ValueError
+            with transaction.atomic():
+                wool.delete()
+            self.assertEqual([call.kwargs['material_ids'] for call in recompute.call_args_list], [{other.pk}])
+            # outside of a transaction the batch runs straight away
+            MaterialAttribute.objects.filter(material=self.material, attribute__placeholder='COTTON').delete()
+            self.assertEqual(recompute.call_args.kwargs['material_ids'], {self.material.pk})
+
+
+class TestDataVersions(TestCase):
+    def test_that_counters_evicted_right_away_are_still_read(self):
+        # a full cache drops what is added to it before it can be read back
+        with patch('materials.versions.cache') as evicting:
+            evicting.get_many.return_value = {}
+            keys = [data_versions.object_key(Material, 1), data_versions.object_key(Material, 2)]
+            versions = data_versions.read(keys)
+            (version,), modified = data_versions.get([Material])
+        self.assertEqual(sorted(versions), keys)
+        self.assertIsInstance(version, int)
+        self.assertIsInstance(modified, float)
+
+
+class TestGenerateDataset(TestCase):
+    def test_that_dataset_is_generated_benchmarked_and_flushed(self):
+        out = StringIO()
+        call_command('generate_dataset', '--materials', '5', '--recyclers', '2', '--qualities', '2', '--samples', '2',
+                     '--keep', stdout=out)
+        self.assertEqual(Material.objects.filter(name__startswith='Bench').count(), 5)
+        self.assertEqual(RecyclerQuality.objects.filter(title__startswith='Bench').count(), 4)
+        self.assertEqual(Attribute.objects.filter(name__startswith='Bench').count(), 36)
+        self.assertIn('recyclers ms', out.getvalue())
+        call_command('generate_dataset', '--materials', '5', '--recyclers', '1', '--qualities', '1', stdout=StringIO())
+        self.assertFalse(Material.objects.filter(name__startswith='Bench').exists())
+
+
+class TestIngest(TestSetup):
+    def test_that_jsonl_materials_are_ingested_in_batches(self):
+        rows = StringIO('\n'.join(json.dumps(row) for row in [
+            {'name': 'Blend 1', 'attributes': {'POLYESTER': 65, 'COTTON': 35, 'DYE_METHOD': 'TOP_DYED'}},
+            {'name': 'Blend 2', 'attributes': {'WOOL': 100}},
+            {'name': 'Blend 3', 'attributes': {}},
+        ]))
+        progress = []
+        stats = ingest_materials(read_rows(rows, 'jsonl'), batch_size=2, progress=progress.append)
+        self.assertEqual((stats.materials, stats.attributes, len(progress)), (3, 4, 2))
+        blend = Material.objects.get(name='Blend 1')
+        context = MaterialContext(blend)
+        self.assertEqual(context.attribute('POLYESTER'), 6500)
+        self.assertEqual(context.attribute('DYE_METHOD'), context.option('TOP_DYED'))
+
+    def test_that_csv_materials_are_ingested(self):
+        rows = StringIO('name,POLYESTER,COTTON,DYE_METHOD\nBlend 1,70,30,UNDYED\nBlend 2,,100,\n')
+        stats = ingest_materials(read_rows(rows, 'csv'))
+        self.assertEqual((stats.materials, stats.attributes), (2, 4))
+        self.assertEqual(MaterialContext(Material.objects.get(name='Blend 2')).cumulative('COMPOSITION'), 10000)
+
+    def test_that_invalid_rows_are_reported_or_skipped(self):
+        rows = [{'name': 'Blend 1', 'attributes': {'DYE_METHOD': 'LIGHT'}}, {'name': 'Blend 2', 'attributes': {}}]
+        with self.assertRaises(InvalidIngestRowException):
+            ingest_materials(rows)
+        stats = ingest_materials(rows, skip_invalid=True)
+        self.assertEqual((stats.materials, stats.skipped), (1, 1))
+
+    def test_that_non_finite_percentages_are_rejected(self):
+        for value in ('nan', 'NaN', '-nan', 'sNaN', 'Infinity'):
+            with self.subTest(value=value), self.assertRaises(InvalidIngestRowException):
+                ingest_materials([{'name': 'Blend', 'attributes': {'POLYESTER': value}}])
+        rows = StringIO('name,POLYESTER\nBlend 1,nan\nBlend 2,70\n')
+        stats = ingest_materials(read_rows(rows, 'csv'), skip_invalid=True)
+        self.assertEqual((stats.materials, stats.skipped), (1, 1))
+
+    def test_that_values_must_match_the_kind_of_attribute(self):
+        for attributes in ({'DYE_METHOD': 50}, {'DYE_METHOD': '50'}, {'POLYESTER': 'TOP_DYED'}):
+            with self.subTest(attributes=attributes), self.assertRaises(InvalidIngestRowException):
+                ingest_materials([{'name': 'Blend', 'attributes': attributes}])
+        self.assertFalse(Material.objects.filter(name='Blend').exists())
+
+
+class TestJudgeAll(TestSetup):
+    def test_that_every_pair_is_judged_and_stored(self):
+        self.operations = [{'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.5]}]
+        self.create_quality()
+        other = Material.objects.create(name='Material 2')
+        MaterialAttribute.objects.create(material=other, attribute=Attribute.objects.get(placeholder='POLYESTER'),
+                                         value_type=ATTR_VALUE_TYPE.PERCENTAGE, percentage=40)
+        # rules the matrix cannot evaluate are judged material by material
+        RecyclerQuality.objects.create(material=other, recycler=self.recycler, title='Quality Other',
+                                       operations=[{'operator': '!=', 'operands': ['ATTR_DYE_METHOD', '5']}])
+        out = StringIO()
+        call_command('judge_all', processes=1, chunk_size=1, stdout=out)
+        self.assertIn('4 pairs judged over 2 materials, 3 passed', out.getvalue())
+        self.assertEqual(
+            set(QualityResult.objects.values_list('quality__title', 'material__name', 'passed')),
+            {('Quality Best', 'Material 1', True), ('Quality Best', 'Material 2', False),
+             ('Quality Other', 'Material 1', True), ('Quality Other', 'Material 2', True)}
+        )
+
+    def test_that_existing_results_are_updated_per_quality_and_outcome(self):
+        self.create_quality()
+        materials = [self.material] + [Material.objects.create(name=f'Material {i}') for i in (2, 3)]
+        QualityResult.objects.bulk_create([
+            QualityResult(quality=self.quality, material=material, passed=False, rule_hash='stale')
+            for material in materials[1:]
+        ])
+        existing = {
+            (result.quality_id, result.material_id): result for result in QualityResult.objects.all()
+        }
+        outcomes = list(zip(materials, [True, True, False]))
+        judged = {(self.quality.pk, material.pk): passed for material, passed in outcomes}
+        with CaptureQueriesContext(connection) as queries:
+            write_results(judged, existing, {self.quality.pk: self.quality})
+        updates = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('UPDATE')]
+        # one statement for the passing results and one for the failing one
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(
+            set(QualityResult.objects.values_list('material__name', 'passed', 'rule_hash')),
+            {(material.name, passed, self.quality.rule_hash) for material, passed in outcomes}
+        )
+
+
+class TestSnapshot(TestSetup):
+    def setUp(self) -> None:
+        super().setUp()
+        self.other_material = Material.objects.create(name='Material 2')
+        MaterialAttribute.objects.create(material=self.other_material, value_type=ATTR_VALUE_TYPE.PERCENTAGE,
+                                         attribute=Attribute.objects.get(placeholder='POLYESTER'), percentage=40)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'materials.snapshot')
+
+    def test_that_snapshot_judges_like_the_database(self):
+        self.operations = [
+            {'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.5]},
+            {'operator': '==', 'operands': ['CUM_COMPOSITION', 1]},
+        ]
+        self.create_quality()
+        self.quality.min_count = -1
+        self.quality.save()
+        write_snapshot(self.path)
+        snapshot = Snapshot(self.path)
+        self.assertFalse(snapshot.values.flags.writeable)
+        quality, = snapshot.qualities()
+        self.assertEqual(quality.rule_hash, RecyclerQuality.objects.get().rule_hash)
+        self.assertEqual(quality.judge_materials(snapshot.matrix()).tolist(),
+                         self.quality.judge_materials(MaterialMatrix.build()).tolist())
+        self.assertEqual(snapshot.matrix(1).material_ids.tolist(), [self.other_material.pk])
+
+        out = StringIO()
+        call_command('judge_all', processes=1, snapshot=self.path, stdout=out)
+        self.assertIn('2 pairs judged over 2 materials, 1 passed', out.getvalue())
+
+    def test_that_rows_deleted_since_the_snapshot_are_skipped(self):
+        self.create_quality()
+        # judged material by material, the matrix cannot compare an option to a number
+        other = RecyclerQuality.objects.create(material=self.other_material, recycler=self.recycler,
+                                               title='Quality Other',
+                                               operations=[{'operator': '!=', 'operands': ['ATTR_DYE_METHOD', '5']}])
+        deleted = RecyclerQuality.objects.create(material=self.material, recycler=self.recycler, title='Deleted',
+                                                 operations=self.operations)
+        write_snapshot(self.path)
+        deleted.delete()
+        third = Material.objects.create(name='Material 3')
+        write_snapshot(f'{self.path}.3')
+        third.delete()
+        self.assertEqual(other.judge_materials(Snapshot(f'{self.path}.3').matrix()).tolist(), [True, True, False])
+
+        QualityResult.objects.all().delete()
+        self.other_material.delete()
+        out = StringIO()
+        call_command('judge_all', processes=1, snapshot=self.path, stdout=out)
+        self.assertIn('1 pairs judged over 2 materials, 1 passed', out.getvalue())
+        self.assertEqual(list(QualityResult.objects.values_list('quality', 'material')),
+                         [(self.quality.pk, self.material.pk)])
+
+    def test_that_results_judged_since_the_snapshot_are_not_overwritten(self):
+        self.operations = [{'operator': '>=', 'operands': ['ATTR_POLYESTER', 0.5]}]
+        self.create_quality()
+        write_snapshot(self.path)
+        polyester = MaterialAttribute.objects.get(material=self.material, attribute__placeholder='POLYESTER')
+        polyester.percentage = 40
+        polyester.save()
+        self.assertFalse(QualityResult.objects.get(quality=self.quality, material=self.material).passed)
+
+        call_command('judge_all', processes=1, snapshot=self.path, stdout=StringIO())
+        self.assertFalse(QualityResult.objects.get(quality=self.quality, material=self.material).passed)
+        # the quality and the material changed since the snapshot, none of their pairs are judged from it
+        self.assertFalse(QualityResult.objects.filter(material=self.other_material).exists())
+
+    def test_that_a_new_snapshot_is_mapped_once_published(self):
+        cache = SnapshotCache()
+        write_snapshot(self.path)
+        snapshot = cache.get(self.path)
+        self.assertIs(cache.get(self.path), snapshot)
+        Material.objects.create(name='Material 3')
+        write_snapshot(self.path)
+        self.assertEqual(len(cache.get(self.path)), 3)
+        # still mapped for whoever holds it
+        self.assertEqual(len(snapshot.matrix()), 2)
+
+
+class TestCategoryRollUp(TestSetup):
+    def setUp(self) -> None:
+        super().setUp()
+        composition = Attribute.objects.get(placeholder='COMPOSITION')
+        cellulosics = Attribute.objects.create(name='Cellulosics', category=composition)
+        viscose = Attribute.objects.get(placeholder='VISCOSELYOCELL')
+        viscose.category = cellulosics
+        viscose.save()
+        attributes = MaterialAttribute.objects.filter(material=self.material)
+        attributes.filter(attribute=viscose).update(percentage=20)
+        attributes.filter(attribute__placeholder='POLYESTER').update(percentage=50)
+
+    def test_that_cumulative_operands_cover_the_whole_subtree(self):
+        context = MaterialContext(self.material)
+        self.assertEqual(context.cumulative('CELLULOSICS'), 2000)
+        self.assertEqual(context.cumulative('COMPOSITION'), 10000)
+        self.operations = [{'operator': '==', 'operands': ['CUM_COMPOSITION', 1]},
+                           {'operator': '==', 'operands': ['CUM_CELLULOSICS', 0.2]}]
+        self.create_quality()
+        self.quality.min_count = -1
+        self.assertEqual(self.quality.judge_materials().tolist(), [True])
+        # summed by the database over the mptt range of the category
+        self.assertEqual(list(filter_materials(rule_cache.get(self.quality), -1).values_list('id', flat=True)),
+                         [self.material.pk])
+
+    def test_that_moving_an_attribute_recomputes_results(self):
+        self.operations = [{'operator': '==', 'operands': ['CUM_CELLULOSICS', 0.2]}]
+        self.create_quality()
+        self.assertEqual(QualityResult.objects.get(quality=self.quality).passed, True)
+        viscose = Attribute.objects.get(placeholder='VISCOSELYOCELL')
+        viscose.category = Attribute.objects.get(placeholder='COMPOSITION')
+        viscose.save()
+        # Cellulosics is left without attributes, so is no longer a category the rule can be evaluated on
+        self.assertFalse(QualityResult.objects.filter(quality=self.quality).exists())
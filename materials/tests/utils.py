@@ -1,6 +1,9 @@
 from collections import OrderedDict
+from contextlib import contextmanager
 from typing import Any
 
+from materials.instrumentation import QueryRecorder
+
 
 def recursively_assert_values(exp: Any, o: Any, s: int = 0, parent: str = ''):
     if type(exp) != type(o):
@@ -24,3 +27,16 @@ def recursively_assert_values(exp: Any, o: Any, s: int = 0, parent: str = ''):
             recursively_assert_values(exp[i], o[i], s + 4, f'{parent}[{i}]')
     else:
         assert exp == o, f'{parent} failed, \nExpected {exp}, \nBut got {o}'
+
+
+@contextmanager
+def query_budget(budget: int):
+    """
+    Fails when the block runs more than `budget` queries, reporting the repeated query shapes and where they
+    were issued from. Pass a view's `query_budget` to hold a test to what the view declares.
+    """
+    recorder = QueryRecorder()
+    with recorder.record():
+        yield recorder
+    if len(recorder) > budget:
+        raise AssertionError(f'Query budget of {budget} exceeded: {recorder.report()}')
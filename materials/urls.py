@@ -5,6 +5,11 @@ from materials import views
 app_name = 'materials'
 
 urlpatterns = [
+    path('', views.MaterialListAPIView.as_view(), name='list'),
     path('<int:material_id>/attributes/', views.AttributesListAPIView.as_view(), name='attributes'),
+    path('<int:material_id>/matching-qualities/', views.MatchingQualitiesListAPIView.as_view(),
+         name='matching-qualities'),
     path('recyclers/', views.RecyclerListAPIView.as_view(), name='recyclers'),
+    path('recyclers/async/', views.recyclers_async, name='recyclers-async'),
+    path('what-if/', views.WhatIfAPIView.as_view(), name='what-if'),
 ]
@@ -0,0 +1,135 @@
+import asyncio
+import hashlib
+import time
+from functools import wraps
+from typing import Iterable, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, quote_etag
+from django.utils.http import http_date
+
+
+class DataVersions:
+    """
+    A counter per model in the Django cache, bumped along with the time of the change whenever one of its rows
+    is saved or deleted. Responses derive their ETag and Last-Modified from the counters of the models they are
+    built from, so a client polling an unchanged resource is answered before anything is loaded or serialized.
+    Rows whose serialized form is cached have a counter of their own.
+    """
+    PREFIX = 'materials:data-version'
+
+    def key(self, model) -> str:
+        return f'{self.PREFIX}:{model._meta.label_lower}'
+
+    @staticmethod
+    def initial() -> int:
+        # a counter evicted from the cache starts over from the clock, not from a value an ETag was derived from
+        return time.time_ns() // 1000
+
+    def object_key(self, model, pk) -> str:
+        return f'{self.key(model)}:{pk}'
+
+    def increment(self, key: str):
+        if not cache.add(key, self.initial(), timeout=None):
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, self.initial(), timeout=None)
+
+    def bump(self, *models):
+        now = time.time()
+        for model in models:
+            key = self.key(model)
+            self.increment(key)
+            cache.set(f'{key}:modified', now, timeout=None)
+
+    def bump_object(self, model, pk):
+        """Bumps the counter of a single row, the fragments rendered from it are keyed by it."""
+        self.increment(self.object_key(model, pk))
+
+    def read(self, keys: Iterable[str]) -> dict:
+        """The counters under the keys, those missing from the cache start over."""
+        keys = set(keys)
+        values = cache.get_many(keys)
+        missing = keys.difference(values)
+        if missing:
+            initial = self.initial()
+            for key in missing:
+                cache.add(key, initial, timeout=None)
+            # a full cache may evict them again right away, they then only last for this read
+            values = {**dict.fromkeys(missing, initial), **values, **cache.get_many(missing)}
+        return values
+
+    def get(self, models: Iterable) -> Tuple[list, float]:
+        """The counters of the models and when the last of them changed."""
+        keys = [self.key(model) for model in models]
+        modified_keys = [f'{key}:modified' for key in keys]
+        values = cache.get_many(keys + modified_keys)
+        missing = [key for key in keys + modified_keys if key not in values]
+        if missing:
+            now, initial = time.time(), self.initial()
+            defaults = {key: now if key.endswith(':modified') else initial for key in missing}
+            for key, value in defaults.items():
+                cache.add(key, value, timeout=None)
+            values = {**defaults, **values, **cache.get_many(missing)}
+        return [values[key] for key in keys], max(values[key] for key in modified_keys)
+
+    def validators(self, request, models: Iterable) -> Tuple[str, int]:
+        """
+        The ETag and Last-Modified timestamp of the response to the request. The query string and the Accept
+        header pick the page and the renderer, and the host is in the absolute links of the body, they are part of
+        the ETag.
+        """
+        versions, modified = self.get(models)
+        source = '|'.join((request.get_host(), request.get_full_path(), request.META.get('HTTP_ACCEPT', ''),
+                           *map(str, versions)))
+        return quote_etag(hashlib.md5(source.encode()).hexdigest()), int(modified)
+
+
+data_versions = DataVersions()
+
+
+def conditional(*models):
+    """
+    Like Django's `condition()`, with the validators taken from the data versions of the models the view reads,
+    and usable on async views. A matching `If-None-Match` returns a 304 without calling the view. Last-Modified
+    is only informational: it has a precision of a second, a change within the second a client last fetched in
+    would go unnoticed by `If-Modified-Since`.
+    Only enabled with `MATERIALS_CONDITIONAL_RESPONSES`, the views are called as they are otherwise.
+    """
+
+    def enabled() -> bool:
+        return getattr(settings, 'MATERIALS_CONDITIONAL_RESPONSES', False)
+
+    def set_validators(request, response, etag: str, last_modified: int):
+        if request.method in ('GET', 'HEAD') and response.status_code == 200:
+            response.setdefault('ETag', etag)
+            response.setdefault('Last-Modified', http_date(last_modified))
+        return response
+
+    def decorator(view):
+        if asyncio.iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapper(request, *args, **kwargs):
+                if not enabled():
+                    return await view(request, *args, **kwargs)
+                etag, last_modified = await sync_to_async(data_versions.validators)(request, models)
+                response = get_conditional_response(request, etag=etag)
+                if response is None:
+                    response = await view(request, *args, **kwargs)
+                return set_validators(request, response, etag, last_modified)
+        else:
+            @wraps(view)
+            def wrapper(request, *args, **kwargs):
+                if not enabled():
+                    return view(request, *args, **kwargs)
+                etag, last_modified = data_versions.validators(request, models)
+                response = get_conditional_response(request, etag=etag)
+                if response is None:
+                    response = view(request, *args, **kwargs)
+                return set_validators(request, response, etag, last_modified)
+        return wrapper
+
+    return decorator
@@ -1,24 +1,253 @@
-from rest_framework.generics import ListAPIView, get_object_or_404
+import asyncio
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
 
-from materials.models import Material, Recycler, MaterialAttribute
-from materials.serializers import RecyclerSerializer, MaterialAttributeSerializer
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Prefetch, F, Count, Exists, OuterRef
+from django.http import StreamingHttpResponse, JsonResponse
+from django.utils.decorators import method_decorator
+from rest_framework.exceptions import ValidationError
+from rest_framework.generics import ListAPIView, GenericAPIView, get_object_or_404
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
 
+from materials.context import MaterialContext, taxonomy_cache
+from materials.index import quality_index
+from materials.pagination import RecyclerCursorPagination, MaterialCursorPagination
+from materials.renderers import FlatJSONRenderer
+from materials.rules import SubexpressionStats
+from materials.models import Material, Recycler, MaterialAttribute, RecyclerQuality, QualityResult, Attribute, \
+    AttributeOption
+from materials.serializers import RecyclerSerializer, MaterialAttributeSerializer, MatchingQualitySerializer, \
+    WhatIfSerializer, MaterialSerializer, MATERIAL_ATTRIBUTE_COLUMNS, project_material_attributes
+from materials.versions import conditional
+from materials.whatif import judge_compositions
 
+# the models a response is built from, a change to any of them changes its ETag
+QUALITIES_DATA = (Recycler, RecyclerQuality, Material, MaterialAttribute, Attribute, AttributeOption)
+ATTRIBUTES_DATA = (Material, MaterialAttribute, Attribute, AttributeOption)
+
+
+@method_decorator(conditional(*QUALITIES_DATA), name='dispatch')
 class RecyclerListAPIView(ListAPIView):
     queryset = Recycler.objects.all()
     serializer_class = RecyclerSerializer
+    pagination_class = RecyclerCursorPagination
+    query_budget = 10
 
     def get_queryset(self):
-        return self.queryset.prefetch_related(
+        return self.prefetch(self.queryset)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.subexpression_stats = SubexpressionStats()
+
+    def get_serializer_context(self):
+        # qualities of the same material judged in this request share their subexpressions
+        return {**super().get_serializer_context(), 'subexpression_stats': self.subexpression_stats}
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        stats = getattr(self, 'subexpression_stats', None)
+        # a streamed body is only judged once the headers are sent, there is nothing to report yet
+        if stats is not None and stats.requested and not response.streaming:
+            response['X-Subexpressions'] = str(stats)
+        return response
+
+    @staticmethod
+    def prefetch(queryset):
+        return queryset.prefetch_related(
             'recyclerquality_set', 'recyclerquality_set__material',
             'recyclerquality_set__material__materialattribute_set',
+            Prefetch(
+                'recyclerquality_set__results',
+                queryset=QualityResult.objects.filter(material_id=F('quality__material_id'))
+            ),
         )
 
+    def list(self, request, *args, **kwargs):
+        if request.query_params.get('stream', '').lower() in ('1', 'true'):
+            return StreamingHttpResponse(self.stream(), content_type='application/json')
+        return super().list(request, *args, **kwargs)
+
+    def stream(self):
+        """
+        Writes the JSON list recycler by recycler, loading and prefetching `RECYCLERS_STREAM_CHUNK_SIZE`
+        recyclers at a time so memory is bounded by the chunk size and not by the number of recyclers.
+        """
+        chunk_size = getattr(settings, 'RECYCLERS_STREAM_CHUNK_SIZE', 100)
+        queryset = self.filter_queryset(self.queryset).order_by('id')
+        last_id = None
+        separator = ''
+        yield '['
+        while True:
+            chunk = queryset if last_id is None else queryset.filter(id__gt=last_id)
+            chunk = list(self.prefetch(chunk[:chunk_size]))
+            if not chunk:
+                break
+            # a fresh context per chunk, so the material contexts cached while serializing do not pile up
+            serializer = self.get_serializer(chunk, many=True)
+            for item in serializer.data:
+                yield separator + json.dumps(item, cls=JSONEncoder)
+                separator = ','
+            last_id = chunk[-1].id
+        yield ']'
+
+
+recyclers_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'RECYCLERS_ASYNC_WORKERS', 4),
+                                        thread_name_prefix='recyclers')
+
+
+@conditional(*QUALITIES_DATA)
+async def recyclers_async(request):
+    """
+    The recyclers listing for ASGI deployments. Recyclers are split in chunks that are loaded, judged and
+    serialized concurrently on a bounded thread pool, every worker thread using its own database connection,
+    so the listing never holds more than `RECYCLERS_ASYNC_WORKERS` connections at once.
+    It has no query budget, the query inspector does not see the connections of the worker threads.
+    """
+    recycler_ids = await sync_to_async(list)(Recycler.objects.order_by('id').values_list('id', flat=True))
+    # spread over every worker, without any chunk growing past what the streamed listing loads at once
+    size = min(math.ceil(len(recycler_ids) / getattr(settings, 'RECYCLERS_ASYNC_WORKERS', 4)),
+               getattr(settings, 'RECYCLERS_STREAM_CHUNK_SIZE', 100)) or 1
+    loop = asyncio.get_running_loop()
+    chunks = await asyncio.gather(*(
+        loop.run_in_executor(recyclers_executor, serialize_recyclers, request, recycler_ids[i:i + size])
+        for i in range(0, len(recycler_ids), size)
+    ))
+
+    data, stats = [], SubexpressionStats()
+    for chunk, chunk_stats in chunks:
+        data.extend(chunk)
+        stats.requested += chunk_stats.requested
+        stats.evaluated += chunk_stats.evaluated
+    response = JsonResponse(data, safe=False, encoder=JSONEncoder)
+    if stats.requested:
+        response['X-Subexpressions'] = str(stats)
+    return response
+
+
+def serialize_recyclers(request, recycler_ids: list) -> tuple:
+    # worker threads live outside of the request cycle that usually recycles connections
+    close_old_connections()
+    try:
+        stats = SubexpressionStats()
+        queryset = RecyclerListAPIView.prefetch(Recycler.objects.filter(id__in=recycler_ids).order_by('id'))
+        serializer = RecyclerSerializer(queryset, many=True, context={'request': request, 'subexpression_stats': stats})
+        return serializer.data, stats
+    finally:
+        close_old_connections()
+
+
+@method_decorator(conditional(*ATTRIBUTES_DATA), name='dispatch')
+class MaterialListAPIView(ListAPIView):
+    """
+    The materials, paged with a cursor on their id. `?attribute=` and `?option=` take comma separated
+    placeholders of attributes the materials have and of options they chose, all of which must match, and
+    `?fields=` the fields to render.
+    """
+    queryset = Material.objects.all()
+    serializer_class = MaterialSerializer
+    pagination_class = MaterialCursorPagination
+    # the page, and the taxonomy when filtering on a cold cache
+    query_budget = 3
 
+    def get_fields(self):
+        if 'fields' not in self.request.query_params:
+            return None
+        fields = [name for name in self.request.query_params['fields'].split(',') if name]
+        unknown = set(fields).difference(MaterialSerializer.Meta.fields)
+        if unknown:
+            raise ValidationError({'fields': f'Unknown fields {", ".join(sorted(unknown))}.'})
+        return fields
+
+    def get_placeholder_ids(self, param: str, ids: dict) -> list:
+        placeholders = [placeholder for placeholder in self.request.query_params.get(param, '').split(',')
+                        if placeholder]
+        unknown = [placeholder for placeholder in placeholders if placeholder not in ids]
+        if unknown:
+            raise ValidationError({param: f'Unknown {param} placeholders {", ".join(unknown)}.'})
+        return [ids[placeholder] for placeholder in placeholders]
+
+    def get_queryset(self):
+        queryset = self.queryset
+        fields = self.get_fields()
+        if fields is None or 'attributes_count' in fields:
+            # counted in the page query instead of once per material
+            queryset = queryset.annotate(attributes_count=Count('materialattribute'))
+        if not {'attribute', 'option'}.intersection(self.request.query_params):
+            return queryset
+        # placeholders are resolved through the taxonomy, which costs two queries when it is not loaded yet
+        taxonomy = taxonomy_cache.get()
+        attribute_ids = {placeholder: taxonomy.ids[placeholder] for placeholder in taxonomy.attributes}
+        for attribute_id in self.get_placeholder_ids('attribute', attribute_ids):
+            queryset = queryset.filter(Exists(MaterialAttribute.objects.filter(
+                material=OuterRef('pk'), attribute_id=attribute_id
+            )))
+        for option_id in self.get_placeholder_ids('option', taxonomy.options):
+            queryset = queryset.filter(Exists(MaterialAttribute.objects.filter(
+                material=OuterRef('pk'), choice_id=option_id
+            )))
+        return queryset
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.setdefault('fields', self.get_fields())
+        return super().get_serializer(*args, **kwargs)
+
+
+@method_decorator(conditional(*ATTRIBUTES_DATA), name='dispatch')
 class AttributesListAPIView(ListAPIView):
+    """
+    The attributes of a material, projected from a single query joined with the attributes, their categories and
+    the options, the material itself is only looked up when it has no attributes. `?format=flat` returns the
+    joined columns side by side.
+    """
     queryset = MaterialAttribute.objects.all()
     serializer_class = MaterialAttributeSerializer
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, FlatJSONRenderer]
+    query_budget = 2
 
     def get_queryset(self):
-        material = get_object_or_404(Material, pk=self.kwargs.get('material_id'))
-        return self.queryset.filter(material=material)
+        return self.queryset.filter(material_id=self.kwargs.get('material_id'))
+
+    def list(self, request, *args, **kwargs):
+        rows = list(self.get_queryset().values_list(*(column for column, _ in MATERIAL_ATTRIBUTE_COLUMNS)))
+        if not rows:
+            # a material without attributes, or no material at all
+            get_object_or_404(Material, pk=self.kwargs.get('material_id'))
+        return Response(project_material_attributes(rows, flat=request.accepted_renderer.format == 'flat'))
+
+
+@method_decorator(conditional(*QUALITIES_DATA), name='dispatch')
+class MatchingQualitiesListAPIView(ListAPIView):
+    queryset = RecyclerQuality.objects.all()
+    serializer_class = MatchingQualitySerializer
+    query_budget = 10
+
+    def get_queryset(self):
+        material = get_object_or_404(
+            Material.objects.prefetch_related('materialattribute_set'),
+            pk=self.kwargs.get('material_id')
+        )
+        index = quality_index.get()
+        matching = index.matching(MaterialContext(material, taxonomy=index.taxonomy))
+        return self.queryset.filter(id__in=matching).select_related('recycler').order_by('id')
+
+
+class WhatIfAPIView(GenericAPIView):
+    """
+    Judges hypothetical compositions, `{"compositions": [{"name": ..., "attributes": {placeholder: value}}]}`,
+    against every quality or those listed in `qualities`, in memory and without writing anything.
+    """
+    serializer_class = WhatIfSerializer
+    query_budget = 10
+
+    def post(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        return Response(judge_compositions(serializer.validated_data['compositions'],
+                                           serializer.validated_data.get('qualities')))
@@ -0,0 +1,33 @@
+from typing import Iterable, List, Optional, Tuple
+
+from materials.context import MaterialContext
+from materials.index import quality_index
+
+
+def judge_compositions(compositions: Iterable[Tuple[str, list]],
+                       quality_ids: Optional[Iterable[int]] = None) -> List[dict]:
+    """
+    Judges hypothetical materials, given as their name and unsaved `MaterialAttribute`s, against the qualities
+    (all of them unless `quality_ids` is given) without writing anything. The quality index picks the candidates
+    of every composition, a quality whose rule cannot be evaluated is not passed.
+    """
+    from materials.models import Material, RecyclerQuality
+
+    index = quality_index.get()
+    # only the requested qualities are judged, every quality when none are requested
+    requested = None if quality_ids is None else set(quality_ids)
+    if quality_ids is None:
+        quality_ids = RecyclerQuality.objects.order_by('id').values_list('id', flat=True)
+    quality_ids = sorted(set(quality_ids))
+
+    results = []
+    for name, material_attributes in compositions:
+        context = MaterialContext(Material(name=name), taxonomy=index.taxonomy,
+                                  material_attributes=material_attributes)
+        matching = set(index.matching(context, requested))
+        results.append({
+            'name': name,
+            'passed': [quality_id for quality_id in quality_ids if quality_id in matching],
+            'failed': [quality_id for quality_id in quality_ids if quality_id not in matching],
+        })
+    return results